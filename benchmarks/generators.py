@@ -0,0 +1,94 @@
+import os
+
+from os import path
+
+import numpy as np
+
+from utils.preparator import prepare_flo2d_run_config
+
+# Origin of the synthetic model domain, in the same projected coordinates as the 250m model.
+ORIGIN_X = 400000.0
+ORIGIN_Y = 500000.0
+# Model time between two timesteps, in hours.
+TIME_STEP = 0.5
+BASE_DATE_TIME = '2018-05-01_00:00:00'
+
+
+def generate_run(run_path, cells, channels, time_steps, grid_size=250.0, seed=1):
+    """
+    Generate a synthetic finished run with the output files the extractors read.
+    :param run_path: str, directory to create the run in
+    :param cells: int, number of flood plain cells
+    :param channels: int, number of channel elements
+    :param time_steps: int, number of timesteps written to TIMDEP.OUT and HYCHAN.OUT
+    :param grid_size: float, distance between the cells, the resolution of the water level grids
+    :param seed: int, seed of the random values
+    :return: dict, paths of the generated output files
+    """
+    output_path = path.join(run_path, 'output')
+    input_path = path.join(run_path, 'input')
+    for dir_path in (output_path, input_path):
+        if not path.exists(dir_path):
+            os.makedirs(dir_path)
+    prepare_flo2d_run_config(input_path, 'benchmark', BASE_DATE_TIME, BASE_DATE_TIME)
+
+    random = np.random.RandomState(seed)
+    files = {
+        'CADPTS.DAT': path.join(output_path, 'CADPTS.DAT'),
+        'TIMDEP.OUT': path.join(output_path, 'TIMDEP.OUT'),
+        'HYCHAN.OUT': path.join(output_path, 'HYCHAN.OUT')
+    }
+    generate_cad_pts(files['CADPTS.DAT'], cells, grid_size)
+    generate_timdep(files['TIMDEP.OUT'], cells, time_steps, random)
+    generate_hychan(files['HYCHAN.OUT'], channels, time_steps, random)
+    return files
+
+
+def generate_cad_pts(cad_pts_file_path, cells, grid_size=250.0):
+    # Cells are laid out row by row on a square grid.
+    side = int(np.ceil(np.sqrt(cells))) or 1
+    elements = np.arange(1, cells + 1)
+    x = ORIGIN_X + grid_size * ((elements - 1) % side)
+    y = ORIGIN_Y + grid_size * ((elements - 1) // side)
+    with open(cad_pts_file_path, 'w') as F:
+        np.savetxt(F, np.column_stack((elements, x, y)), fmt='%8d %14.3f %14.3f')
+
+
+def generate_timdep(timdep_file_path, cells, time_steps, random):
+    # One block per timestep, the model time followed by
+    # element, depth, x velocity, y velocity, velocity and elevation of each cell.
+    elements = np.arange(1, cells + 1)
+    ground = 5.0 + random.random_sample(cells)
+    with open(timdep_file_path, 'w', newline='\r\n') as F:
+        for step in range(time_steps):
+            F.write('%12.2f\n' % (step * TIME_STEP))
+            depths = np.maximum(random.normal(0.2, 0.3, cells), 0.0)
+            rows = np.column_stack((elements, depths, random.random_sample(cells), random.random_sample(cells),
+                                    np.zeros(cells), ground + depths))
+            np.savetxt(F, rows, fmt='%8d%10.3f%10.3f%10.3f%10.3f%10.3f')
+
+
+def generate_hychan(hychan_file_path, channels, time_steps, random):
+    # One series per channel element, time, elevation, depth, velocity, discharge and froude number of each timestep.
+    times = np.arange(time_steps) * TIME_STEP
+    with open(hychan_file_path, 'w', newline='\r\n') as F:
+        F.write(' FLO-2D HYCHAN.OUT\n\n')
+        for channel in range(1, channels + 1):
+            F.write('     CHANNEL HYDROGRAPH FOR ELEMENT NO: %8d\n\n' % (channel * 7))
+            F.write('    TIME   ELEVATION   DEPTH   VELOCITY   DISCHARGE  FROUDE\n\n')
+            depths = random.random_sample(time_steps)
+            rows = np.column_stack((times, 3.0 + depths, depths, random.random_sample(time_steps),
+                                    random.random_sample(time_steps) * 100, np.full(time_steps, 0.1)))
+            np.savetxt(F, rows, fmt='%8.2f%12.3f%10.3f%10.3f%12.3f%8.3f')
+            F.write('\n   MAXIMUM DISCHARGE = %.3f\n\n' % rows[:, 4].max() if time_steps else '\n')
+
+
+def get_cell_maps(cells, channels, sample=100):
+    """
+    Cell maps of the extract endpoints for the generated run.
+    :param sample: int, every sample-th cell and channel is requested
+    :return: tuple of dict, (CHANNEL_CELL_MAP, FLOOD_PLAIN_CELL_MAP)
+    """
+    channel_cell_map = {str(channel * 7): 'CH%d' % channel for channel in range(1, channels + 1, sample)}
+    flood_plain_cell_map = {str(cell): 'FP%d' % cell for cell in range(1, cells + 1, sample)}
+    return channel_cell_map, flood_plain_cell_map
@@ -0,0 +1,212 @@
+"""
+Benchmarks of the extraction paths on synthetic FLO2D outputs.
+
+    python -m benchmarks --cells 100000 --channels 500 --time-steps 48 --output results.json
+    python -m benchmarks --compare results-before.json results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from os import path
+
+from benchmarks.generators import generate_run, get_cell_maps
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak working set is read with GetProcessMemoryInfo instead.
+    resource = None
+
+BENCHMARKS = ['extract_water_levels', 'extract_water_discharge', 'extract_water_level_grid']
+
+# Output files each benchmark reads, used to work out the throughput.
+BENCHMARK_INPUTS = {
+    'extract_water_levels': ['TIMDEP.OUT', 'HYCHAN.OUT'],
+    'extract_water_discharge': ['HYCHAN.OUT'],
+    'extract_water_level_grid': ['TIMDEP.OUT', 'CADPTS.DAT']
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the FLO2D output extraction.')
+    parser.add_argument('--cells', type=int, default=100000, help='number of flood plain cells')
+    parser.add_argument('--channels', type=int, default=500, help='number of channel elements')
+    parser.add_argument('--time-steps', type=int, default=48, help='number of output timesteps')
+    parser.add_argument('--grid-size', type=float, default=250.0, help='cell size of the water level grids')
+    parser.add_argument('--grid-processes', type=int, default=1, help='processes rendering the water level grids')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times each benchmark is run')
+    parser.add_argument('--benchmark', action='append', choices=BENCHMARKS, help='benchmarks to run, all by default')
+    parser.add_argument('--work-dir', help='directory to generate the run in, a temporary directory by default')
+    parser.add_argument('--output', help='file to save the results in as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two saved results')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='flo2d-benchmark-')
+    try:
+        results = run_benchmarks(work_dir, args)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as F:
+            json.dump(results, F, indent=2)
+        print('Saved: ' + args.output)
+
+
+def run_benchmarks(work_dir, args):
+    run_path = path.join(work_dir, 'run')
+    print('Generating %d cells, %d channels, %d timesteps...' % (args.cells, args.channels, args.time_steps))
+    start = time.time()
+    files = generate_run(run_path, args.cells, args.channels, args.time_steps, args.grid_size)
+    print('Generated in %.1fs' % (time.time() - start))
+
+    results = {
+        'commit': _get_commit(),
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'sizes': {
+            'cells': args.cells,
+            'channels': args.channels,
+            'time_steps': args.time_steps,
+            'grid_size': args.grid_size,
+            'grid_processes': args.grid_processes,
+            'files': {name: path.getsize(file_path) for name, file_path in files.items()}
+        },
+        'benchmarks': {}
+    }
+    # Each benchmark runs in a fresh process, so its peak RSS is not hidden by an earlier benchmark.
+    context = multiprocessing.get_context('spawn')
+    for name in args.benchmark or BENCHMARKS:
+        input_size = sum(results['sizes']['files'][file_name] for file_name in BENCHMARK_INPUTS[name])
+        timings = []
+        peak_rss = None
+        for attempt in range(max(args.repeat, 1)):
+            with context.Pool(1) as pool:
+                seconds, rss = pool.apply(_run_benchmark, (name, work_dir, args.cells, args.channels,
+                                                           args.grid_size, args.grid_processes))
+            timings.append(seconds)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+        # The first run also builds the indexes and caches kept next to the outputs, the later runs reuse them.
+        warm_seconds = min(timings[1:]) if len(timings) > 1 else timings[0]
+        results['benchmarks'][name] = {
+            'seconds': timings,
+            'cold_seconds': timings[0],
+            'best_seconds': warm_seconds,
+            'input_size': input_size,
+            'mb_per_s': input_size / 1024.0 / 1024.0 / warm_seconds if warm_seconds else None,
+            'peak_rss_mb': peak_rss / 1024.0 / 1024.0 if peak_rss is not None else None
+        }
+    return results
+
+
+def _run_benchmark(name, work_dir, cells, channels, grid_size, grid_processes):
+    from utils import extract_water_levels, extract_water_discharge, extract_water_level_grid, get_run_date_times
+
+    run_path = path.join(work_dir, 'run')
+    channel_cell_map, flood_plain_cell_map = get_cell_maps(cells, channels)
+    grid_dir = path.join(work_dir, 'grid')
+    if path.exists(grid_dir):
+        shutil.rmtree(grid_dir)
+    os.makedirs(grid_dir)
+
+    start = time.time()
+    # The extractors report every timestep, keep the benchmark output readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        if name == 'extract_water_levels':
+            extract_water_levels(run_path, channel_cell_map, flood_plain_cell_map)
+        elif name == 'extract_water_discharge':
+            extract_water_discharge(run_path, channel_cell_map)
+        else:
+            base_dt, run_dt = get_run_date_times(run_path)
+            extract_water_level_grid(run_path, grid_size, base_dt, run_dt, grid_dir, grid_processes)
+    seconds = time.time() - start
+    return seconds, _get_peak_rss()
+
+
+def _get_peak_rss():
+    if resource is None:
+        return _get_windows_peak_working_set()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _get_windows_peak_working_set():
+    # Peak working set of the benchmark process only, the grid rendering processes are not included.
+    if os.name != 'nt':
+        return None
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+            [(field, ctypes.c_size_t) for field in ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                                                    'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                                                    'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    kernel32.K32GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters),
+                                                 wintypes.DWORD]
+    kernel32.K32GetProcessMemoryInfo.restype = wintypes.BOOL
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if not kernel32.K32GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path.dirname(path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    # best is the fastest of the runs after the first, cold is the first run.
+    print('%-26s %10s %10s %10s %12s' % ('benchmark', 'cold (s)', 'best (s)', 'MB/s', 'peak RSS MB'))
+    for name, result in results['benchmarks'].items():
+        print('%-26s %10.3f %10.3f %10.1f %12s' % (name, result['cold_seconds'], result['best_seconds'],
+                                                   result['mb_per_s'] or 0.0, _format_mb(result['peak_rss_mb'])))
+
+
+def compare_results(before_path, after_path):
+    with open(before_path, 'r') as F:
+        before = json.load(F)
+    with open(after_path, 'r') as F:
+        after = json.load(F)
+    if before['sizes'] != after['sizes']:
+        print('Warning: The results were taken with different sizes.')
+    print('%-33s %12s %12s %8s' % ('benchmark', 'before (s)', 'after (s)', 'speedup'))
+    for name, result in after['benchmarks'].items():
+        if name not in before['benchmarks']:
+            continue
+        for label, key in [('', 'best_seconds'), (' (cold)', 'cold_seconds')]:
+            # Results saved before the cold run was reported separately have no cold_seconds.
+            if key not in before['benchmarks'][name] or key not in result:
+                continue
+            before_seconds = before['benchmarks'][name][key]
+            print('%-33s %12.3f %12.3f %7.2fx' % (name + label, before_seconds, result[key],
+                                                  before_seconds / result[key] if result[key] else 0))
+
+
+def _format_mb(size):
+    return '%.1f' % size if size is not None else '-'
@@ -2,3 +2,82 @@
 UPLOADS_DEFAULT_DEST = ''
 MODEL_250M_TEMPLATE_DIR = ''
 FLO2D_LIBS_DIR = ''
+
+# Model run scheduler configs
+RUN_QUEUE_FILE = ''
+# Number of FLOPRO runs allowed at once.
+RUN_SLOTS = 2
+# CPUs each run slot is pinned to, e.g. [[0, 1, 2, 3], [4, 5, 6, 7]]. Leave empty to not pin the runs.
+# Works on Linux and on Windows, where the CPUs are of the processor group of FLOPRO.exe (CPU numbers 0 to 63).
+RUN_SLOT_CPUS = []
+
+# SQLite database of the model runs. Defaults to <UPLOADS_DEFAULT_DEST>/FLO2D/runs.db
+RUN_REGISTRY_DB = ''
+
+# How the model template and FLO2D libraries are placed in the run directories. 'copy', 'hardlink' or 'reflink'.
+# 'reflink' clones the files on copy-on-write file systems (btrfs, xfs) and copies them elsewhere, a run writing to a
+# file only changes its own copy. 'hardlink' shares the files with the snapshot and every other run, only use it when
+# FLOPRO never modifies a template or library file in place.
+RUN_DIR_LINK_MODE = 'reflink'
+# Template snapshots to link the runs from, should be on the same drive as the runs.
+# Defaults to <UPLOADS_DEFAULT_DEST>/FLO2D/template-snapshots
+TEMPLATE_SNAPSHOT_DIR = ''
+
+# Model directories kept prepared with the template and FLO2D libraries, a run takes one instead of preparing its own.
+# 0 to prepare the model directory of each run when it starts. The pool is rebuilt when the template changes.
+# Defaults to <UPLOADS_DEFAULT_DEST>/FLO2D/run-dir-pool, must be on the same drive as the runs.
+RUN_DIR_POOL_SIZE = 2
+RUN_DIR_POOL_DIR = ''
+
+# Python interpreter the worker processes (grid rendering, extraction jobs) are started with. Required on Windows
+# under mod_wsgi, where the server executable is httpd.exe, e.g. 'C:/Python37/python.exe'. Leave empty to use the
+# interpreter of the server.
+PYTHON_EXECUTABLE = ''
+
+# Number of processes rendering the water level grids of a run. 1 to render them in the request thread. Grid jobs
+# render in their job process, they are bounded by JOB_PROCESSES.
+GRID_PROCESSES = 4
+
+# Grid geometries built from CADPTS.DAT, shared by the runs of the same model.
+# Defaults to <UPLOADS_DEFAULT_DEST>/FLO2D/geometry
+GEOMETRY_CACHE_DIR = ''
+
+# Chunked water level grid store (format=zarr of water-level-grid.zip). Coordinate reference system of the CADPTS.DAT
+# coordinates, written to the store metadata, and the (time, rows, cols) shape of a compressed chunk.
+GRID_CRS = 'EPSG:5235'
+GRID_STORE_CHUNKS = [8, 256, 256]
+
+# Keep the run input files once in a content addressed store and link them into the runs. Defaults to
+# <UPLOADS_DEFAULT_DEST>/FLO2D/input-store, should be on the same drive as the runs.
+INPUT_STORE = True
+INPUT_STORE_DIR = ''
+# Days a stored input file is kept after the last run using it was removed, so clients can still refer to it by
+# its SHA-256.
+INPUT_STORE_UNUSED_DAYS = 7
+
+# Stream output.zip and water-level-grid.zip while they are being built instead of building them first.
+STREAM_ARCHIVES = True
+# Keep the streamed archives in the run directory for repeat downloads.
+ARCHIVE_CACHE = True
+
+# Extraction result cache. Defaults to <UPLOADS_DEFAULT_DEST>/FLO2D/result-cache
+RESULT_CACHE_DIR = ''
+# Size limits of the in memory and on disk result cache tiers, in MB. 0 disk size to keep the results in memory only.
+RESULT_CACHE_MEMORY_MB = 256
+RESULT_CACHE_DISK_MB = 4096
+
+# Serve /metrics only to requests from the local host.
+METRICS_LOCAL_ONLY = True
+# Directory to write the sampled profiles of the requests made with profile=true. Leave empty to not allow profiling.
+PROFILE_DIR = ''
+
+# Batch extraction across runs. Threads extracting the runs of a batch request, and the most runs in one request.
+BATCH_WORKERS = 4
+BATCH_MAX_RUNS = 50
+
+# Extraction jobs, the long extractions submitted to /FLO2D/250m/jobs and run in a pool of local processes.
+# Defaults to <UPLOADS_DEFAULT_DEST>/FLO2D/jobs
+JOB_DIR = ''
+# Processes running the jobs, and the hours a finished job and its result are kept.
+JOB_PROCESSES = 2
+JOB_MAX_AGE_HOURS = 24
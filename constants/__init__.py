@@ -1 +1,2 @@
-from .general_constants import INIT_DATE_TIME_FORMAT
+from .general_constants import INIT_DATE_TIME_FORMAT, DATE_TIME_FORMAT, RUN_STATE_INITIALIZED, RUN_STATE_QUEUED, \
+    RUN_STATE_RUNNING, RUN_STATE_FINISHED, RUN_STATE_FAILED
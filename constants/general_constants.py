@@ -1 +1,8 @@
 INIT_DATE_TIME_FORMAT = "%Y-%m-%d_%H:%M:%S"
+DATE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+RUN_STATE_INITIALIZED = 'Initialized'
+RUN_STATE_QUEUED = 'Queued'
+RUN_STATE_RUNNING = 'Running'
+RUN_STATE_FINISHED = 'Finished'
+RUN_STATE_FAILED = 'Failed'
@@ -1,19 +1,50 @@
 import json
+import multiprocessing
+import os
+import threading
 
 from datetime import datetime, timedelta
-from flask import Flask, request, send_from_directory, jsonify
+from flask import Flask, Request, Response, request, send_from_directory, jsonify
 from flask_negotiate import consumes, produces
 from flask_json import FlaskJSON, JsonError, json_response
 from flask_uploads import UploadSet, configure_uploads
 from os import path
 
-from constants import INIT_DATE_TIME_FORMAT
-from config import UPLOADS_DEFAULT_DEST, FLO2D_LIBS_DIR, MODEL_250M_TEMPLATE_DIR
-from utils import is_valid_run_name, is_valid_init_dt, parse_run_id, prepare_flo2d_run, run_flo2d_model, \
-    prepare_flo2d_output, extract_water_levels, extract_water_discharge, prepare_flo2d_waterlevel_grid_asci, \
-    prepare_flo2d_run_config, is_output_ready
+from constants import INIT_DATE_TIME_FORMAT, RUN_STATE_RUNNING
+from config import UPLOADS_DEFAULT_DEST, FLO2D_LIBS_DIR, MODEL_250M_TEMPLATE_DIR, RUN_QUEUE_FILE, RUN_SLOTS, \
+    RUN_SLOT_CPUS, RUN_REGISTRY_DB, RUN_DIR_LINK_MODE, TEMPLATE_SNAPSHOT_DIR, GRID_PROCESSES, GEOMETRY_CACHE_DIR, \
+    STREAM_ARCHIVES, ARCHIVE_CACHE, RESULT_CACHE_DIR, RESULT_CACHE_MEMORY_MB, RESULT_CACHE_DISK_MB, \
+    METRICS_LOCAL_ONLY, PROFILE_DIR, BATCH_WORKERS, BATCH_MAX_RUNS, GRID_CRS, GRID_STORE_CHUNKS, INPUT_STORE, \
+    INPUT_STORE_DIR, INPUT_STORE_UNUSED_DAYS, JOB_DIR, JOB_PROCESSES, JOB_MAX_AGE_HOURS, RUN_DIR_POOL_SIZE, \
+    RUN_DIR_POOL_DIR, PYTHON_EXECUTABLE
+from utils import is_valid_run_name, is_valid_init_dt, parse_run_id, prepare_flo2d_run, get_run_scheduler, \
+    RUN_PRIORITIES, prepare_flo2d_output, extract_water_levels, extract_water_discharge, \
+    prepare_flo2d_waterlevel_grid_asci, prepare_flo2d_run_config, is_output_ready, get_run_registry, get_run_sizes, \
+    stream_flo2d_output, stream_flo2d_waterlevel_grid_asci, extract_partial_water_levels, \
+    extract_partial_water_discharge, get_result_cache, start_trace, get_trace, end_trace, stage, format_stages, \
+    render_metrics, register_gauge, SampledProfiler, get_batch_executor, get_ensemble_statistics, \
+    stream_flo2d_waterlevel_envelope_asci, stream_flo2d_waterlevel_grid_store, get_run_date_times, get_time_window, \
+    iter_water_levels, iter_water_discharge, stream_ndjson_series, stream_columnar_series, NDJSON_MIMETYPE, \
+    COLUMNAR_MIMETYPE, get_region_cells, get_input_store, is_valid_digest, get_job_manager, JOB_TYPES, JOB_DONE, \
+    JOB_FAILED, get_run_dir_pool, prepare_flo2d_model_dir
+
+
+class Flo2dRequest(Request):
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Run input files are written straight into the input store and hashed on the way, instead of being spooled
+        # to a temporary file and copied afterwards.
+        if input_store is not None and self.endpoint == 'init_250m_run':
+            return input_store.new_upload()
+        return Request._get_file_stream(self, total_content_length, content_type, filename, content_length)
+
+
+# Worker processes are spawned from this interpreter instead of the executable hosting the app, set before any pool.
+if PYTHON_EXECUTABLE:
+    multiprocessing.set_executable(PYTHON_EXECUTABLE)
 
 app = Flask(__name__)
+app.request_class = Flo2dRequest
 flask_json = FlaskJSON()
 
 # Flask-Uploads configs
@@ -27,6 +58,80 @@ configure_uploads(app, model_250m)
 flask_json.init_app(app)
 
 
+def prepare_250m_run(run_path):
+    prepare_flo2d_run(run_path, MODEL_250M_TEMPLATE_DIR, FLO2D_LIBS_DIR,
+                      TEMPLATE_SNAPSHOT_DIR or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'template-snapshots'),
+                      RUN_DIR_LINK_MODE, run_dir_pool)
+
+
+def prepare_250m_model_dir(model_path):
+    prepare_flo2d_model_dir(model_path, MODEL_250M_TEMPLATE_DIR, FLO2D_LIBS_DIR,
+                            TEMPLATE_SNAPSHOT_DIR or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'template-snapshots'),
+                            RUN_DIR_LINK_MODE)
+
+
+run_dir_pool = get_run_dir_pool(RUN_DIR_POOL_DIR or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'run-dir-pool'),
+                                RUN_DIR_POOL_SIZE, [FLO2D_LIBS_DIR, MODEL_250M_TEMPLATE_DIR], prepare_250m_model_dir) \
+    if RUN_DIR_POOL_SIZE > 0 else None
+run_registry = get_run_registry(RUN_REGISTRY_DB or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'runs.db'))
+run_scheduler = get_run_scheduler(RUN_QUEUE_FILE or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'run-queue.json'),
+                                  RUN_SLOTS, RUN_SLOT_CPUS, prepare_250m_run, run_registry)
+geometry_dir = GEOMETRY_CACHE_DIR or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'geometry')
+input_store = get_input_store(INPUT_STORE_DIR or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'input-store'),
+                              INPUT_STORE_UNUSED_DAYS * 24 * 3600) if INPUT_STORE else None
+result_cache = get_result_cache(RESULT_CACHE_DIR or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'result-cache'),
+                                RESULT_CACHE_MEMORY_MB * 1024 * 1024, RESULT_CACHE_DISK_MB * 1024 * 1024)
+register_gauge('flo2d_result_cache_hits', 'Extraction result cache hits.',
+               lambda: result_cache.get_stats()['memory_hits'] + result_cache.get_stats()['disk_hits'])
+register_gauge('flo2d_result_cache_misses', 'Extraction result cache misses.',
+               lambda: result_cache.get_stats()['misses'])
+job_manager = get_job_manager(JOB_DIR or path.join(UPLOADS_DEFAULT_DEST, 'FLO2D', 'jobs'), JOB_PROCESSES,
+                              JOB_MAX_AGE_HOURS * 3600)
+register_gauge('flo2d_jobs_queued', 'Extraction jobs waiting for a process.',
+               lambda: job_manager.get_counts()['queued'])
+register_gauge('flo2d_jobs_running', 'Extraction jobs running.', lambda: job_manager.get_counts()['running'])
+if run_dir_pool is not None:
+    register_gauge('flo2d_run_dirs_ready', 'Prepared model directories ready for the next runs.',
+                   run_dir_pool.get_ready_count)
+
+
+@app.before_request
+def start_request_trace():
+    start_trace(request.endpoint or 'unknown')
+    if PROFILE_DIR and request.args.get('profile', '').lower() in ('true', '1'):
+        request.environ['flo2d.profiler'] = SampledProfiler(threading.get_ident())
+        request.environ['flo2d.profiler'].start()
+
+
+@app.after_request
+def end_request_trace(response):
+    profiler = request.environ.pop('flo2d.profiler', None)
+    profile_file = None
+    if profiler is not None:
+        profile_file = '%s-%s.folded' % (datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f'), request.endpoint)
+        response.headers['X-Profile'] = profile_file
+    if response.is_streamed:
+        # The body of a streamed response is generated after the headers are sent. The trace ends when the response
+        # is closed, so the stages of the body are in the metrics and the profile, while the Server-Timing header
+        # only has the stages done before the body.
+        if get_trace() is not None:
+            response.headers['Server-Timing'] = format_stages(get_trace())
+        status = response.status_code
+        response.call_on_close(lambda: _end_request_trace(status, profiler, profile_file))
+    else:
+        trace = _end_request_trace(response.status_code, profiler, profile_file)
+        if trace is not None:
+            response.headers['Server-Timing'] = format_stages(trace)
+    return response
+
+
+def _end_request_trace(status, profiler, profile_file):
+    trace = end_trace(status)
+    if profiler is not None:
+        profiler.stop(path.join(PROFILE_DIR, profile_file))
+    return trace
+
+
 @app.route('/')
 def hello_world():
     return 'Welcome to FLO2D Server!'
@@ -63,19 +168,37 @@ def init_250m_run():
     if path.exists(input_dir_abs_path):
         raise JsonError(status_=400, description='run-name: %s is already taken for today: %s.' % (run_name, today))
 
-    req_files = request.files
-    if 'inflow' in req_files and 'outflow' in req_files and 'raincell' in req_files:
-        model_250m.save(req_files['inflow'], folder=input_dir_rel_path, name='INFLOW.DAT')
-        model_250m.save(req_files['outflow'], folder=input_dir_rel_path, name='OUTFLOW.DAT')
-        model_250m.save(req_files['raincell'], folder=input_dir_rel_path, name='RAINCELL.DAT')
+    input_digests = {}
+    if input_store is not None:
+        input_digests = _store_input_files(req_args, request.files)
+        os.makedirs(input_dir_abs_path)
+        for file_name, digest in input_digests.items():
+            input_store.link_blob(digest, path.join(input_dir_abs_path, file_name))
     else:
-        raise JsonError(status_=400, description='Missing required input files. Required inflow, outflow, raincell.')
+        req_files = request.files
+        if 'inflow' in req_files and 'outflow' in req_files and 'raincell' in req_files:
+            model_250m.save(req_files['inflow'], folder=input_dir_rel_path, name='INFLOW.DAT')
+            model_250m.save(req_files['outflow'], folder=input_dir_rel_path, name='OUTFLOW.DAT')
+            model_250m.save(req_files['raincell'], folder=input_dir_rel_path, name='RAINCELL.DAT')
+        else:
+            raise JsonError(status_=400,
+                            description='Missing required input files. Required inflow, outflow, raincell.')
 
     # Save run configurations.
     prepare_flo2d_run_config(input_dir_abs_path, run_name, base_dt, run_dt)
 
-    run_id = 'FLO2D:model250m:%s:%s' % (today, run_name)  # TODO save run_id in a DB with the status
-    return json_response(status_=200, run_id=run_id, description='Successfully saved files.')
+    run_id = 'FLO2D:model250m:%s:%s' % (today, run_name)
+    run_path = path.join(UPLOADS_DEFAULT_DEST, parse_run_id(run_id))
+    run_registry.register_run(run_id, run_path, get_run_sizes(run_path)['input_size'])
+    return json_response(status_=200, run_id=run_id, inputs=input_digests, description='Successfully saved files.')
+
+
+@app.route('/FLO2D/250m/inputs/<digest>', methods=['GET'])
+def get_250m_input(digest):
+    # Lets the clients check whether an input file is already stored before uploading it.
+    if input_store is None or not input_store.has_blob(digest):
+        raise JsonError(status_=404, sha256=digest, description='Input file is not stored.')
+    return json_response(status_=200, sha256=digest, size=path.getsize(input_store.get_blob_path(digest)))
 
 
 @app.route('/FLO2D/250m/start-run', methods=['GET', 'POST'])
@@ -91,12 +214,37 @@ def start_250m_run():
     except:
         raise JsonError(status_=400, description='Error in the given run-id: %s' % run_id)
     run_path = path.join(UPLOADS_DEFAULT_DEST, rel_run_path)
+    if not path.exists(path.join(run_path, 'input')):
+        raise JsonError(status_=400, description='No inputs found for the given run-id: %s' % run_id)
+
+    # Operational forecasts go before reruns.
+    priority = req_args.get('priority', 'operational')
+    if priority not in RUN_PRIORITIES:
+        raise JsonError(status_=400, description='priority should be one of: %s' % ', '.join(RUN_PRIORITIES.keys()))
+
+    run = run_scheduler.enqueue(run_id, run_path, priority)
+    return json_response(status_=200, run_id=run_id, run_status=run['state'],
+                         queue_position=run_scheduler.get_queue_position(run_id),
+                         description='Successfully queued model run. This will take a while to complete.')
+
 
-    prepare_flo2d_run(run_path, MODEL_250M_TEMPLATE_DIR, FLO2D_LIBS_DIR)
-    run_flo2d_model(run_path)
-    # TODO update the run_id in the DB with the status
-    return json_response(status_=200, run_id=run_id, run_status='Started',
-                         description='Successfully started model run. This will take a while to complete.')
+@app.route('/FLO2D/250m/status', methods=['GET'])
+def get_250m_status():
+    req_args = request.args.to_dict()
+    # check whether run_id is specified and valid.
+    if 'run-id' not in req_args.keys() or not req_args['run-id']:
+        raise JsonError(status_=400, description='run-id is not specified')
+
+    run_id = req_args['run-id']
+    run = run_registry.get_run(run_id)
+    if run is None:
+        raise JsonError(status_=404, run_id=run_id, description='Unknown run-id: %s' % run_id)
+
+    return json_response(status_=200, run_id=run_id, run_status=run['state'], output_ready=bool(run['output_ready']),
+                         queue_position=run_scheduler.get_queue_position(run_id),
+                         created_at=run['created_at'], queued_at=run['queued_at'], started_at=run['started_at'],
+                         finished_at=run['finished_at'], input_size=run['input_size'],
+                         output_size=run['output_size'], artifacts_size=run['artifacts_size'])
 
 
 @app.route('/FLO2D/250m/get-output/output.zip', methods=['GET', 'POST'])
@@ -113,12 +261,16 @@ def get_250m_output():
         raise JsonError(status_=400, description='Error in the given run-id: %s' % run_id)
     run_path = path.join(UPLOADS_DEFAULT_DEST, rel_run_path)
 
-    # TODO check the DB for the status of run_id
-    # TODO if status is not finished prepare error response saying so.
-    if not is_output_ready(run_path):
-        raise JsonError(status_=503, run_id=run_id, run_status='Running', description='output is not ready yet.')
+    run = run_registry.get_run(run_id)
+    if not is_output_ready(run_path, run):
+        raise JsonError(status_=503, run_id=run_id, run_status=run['state'] if run else 'Running',
+                        description='output is not ready yet.')
+
+    if STREAM_ARCHIVES and not path.exists(path.join(run_path, 'output.zip')):
+        return _stream_archive(run_id, run_path, 'output.zip', stream_flo2d_output(run_path, ARCHIVE_CACHE))
 
     output_zip = prepare_flo2d_output(run_path)
+    run_registry.set_artifacts_size(run_id, get_run_sizes(run_path)['artifacts_size'])
     return send_from_directory(directory=run_path, filename=output_zip)
 
 
@@ -137,20 +289,87 @@ def extract_250m_waterlevel():
         raise JsonError(status_=400, description='Error in the given run-id: %s' % run_id)
     run_path = path.join(UPLOADS_DEFAULT_DEST, rel_run_path)
 
+    # The flood plain cells are either listed in FLOOD_PLAIN_CELL_MAP or selected with FLOOD_PLAIN_BBOX
+    # ([x min, y min, x max, y max]) or FLOOD_PLAIN_POLYGON ([[x, y], ...]) in the CADPTS.DAT coordinates.
     try:
         cell_map = request.get_json()
         channel_cell_map = cell_map['CHANNEL_CELL_MAP']
-        flood_plain_cell_map = cell_map['FLOOD_PLAIN_CELL_MAP']
+        if _is_region_requested(cell_map):
+            flood_plain_cell_map = cell_map.get('FLOOD_PLAIN_CELL_MAP') or {}
+        else:
+            flood_plain_cell_map = cell_map['FLOOD_PLAIN_CELL_MAP']
     except:
         raise JsonError(status_=400, description='Invalid cell map!')
 
-    # TODO check the DB for the status of run_id
-    # TODO if status is not finished prepare error response saying so.
-    if not is_output_ready(run_path):
-        raise JsonError(status_=503, run_id=run_id, run_status='Running', description='output is not ready yet.')
-
-    channel_tms, flood_plain_tms = extract_water_levels(run_path, channel_cell_map, flood_plain_cell_map)
-    return jsonify({'CHANNELS': channel_tms, 'FLOOD_PLAIN': flood_plain_tms})
+    run = run_registry.get_run(run_id)
+    if not is_output_ready(run_path, run):
+        if _is_partial_requested(req_args, run):
+            if _is_region_requested(cell_map):
+                flood_plain_cell_map = _get_region_cell_map(cell_map, path.join(run_path, 'model'),
+                                                            flood_plain_cell_map)
+            channel_tms, flood_plain_tms, progress = extract_partial_water_levels(
+                run_path, channel_cell_map, flood_plain_cell_map, _get_time_window(req_args, run_path))
+            return jsonify({'CHANNELS': channel_tms, 'FLOOD_PLAIN': flood_plain_tms, 'PARTIAL': True,
+                            'PROGRESS': progress})
+        raise JsonError(status_=503, run_id=run_id, run_status=run['state'] if run else 'Running',
+                        description='output is not ready yet.')
+
+    if _is_region_requested(cell_map):
+        flood_plain_cell_map = _get_region_cell_map(cell_map, path.join(run_path, 'output'), flood_plain_cell_map)
+    window = _get_time_window(req_args, run_path)
+    mimetype = _get_series_mimetype()
+    if mimetype != 'application/json':
+        return _stream_series(mimetype, iter_water_levels(run_path, channel_cell_map, flood_plain_cell_map, window,
+                                                          mimetype == COLUMNAR_MIMETYPE))
+
+    channel_tms, flood_plain_tms = result_cache.get_or_extract(
+        run_id, run_path, 'water-level', [channel_cell_map, flood_plain_cell_map],
+        lambda: extract_water_levels(run_path, channel_cell_map, flood_plain_cell_map, window),
+        window._asdict() if window else None)
+    with stage('serialize'):
+        return jsonify({'CHANNELS': channel_tms, 'FLOOD_PLAIN': flood_plain_tms})
+
+
+@app.route('/FLO2D/250m/extract/water-level/batch', methods=['POST'])
+@consumes('application/json')
+def extract_250m_waterlevel_batch():
+    try:
+        batch = request.get_json()
+        run_ids = list(dict.fromkeys(batch['RUN_IDS']))
+        channel_cell_map = batch['CHANNEL_CELL_MAP']
+        if _is_region_requested(batch):
+            flood_plain_cell_map = batch.get('FLOOD_PLAIN_CELL_MAP') or {}
+        else:
+            flood_plain_cell_map = batch['FLOOD_PLAIN_CELL_MAP']
+        percentiles = [float(percentile) for percentile in batch.get('PERCENTILES', [10, 50, 90])]
+    except:
+        raise JsonError(status_=400, description='Invalid batch! RUN_IDS, CHANNEL_CELL_MAP and FLOOD_PLAIN_CELL_MAP '
+                                                 'or a flood plain region are required.')
+    if not run_ids:
+        raise JsonError(status_=400, description='RUN_IDS is empty.')
+    if len(run_ids) > BATCH_MAX_RUNS:
+        raise JsonError(status_=400, description='At most %d runs are allowed in a batch.' % BATCH_MAX_RUNS)
+    if not all(0 <= percentile <= 100 for percentile in percentiles):
+        raise JsonError(status_=400, description='PERCENTILES must be within 0 and 100.')
+
+    # The runs are extracted in parallel, each run is served from the result cache when it was extracted before.
+    executor = get_batch_executor(BATCH_WORKERS)
+    req_args = request.args.to_dict()
+    with stage('extract_runs'):
+        results = list(executor.map(lambda run_id: _extract_batch_run(run_id, channel_cell_map, flood_plain_cell_map,
+                                                                      req_args, batch),
+                                    run_ids))
+    runs = dict(zip(run_ids, results))
+    response = {'RUNS': runs}
+
+    if batch.get('STATISTICS'):
+        extracted = [result for result in results if 'error' not in result]
+        response['STATISTICS'] = {
+            'CHANNELS': get_ensemble_statistics([result['CHANNELS'] for result in extracted], percentiles),
+            'FLOOD_PLAIN': get_ensemble_statistics([result['FLOOD_PLAIN'] for result in extracted], percentiles)
+        }
+    with stage('serialize'):
+        return jsonify(response)
 
 
 @app.route('/FLO2D/250m/extract/water-discharge', methods=['POST'])
@@ -174,13 +393,25 @@ def extract_250m_waterdischarge():
     except:
         raise JsonError(status_=400, description='Invalid cell map!')
 
-    # TODO check the DB for the status of run_id
-    # TODO if status is not finished prepare error response saying so.
-    if not is_output_ready(run_path):
-        raise JsonError(status_=503, run_id=run_id, run_status='Running', description='output is not ready yet.')
+    run = run_registry.get_run(run_id)
+    if not is_output_ready(run_path, run):
+        if _is_partial_requested(req_args, run):
+            channel_tms, progress = extract_partial_water_discharge(run_path, channel_cell_map,
+                                                                    _get_time_window(req_args, run_path))
+            return jsonify({'CHANNELS': channel_tms, 'PARTIAL': True, 'PROGRESS': progress})
+        raise JsonError(status_=503, run_id=run_id, run_status=run['state'] if run else 'Running',
+                        description='output is not ready yet.')
 
-    channel_tms = extract_water_discharge(run_path, channel_cell_map)
-    return jsonify({'CHANNELS': channel_tms})
+    window = _get_time_window(req_args, run_path)
+    mimetype = _get_series_mimetype()
+    if mimetype != 'application/json':
+        return _stream_series(mimetype, iter_water_discharge(run_path, channel_cell_map, window))
+
+    channel_tms = result_cache.get_or_extract(run_id, run_path, 'water-discharge', channel_cell_map,
+                                              lambda: extract_water_discharge(run_path, channel_cell_map, window),
+                                              window._asdict() if window else None)
+    with stage('serialize'):
+        return jsonify({'CHANNELS': channel_tms})
 
 
 @app.route('/FLO2D/250m/extract/water-level-grid.zip', methods=['GET', 'POST'])
@@ -197,14 +428,278 @@ def extract_250m_waterlevelgrid():
         raise JsonError(status_=400, description='Error in the given run-id: %s' % run_id)
     run_path = path.join(UPLOADS_DEFAULT_DEST, rel_run_path)
 
-    # TODO check the DB for the status of run_id
-    # TODO if status is not finished prepare error response saying so.
-    if not is_output_ready(run_path):
-        raise JsonError(status_=503, run_id=run_id, run_status='Running', description='output is not ready yet.')
-
-    asci_grid_zip = prepare_flo2d_waterlevel_grid_asci(run_path, 250.0)
+    # asc: a zip of Esri grids, one per timestep. zarr: one chunked and compressed time x rows x cols array.
+    grid_format = req_args.get('format', 'asc')
+    if grid_format not in ['asc', 'zarr']:
+        raise JsonError(status_=400, description='format should be one of asc, zarr.')
+
+    run = run_registry.get_run(run_id)
+    if not is_output_ready(run_path, run):
+        raise JsonError(status_=503, run_id=run_id, run_status=run['state'] if run else 'Running',
+                        description='output is not ready yet.')
+
+    # Grids of a time window are always streamed, only the grids of the whole run are kept in the run directory.
+    window = _get_time_window(req_args, run_path)
+    if grid_format == 'zarr':
+        if window is None and path.exists(path.join(run_path, 'water_level_grid.zarr.zip')):
+            return send_from_directory(directory=run_path, filename='water_level_grid.zarr.zip')
+        chunks = stream_flo2d_waterlevel_grid_store(run_path, 250.0, geometry_dir, GRID_STORE_CHUNKS, GRID_CRS,
+                                                    ARCHIVE_CACHE, window)
+        return _stream_archive(run_id, run_path, 'water_level_grid.zarr.zip', chunks)
+
+    if window is not None:
+        chunks = stream_flo2d_waterlevel_grid_asci(run_path, 250.0, GRID_PROCESSES, geometry_dir, False, window)
+        return _stream_archive(run_id, run_path, 'asci_grid.zip', chunks)
+
+    if STREAM_ARCHIVES and not path.exists(path.join(run_path, 'asci_grid.zip')):
+        chunks = stream_flo2d_waterlevel_grid_asci(run_path, 250.0, GRID_PROCESSES, geometry_dir, ARCHIVE_CACHE)
+        return _stream_archive(run_id, run_path, 'asci_grid.zip', chunks)
+
+    asci_grid_zip = prepare_flo2d_waterlevel_grid_asci(run_path, 250.0, GRID_PROCESSES, geometry_dir)
+    run_registry.set_artifacts_size(run_id, get_run_sizes(run_path)['artifacts_size'])
     return send_from_directory(directory=run_path, filename=asci_grid_zip)
 
 
+@app.route('/FLO2D/250m/extract/water-level-envelope.zip', methods=['GET', 'POST'])
+def extract_250m_waterlevelenvelope():
+    req_args = request.args.to_dict()
+    # check whether run_id is specified and valid.
+    if 'run-id' not in req_args.keys() or not req_args['run-id']:
+        raise JsonError(status_=400, description='run-id is not specified')
+
+    run_id = req_args['run-id']
+    try:
+        rel_run_path = parse_run_id(run_id)
+    except:
+        raise JsonError(status_=400, description='Error in the given run-id: %s' % run_id)
+    run_path = path.join(UPLOADS_DEFAULT_DEST, rel_run_path)
+
+    try:
+        depth_threshold = float(req_args.get('threshold', 0.3))
+    except ValueError:
+        raise JsonError(status_=400, description='threshold should be a number.')
+
+    run = run_registry.get_run(run_id)
+    if not is_output_ready(run_path, run):
+        raise JsonError(status_=503, run_id=run_id, run_status=run['state'] if run else 'Running',
+                        description='output is not ready yet.')
+
+    chunks = stream_flo2d_waterlevel_envelope_asci(run_path, 250.0, depth_threshold, geometry_dir,
+                                                   _get_time_window(req_args, run_path))
+    return Response(chunks, mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=water_level_envelope.zip'})
+
+
+@app.route('/FLO2D/250m/jobs/<job_type>', methods=['POST'])
+def submit_250m_job(job_type):
+    # Takes the same parameters as the matching extract endpoint, water-level-grid-store is water-level-grid.zip with
+    # format=zarr. Returns the job straight away, the client polls the job and downloads the result once it is done.
+    if job_type not in JOB_TYPES:
+        raise JsonError(status_=404, description='Job type should be one of %s.' % ', '.join(sorted(JOB_TYPES)))
+    req_args = request.args.to_dict()
+    # check whether run_id is specified and valid.
+    if 'run-id' not in req_args.keys() or not req_args['run-id']:
+        raise JsonError(status_=400, description='run-id is not specified')
+
+    run_id = req_args['run-id']
+    try:
+        rel_run_path = parse_run_id(run_id)
+    except:
+        raise JsonError(status_=400, description='Error in the given run-id: %s' % run_id)
+    run_path = path.join(UPLOADS_DEFAULT_DEST, rel_run_path)
+
+    run = run_registry.get_run(run_id)
+    if not is_output_ready(run_path, run):
+        raise JsonError(status_=503, run_id=run_id, run_status=run['state'] if run else 'Running',
+                        description='output is not ready yet.')
+
+    window = _get_time_window(req_args, run_path)
+    params = {'window': window._asdict() if window else None}
+    if job_type in ['water-level', 'water-discharge']:
+        try:
+            cell_map = request.get_json(force=True)
+            params['channel_cell_map'] = cell_map['CHANNEL_CELL_MAP']
+            if job_type == 'water-level':
+                if _is_region_requested(cell_map):
+                    params['flood_plain_cell_map'] = _get_region_cell_map(
+                        cell_map, path.join(run_path, 'output'), cell_map.get('FLOOD_PLAIN_CELL_MAP') or {})
+                else:
+                    params['flood_plain_cell_map'] = cell_map['FLOOD_PLAIN_CELL_MAP']
+        except JsonError:
+            raise
+        except:
+            raise JsonError(status_=400, description='Invalid cell map!')
+    elif job_type == 'water-level-grid':
+        params.update(grid_size=250.0, geometry_dir=geometry_dir)
+    elif job_type == 'water-level-grid-store':
+        params.update(grid_size=250.0, geometry_dir=geometry_dir, chunks=GRID_STORE_CHUNKS, crs=GRID_CRS)
+    else:
+        try:
+            params.update(grid_size=250.0, depth_threshold=float(req_args.get('threshold', 0.3)),
+                          geometry_dir=geometry_dir)
+        except ValueError:
+            raise JsonError(status_=400, description='threshold should be a number.')
+
+    job = job_manager.submit(job_type, run_id, run_path, params)
+    return json_response(status_=202, **job)
+
+
+@app.route('/FLO2D/250m/jobs/<job_id>', methods=['GET'])
+def get_250m_job(job_id):
+    job = job_manager.get_job(job_id)
+    if job is None:
+        raise JsonError(status_=404, job_id=job_id, description='Job is not known or has expired.')
+    return json_response(status_=200, **job)
+
+
+@app.route('/FLO2D/250m/jobs/<job_id>/result', methods=['GET'])
+def get_250m_job_result(job_id):
+    job = job_manager.get_job(job_id)
+    if job is None:
+        raise JsonError(status_=404, job_id=job_id, description='Job is not known or has expired.')
+    if job['state'] == JOB_FAILED:
+        raise JsonError(status_=500, job_id=job_id, error=job['error'], description='Job failed.')
+    result_path = job_manager.get_result_path(job_id)
+    if job['state'] != JOB_DONE or result_path is None:
+        raise JsonError(status_=503, job_id=job_id, state=job['state'], description='Job is not done yet.')
+    mimetype = 'application/json' if job['file_name'].endswith('.json') else 'application/zip'
+    return send_from_directory(directory=path.dirname(result_path), filename=path.basename(result_path),
+                               mimetype=mimetype, as_attachment=True, attachment_filename=job['file_name'])
+
+
+@app.route('/FLO2D/250m/extract/cache-stats', methods=['GET'])
+def get_250m_extract_cache_stats():
+    return jsonify(result_cache.get_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if METRICS_LOCAL_ONLY and request.remote_addr not in ('127.0.0.1', '::1'):
+        raise JsonError(status_=403, description='metrics are only served to the local host.')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def _extract_batch_run(run_id, channel_cell_map, flood_plain_cell_map, req_args, batch):
+    start_trace('extract_batch_run')
+    try:
+        try:
+            rel_run_path = parse_run_id(run_id)
+        except:
+            return {'error': 'Error in the given run-id: %s' % run_id}
+        run_path = path.join(UPLOADS_DEFAULT_DEST, rel_run_path)
+
+        run = run_registry.get_run(run_id)
+        if not is_output_ready(run_path, run):
+            return {'error': 'output is not ready yet.', 'run_status': run['state'] if run else 'Running'}
+
+        # The time window and the cells of the region are worked out for each run, the runs of a batch may have
+        # different base times and models.
+        try:
+            window = _get_time_window(req_args, run_path)
+        except JsonError as e:
+            return {'error': e.data.get('description', 'Invalid time window.')}
+        if _is_region_requested(batch):
+            try:
+                flood_plain_cell_map = _get_region_cell_map(batch, path.join(run_path, 'output'),
+                                                            flood_plain_cell_map)
+            except JsonError as e:
+                return {'error': e.data.get('description', 'Invalid region.')}
+        channel_tms, flood_plain_tms = result_cache.get_or_extract(
+            run_id, run_path, 'water-level', [channel_cell_map, flood_plain_cell_map],
+            lambda: extract_water_levels(run_path, channel_cell_map, flood_plain_cell_map, window),
+            window._asdict() if window else None)
+        return {'CHANNELS': channel_tms, 'FLOOD_PLAIN': flood_plain_tms}
+    except Exception as e:
+        print('Error: Batch extraction. ' + run_id, e)
+        return {'error': 'Extraction failed.'}
+    finally:
+        end_trace()
+
+
+def _store_input_files(req_args, req_files):
+    # Each input is either uploaded, or given by the SHA-256 of an earlier upload with <input>-sha256 in which case
+    # the request does not need to carry the file.
+    input_digests = {}
+    for input_name, file_name in [('inflow', 'INFLOW.DAT'), ('outflow', 'OUTFLOW.DAT'), ('raincell', 'RAINCELL.DAT')]:
+        digest = req_args.get('%s-sha256' % input_name)
+        if digest and not is_valid_digest(digest.lower()):
+            raise JsonError(status_=400, description='%s-sha256 is not a SHA-256 hex digest.' % input_name)
+        digest = digest.lower() if digest else None
+        if input_name in req_files:
+            try:
+                input_digests[file_name] = input_store.save(req_files[input_name].stream, digest)
+            except ValueError as e:
+                raise JsonError(status_=400, description='%s: %s' % (input_name, e))
+        elif digest and input_store.has_blob(digest):
+            input_digests[file_name] = digest
+        else:
+            raise JsonError(status_=400, description='Missing required input files. Required inflow, outflow, '
+                                                     'raincell, either uploaded or as inflow-sha256, outflow-sha256, '
+                                                     'raincell-sha256 of files uploaded before.')
+    return input_digests
+
+
+def _get_time_window(req_args, run_path):
+    # start, end and every of the extract endpoints. They are pushed down into the output readers so the timesteps
+    # outside the window are not read.
+    if not any(req_args.get(name) for name in ['start', 'end', 'every']):
+        return None
+    base_dt, run_dt = get_run_date_times(run_path)
+    try:
+        return get_time_window(base_dt, req_args.get('start'), req_args.get('end'), req_args.get('every'))
+    except ValueError as e:
+        raise JsonError(status_=400, description='Invalid time window. start and end should be '
+                                                 '"yyyy-mm-dd HH:MM:SS" and every a positive integer. %s' % e)
+
+
+def _is_region_requested(cell_map):
+    return isinstance(cell_map, dict) and ('FLOOD_PLAIN_BBOX' in cell_map or 'FLOOD_PLAIN_POLYGON' in cell_map)
+
+
+def _get_region_cell_map(cell_map, output_dir, flood_plain_cell_map):
+    # The cells of the region are named by their element numbers, the cells listed in FLOOD_PLAIN_CELL_MAP keep their
+    # names.
+    cad_pts_file_path = path.join(output_dir, 'CADPTS.DAT')
+    if not path.exists(cad_pts_file_path):
+        raise JsonError(status_=503, description='CADPTS.DAT of the run is not available yet.')
+    try:
+        elements = get_region_cells(cad_pts_file_path, 250.0, geometry_dir, cell_map.get('FLOOD_PLAIN_BBOX'),
+                                    cell_map.get('FLOOD_PLAIN_POLYGON'))
+    except ValueError as e:
+        raise JsonError(status_=400, description='Invalid region. %s' % e)
+    region_cell_map = {elementNo: elementNo for elementNo in elements}
+    region_cell_map.update(flood_plain_cell_map)
+    return region_cell_map
+
+
+def _get_series_mimetype():
+    # Extract responses are JSON unless the client asks for one of the streamed formats.
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE, COLUMNAR_MIMETYPE],
+                                               default='application/json')
+
+
+def _stream_series(mimetype, groups):
+    # The series are sent while they are extracted, they are not kept in the result cache.
+    chunks = stream_ndjson_series(groups) if mimetype == NDJSON_MIMETYPE else stream_columnar_series(groups)
+    return Response(chunks, mimetype=mimetype)
+
+
+def _is_partial_requested(req_args, run):
+    # Partial results are read from the model directory, only while FLOPRO is running.
+    return req_args.get('partial', '').lower() in ('true', '1') and run is not None and \
+        run['state'] == RUN_STATE_RUNNING
+
+
+def _stream_archive(run_id, run_path, file_name, chunks):
+    def generate():
+        for chunk in chunks:
+            yield chunk
+        # The streamed archive is cached in the run directory once it is complete.
+        run_registry.set_artifacts_size(run_id, get_run_sizes(run_path)['artifacts_size'])
+
+    return Response(generate(), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=%s' % file_name})
+
+
 if __name__ == '__main__':
     app.run()
@@ -1,8 +1,21 @@
 from .validator import is_valid_run_name, is_valid_init_dt, is_output_ready
 from .parser import parse_run_id
 from .preparator import prepare_flo2d_run, prepare_flo2d_output, prepare_flo2d_waterlevel_grid_asci, \
-    prepare_flo2d_run_config
-from .runner import run_flo2d_model
-from .extractor import extract_water_levels, extract_water_discharge
-from .asci_extractor import extract_water_level_grid
-from .general import get_run_date_times
+    prepare_flo2d_run_config, stream_flo2d_output, stream_flo2d_waterlevel_grid_asci, \
+    stream_flo2d_waterlevel_envelope_asci, stream_flo2d_waterlevel_grid_store, prepare_flo2d_model_dir
+from .scheduler import get_run_scheduler, RUN_PRIORITIES
+from .registry import get_run_registry
+from .result_cache import get_result_cache
+from .ensemble import get_batch_executor, get_ensemble_statistics
+from .metrics import start_trace, get_trace, end_trace, stage, format_stages, render_metrics, register_gauge, \
+    SampledProfiler
+from .extractor import extract_water_levels, extract_water_discharge, extract_partial_water_levels, \
+    extract_partial_water_discharge, iter_water_levels, iter_water_discharge
+from .serializer import stream_ndjson_series, stream_columnar_series, NDJSON_MIMETYPE, COLUMNAR_MIMETYPE
+from .asci_extractor import extract_water_level_grid, extract_water_level_envelopes, iter_water_level_grid_store
+from .general import get_run_date_times, get_run_sizes
+from .window import get_time_window
+from .spatial import get_region_cells
+from .input_store import get_input_store, is_valid_digest
+from .jobs import get_job_manager, JOB_TYPES, JOB_DONE, JOB_FAILED
+from .run_dir_pool import get_run_dir_pool
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+import zipfile
+
+from os import path
+
+from .metrics import stage, count
+
+# Compressed bytes are handed to the client once this much is buffered.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def stream_zip(entries, cache_file_path=None, compression=zipfile.ZIP_DEFLATED):
+    """
+    Build a zip archive on the fly. Entries are compressed as they are produced and the archive is yielded in chunks,
+    so nothing has to be written to disk before the first byte is sent.
+    :param entries: iterable of (str, str|bytes), (name in the archive, file path) to add a file or
+    (name in the archive, bytes) to add generated content
+    :param cache_file_path: str, path to keep a copy of the archive at, optional. The copy is only kept when the
+    whole archive was streamed.
+    :param compression: int, zipfile.ZIP_DEFLATED, or zipfile.ZIP_STORED for entries which are already compressed
+    :return: generator of bytes
+    """
+    stream = _ZipStream(cache_file_path)
+    completed = False
+    try:
+        with zipfile.ZipFile(stream, 'w', compression, allowZip64=True) as archive:
+            for name, source in entries:
+                if isinstance(source, bytes):
+                    info = zipfile.ZipInfo(name, time.localtime()[:6])
+                    info.compress_type = compression
+                    info.external_attr = 0o644 << 16
+                    with stage('archive_compress'):
+                        archive.writestr(info, source)
+                    for chunk in stream.drain():
+                        yield chunk
+                    continue
+                # Large files are compressed block by block, so they are never held in memory as a whole.
+                info = zipfile.ZipInfo.from_file(source, name)
+                info.compress_type = compression
+                with open(source, 'rb') as src_file, archive.open(info, 'w', force_zip64=True) as dst_file:
+                    for block in iter(lambda: src_file.read(STREAM_CHUNK_SIZE), b''):
+                        with stage('archive_compress'):
+                            dst_file.write(block)
+                        for chunk in stream.drain():
+                            yield chunk
+                for chunk in stream.drain():
+                    yield chunk
+        for chunk in stream.drain(final=True):
+            yield chunk
+        completed = True
+    finally:
+        stream.close(completed)
+        if hasattr(entries, 'close'):
+            # Stops the producer of the entries (e.g. a grid rendering pool) when the client goes away.
+            entries.close()
+
+
+def get_dir_entries(dir_path):
+    """
+    :param dir_path: str, directory to archive
+    :return: list of (str, str), (name in the archive, file path) of the files under the directory
+    """
+    entries = []
+    for root, dirs, files in os.walk(dir_path):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = path.join(root, file_name)
+            entries.append((path.relpath(file_path, dir_path).replace(os.sep, '/'), file_path))
+    return entries
+
+
+class _ZipStream:
+    """
+    Write only file object for zipfile. Written bytes are buffered until they are drained, and copied to the cache
+    file if one is given.
+    """
+
+    def __init__(self, cache_file_path=None):
+        self.buffer = []
+        self.size = 0
+        self.position = 0
+        self.cache_file_path = cache_file_path
+        self.cache_file = None
+        if cache_file_path:
+            self.tmp_cache_file_path = '%s.%d.%d.tmp' % (cache_file_path, os.getpid(), threading.get_ident())
+            try:
+                self.cache_file = open(self.tmp_cache_file_path, 'wb')
+            except (IOError, OSError) as e:
+                print('Warning: Unable to cache the archive. ' + cache_file_path, e)
+
+    def write(self, data):
+        data = bytes(data)
+        self.buffer.append(data)
+        self.size += len(data)
+        self.position += len(data)
+        if self.cache_file is not None:
+            self.cache_file.write(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self, final=False):
+        if self.size < STREAM_CHUNK_SIZE and not (final and self.size):
+            return []
+        chunk = b''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        count('bytes_archived', len(chunk))
+        return [chunk]
+
+    def close(self, completed=False):
+        if self.cache_file is None:
+            return
+        self.cache_file.close()
+        self.cache_file = None
+        if completed:
+            os.replace(self.tmp_cache_file_path, self.cache_file_path)
+        else:
+            # The client went away before the end, the partial archive is of no use.
+            os.remove(self.tmp_cache_file_path)
@@ -1,65 +1,371 @@
-import math
-import numbers
+import json
+import zlib
 
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
 from os import path
 from datetime import timedelta
 
+import numpy as np
 
-def extract_water_level_grid(run_path, grid_size, base_date_time, run_date_time, out_dir):
+from .geometry import get_grid_geometry, get_grid_dimensions
+from .metrics import stage, count
+from .output_cache import load_output_cache
+from .timdep import read_timdep, read_timdep_window
+from .window import TimeWindow, get_window_steps
+
+# Number of timesteps rendered by a worker process at once.
+GRID_CHUNK_SIZE = 8
+# Chunks of timesteps handed to the worker processes ahead of the one being consumed, per process.
+GRID_CHUNKS_AHEAD = 2
+# Default (time, rows, cols) chunk shape of the chunked water level grid store.
+GRID_STORE_CHUNKS = (8, 256, 256)
+GRID_STORE_COMPRESSION_LEVEL = 5
+
+# Grid geometry and output settings of a grid worker process, set by _init_grid_worker.
+_grid_worker_args = None
+
+
+def extract_water_level_grid(run_path, grid_size, base_date_time, run_date_time, out_dir, processes=1,
+                             geometry_dir=None, window=None):
+    WATER_LEVEL_DEPTH_MIN = 0.3
+    timeSteps, boundary, CellGrid = _get_grid_sources(run_path, grid_size, geometry_dir,
+                                                      _get_grid_window(base_date_time, run_date_time, window))
+    gridSteps = _get_grid_steps(timeSteps, base_date_time, run_date_time)
+    grid_args = (boundary, CellGrid, WATER_LEVEL_DEPTH_MIN, grid_size, out_dir)
+
+    if processes > 1:
+        # Each worker renders and writes the grids of a chunk of timesteps.
+        pool = Pool(processes, initializer=_init_grid_worker, initargs=grid_args)
+        try:
+            chunks = iter(lambda: list(islice(gridSteps, GRID_CHUNK_SIZE)), [])
+            with stage('grid_render'):
+                for fileNames in _imap_bounded(pool, _write_esri_grids, chunks, processes * GRID_CHUNKS_AHEAD):
+                    for fileName in fileNames:
+                        print('Prepared: ', fileName)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for fileName, elements, depths in gridSteps:
+            _write_esri_grid(fileName, elements, depths, *grid_args)
+            print('Prepared: ', fileName)
+    return True
+
+
+def iter_water_level_grids(run_path, grid_size, base_date_time, run_date_time, processes=1, geometry_dir=None,
+                           window=None):
+    """
+    Render the water level grids one timestep at a time, in model time order.
+    :return: generator of (str, str), (file name, Esri grid)
+    """
+    WATER_LEVEL_DEPTH_MIN = 0.3
+    timeSteps, boundary, CellGrid = _get_grid_sources(run_path, grid_size, geometry_dir,
+                                                      _get_grid_window(base_date_time, run_date_time, window))
+    gridSteps = _get_grid_steps(timeSteps, base_date_time, run_date_time)
+    grid_args = (boundary, CellGrid, WATER_LEVEL_DEPTH_MIN, grid_size, None)
+
+    if processes > 1:
+        pool = Pool(processes, initializer=_init_grid_worker, initargs=grid_args)
+        try:
+            # A few chunks are rendered ahead by the workers while the earlier ones are consumed, the timesteps are
+            # only read when a chunk is handed out so a slow consumer holds back the reading and the rendering.
+            chunks = iter(lambda: list(islice(gridSteps, GRID_CHUNK_SIZE)), [])
+            for grids in _imap_bounded(pool, _render_esri_grids, chunks, processes * GRID_CHUNKS_AHEAD):
+                for grid in grids:
+                    yield grid
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for fileName, elements, depths in gridSteps:
+            EsriGrid = _get_esri_grid(elements, depths, boundary, CellGrid, WATER_LEVEL_DEPTH_MIN, gap=grid_size)
+            yield fileName, ''.join(EsriGrid)
+
+
+def iter_water_level_grid_store(run_path, grid_size, base_date_time, run_date_time, geometry_dir=None,
+                                chunks=GRID_STORE_CHUNKS, crs=None, window=None):
+    """
+    Write the water level grids of a run as one chunked, compressed time x rows x cols array. The store follows the
+    Zarr v2 layout (zlib compressed chunks, xarray dimension names and CF time units), so it can be read from the zip
+    with zarr or xarray without unpacking. Only one time chunk of grids is held in memory.
+    Depths below the minimum water level depth and cells outside the model are NaN, same as the missing values of the
+    Esri grids.
+    :param run_path: str, absolute path to the run resources and configs
+    :param grid_size: float, size of a grid cell
+    :param base_date_time: datetime, model start time
+    :param run_date_time: datetime, time of the run, earlier timesteps are left out
+    :param geometry_dir: str, directory of the shared grid geometries, optional
+    :param chunks: tuple of int, (time, rows, cols) shape of a chunk
+    :param crs: str, coordinate reference system of the CADPTS.DAT coordinates e.g. 'EPSG:5235', optional
+    :param window: TimeWindow, timesteps to write, every timestep from the run date time if not given
+    :return: generator of (str, bytes), (key in the store, content)
+    """
+    WATER_LEVEL_DEPTH_MIN = 0.3
+    timeSteps, boundary, CellGrid = _get_grid_sources(run_path, grid_size, geometry_dir,
+                                                      _get_grid_window(base_date_time, run_date_time, window))
+    cols, rows = get_grid_dimensions(boundary, grid_size)
+    chunkSteps, chunkRows, chunkCols = chunks
+    modelTimes = []
+    # Grids of the time chunk being filled, padded to whole chunks with the fill value.
+    Block = np.full((chunkSteps, -(-rows // chunkRows) * chunkRows, -(-cols // chunkCols) * chunkCols), np.nan,
+                    dtype='<f4')
+
+    for ModelTime, elements, depths in timeSteps:
+        if base_date_time + timedelta(hours=ModelTime) < run_date_time:
+            continue
+        index = len(modelTimes) % chunkSteps
+        with stage('grid_render'):
+            i, j, is_mapped = _get_raster_index(elements, CellGrid)
+            mask = is_mapped & (depths >= WATER_LEVEL_DEPTH_MIN) & (i < cols) & (j < rows)
+            Block[index].fill(np.nan)
+            Block[index, j[mask], i[mask]] = depths[mask]
+        modelTimes.append(ModelTime)
+        count('cells_emitted', rows * cols)
+        if index == chunkSteps - 1:
+            for entry in _get_store_chunks(Block, len(modelTimes) // chunkSteps - 1, chunkRows, chunkCols):
+                yield entry
+    if len(modelTimes) % chunkSteps:
+        Block[len(modelTimes) % chunkSteps:] = np.nan
+        for entry in _get_store_chunks(Block, len(modelTimes) // chunkSteps, chunkRows, chunkCols):
+            yield entry
+
+    # Metadata goes last, the number of timesteps is only known at the end.
+    time_units = 'hours since %s' % base_date_time.strftime('%Y-%m-%d %H:%M:%S')
+    x = boundary['long_min'] + grid_size * np.arange(cols)
+    y = boundary['lat_min'] + grid_size * (rows - 1 - np.arange(rows))
+    attributes = {
+        'title': 'FLO2D water level grids',
+        'run_date_time': run_date_time.strftime('%Y-%m-%d %H:%M:%S'),
+        'cellsize': grid_size
+    }
+    if crs:
+        attributes['crs'] = crs
+    yield '.zgroup', _to_json({'zarr_format': 2})
+    yield '.zattrs', _to_json(attributes)
+    for name, values, dimensions, array_chunks, array_attributes in [
+        ('depth', None, ['time', 'y', 'x'], list(chunks), {'units': 'm', 'long_name': 'water level depth'}),
+        ('time', np.array(modelTimes, dtype='<f8'), ['time'], [max(len(modelTimes), 1)],
+         {'units': time_units, 'calendar': 'standard', 'standard_name': 'time'}),
+        ('y', y.astype('<f8'), ['y'], [max(rows, 1)], {'units': 'm', 'long_name': 'northing of the cell centre'}),
+        ('x', x.astype('<f8'), ['x'], [max(cols, 1)], {'units': 'm', 'long_name': 'easting of the cell centre'})
+    ]:
+        shape = [len(modelTimes), rows, cols] if values is None else [len(values)]
+        array_attributes['_ARRAY_DIMENSIONS'] = dimensions
+        if crs and name != 'time':
+            array_attributes['crs'] = crs
+        yield '%s/.zarray' % name, _to_json({
+            'zarr_format': 2,
+            'shape': shape,
+            'chunks': array_chunks,
+            'dtype': '<f4' if values is None else '<f8',
+            'compressor': {'id': 'zlib', 'level': GRID_STORE_COMPRESSION_LEVEL},
+            'fill_value': 'NaN',
+            'order': 'C',
+            'filters': None,
+            'dimension_separator': '.'
+        })
+        yield '%s/.zattrs' % name, _to_json(array_attributes)
+        if values is not None and len(values):
+            yield '%s/0' % name, zlib.compress(values.tobytes(), GRID_STORE_COMPRESSION_LEVEL)
+
+
+def _get_store_chunks(Block, timeChunk, chunkRows, chunkCols):
+    with stage('grid_compress'):
+        entries = []
+        for rowChunk in range(Block.shape[1] // chunkRows):
+            for colChunk in range(Block.shape[2] // chunkCols):
+                Chunk = Block[:, rowChunk * chunkRows:(rowChunk + 1) * chunkRows,
+                              colChunk * chunkCols:(colChunk + 1) * chunkCols]
+                if np.isnan(Chunk).all():
+                    # Chunks of only the fill value are not stored.
+                    continue
+                entries.append(('depth/%d.%d.%d' % (timeChunk, rowChunk, colChunk),
+                                zlib.compress(np.ascontiguousarray(Chunk).tobytes(), GRID_STORE_COMPRESSION_LEVEL)))
+    return entries
+
+
+def _to_json(value):
+    return json.dumps(value, indent=2, sort_keys=True).encode('utf-8')
+
+
+def extract_water_level_envelopes(run_path, grid_size, base_date_time, run_date_time, depth_threshold=0.3,
+                                  geometry_dir=None, window=None):
+    """
+    Reduce the timesteps of a run into flood hazard rasters in one pass over TIMDEP.OUT. Only one array per statistic
+    is kept in memory. Timesteps before the run date time are left out, same as for the water level grids.
+    :param run_path: str, absolute path to the run resources and configs
+    :param grid_size: float, size of a grid cell
+    :param base_date_time: datetime, model start time
+    :param run_date_time: datetime, time of the run
+    :param depth_threshold: float, depth a cell is counted as flooded at
+    :param geometry_dir: str, directory of the shared grid geometries, optional
+    :param window: TimeWindow, timesteps to reduce, every timestep from the run date time if not given
+    :return: list of (str, str), (file name, Esri grid) of
+        max_depth: maximum flood depth, missing where it stays below the threshold
+        time_of_max_depth: model time in hours when the maximum depth is first reached, missing where the maximum
+            depth is below the threshold
+        duration_above_threshold: hours the depth stays at or above the threshold. The time since the previous
+            timestep is counted for each timestep at or above the threshold.
+    """
+    timeSteps, boundary, CellGrid = _get_grid_sources(run_path, grid_size, geometry_dir,
+                                                      _get_grid_window(base_date_time, run_date_time, window))
+    cols, rows = get_grid_dimensions(boundary, grid_size)
+    maxDepth = np.full((rows, cols), -np.inf)
+    timeOfMax = np.full((rows, cols), np.nan)
+    duration = np.zeros((rows, cols))
+    isInGrid = np.zeros((rows, cols), dtype=bool)
+    previousTime = None
+
+    with stage('grid_reduce'):
+        for ModelTime, elements, depths in timeSteps:
+            if base_date_time + timedelta(hours=ModelTime) < run_date_time:
+                continue
+            i, j, is_mapped = _get_raster_index(elements, CellGrid)
+            mask = is_mapped & (i < cols) & (j < rows)
+            cells, stepMax = _get_cell_maxima(j[mask] * cols + i[mask], depths[mask])
+            # The statistics are updated in place at the cells of the timestep, through flat views of the rasters.
+            isInGrid.reshape(-1)[cells] = True
+            isDeeper = stepMax > maxDepth.reshape(-1)[cells]
+            maxDepth.reshape(-1)[cells[isDeeper]] = stepMax[isDeeper]
+            timeOfMax.reshape(-1)[cells[isDeeper]] = ModelTime
+            if previousTime is not None:
+                duration.reshape(-1)[cells[stepMax >= depth_threshold]] += ModelTime - previousTime
+            previousTime = ModelTime
+
+    isFlooded = maxDepth >= depth_threshold
+    envelopes = [
+        ('max_depth.asc', np.where(isFlooded, maxDepth, np.nan)),
+        ('time_of_max_depth.asc', np.where(isFlooded, timeOfMax, np.nan)),
+        ('duration_above_threshold.asc', np.where(isInGrid, duration, np.nan))
+    ]
+    return [(fileName, ''.join(_get_esri_raster(Raster, boundary, gap=grid_size))) for fileName, Raster in envelopes]
+
+
+def _get_cell_maxima(cells, depths):
+    """
+    A cell repeated within a timestep keeps its deepest value, same as a cell of a later timestep.
+    :param cells: numpy array of int, flat raster index of each element of a timestep
+    :param depths: numpy array of float, depth of each element
+    :return: (numpy array of int, numpy array of float), the distinct cells and their maximum depth
+    """
+    if not len(cells):
+        return cells, depths
+    order = np.lexsort((depths, cells))
+    cells, depths = cells[order], depths[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    return cells[starts], np.maximum.reduceat(depths, starts)
+
+
+def _get_grid_window(base_date_time, run_date_time, window):
+    # Timesteps before the run date time are never written, they are left out of the window so they are not read.
+    run_time = (run_date_time - base_date_time).total_seconds() / 3600.0
+    if window is None:
+        return TimeWindow(run_time, None, 1)
+    return TimeWindow(run_time if window.start is None else max(window.start, run_time), window.end, window.every)
+
+
+def _get_grid_sources(run_path, grid_size, geometry_dir=None, window=None):
     TIMEDEP_OUT_PATH = path.join(run_path, 'output', 'TIMDEP.OUT')
     CADPTS_DAT_PATH = path.join(run_path, 'output', 'CADPTS.DAT')
-    WATER_LEVEL_DEPTH_MIN = 0.3
-    buffer_size = 65536
-    with open(TIMEDEP_OUT_PATH) as infile:
-        waterLevelLines = []
-        boundary = _get_grid_boudary(CADPTS_DAT_PATH)
-        # print("boundary : ", boundary)
-        CellGrid = _get_cell_grid(CADPTS_DAT_PATH, boundary, gap=grid_size)
-        # print("CellGrid : ", CellGrid)
-        while True:
-            lines = infile.readlines(buffer_size)
-            if not lines:
-                break
-            for line in lines:
-                if len(line.split()) == 1:
-                    if len(waterLevelLines) > 0:
-                        waterLevels = _get_water_level_grid(waterLevelLines)
-                        EsriGrid = _get_esri_grid(waterLevels, boundary, CellGrid, WATER_LEVEL_DEPTH_MIN, gap=grid_size)
-
-                        # Get Time stamp Ref:http://stackoverflow.com/a/13685221/1461060
-                        ModelTime = float(waterLevelLines[0].split()[0])
-                        fileModelTime = base_date_time
-                        fileModelTime = fileModelTime + timedelta(hours=ModelTime)
-                        dateAndTime = fileModelTime.strftime("%Y-%m-%d_%H-%M-%S")
-                        if fileModelTime >= run_date_time:
-                            # Create files
-                            fileName = "%s-%s.%s" % ('water_level_grid', dateAndTime, 'asc')
-                            file_path = path.join(out_dir, fileName)
-                            with open(file_path, 'w') as F:
-                                F.writelines(EsriGrid)
-                            print('Prepared: ', fileName)
-                        else:
-                            print('Skip. Current model time:' + dateAndTime +
-                                  ' is not greater than ' + run_date_time.strftime("%Y-%m-%d_%H-%M-%S"))
-                        waterLevelLines = []
-                waterLevelLines.append(line)
-        return True
-
-
-def _get_water_level_grid(lines):
-    waterLevels = []
-    for line in lines[1:]:
-        if line == '\n':
-            break
-        v = line.split()
-        # Get flood level (Elevation)
-        # waterLevels.append('%s %s' % (v[0], v[1]))
-        # Get flood depth (Depth)
-        waterLevels.append('%s %s' % (v[0], v[1]))
-    return waterLevels
-
-
-def _get_esri_grid(waterLevels, boudary, CellMap, water_level_depth_min,  gap=250.0, missingVal=-9):
+    # The geometry is shared by every run of the model, it is only built when CADPTS.DAT changes.
+    with stage('geometry'):
+        geometry = get_grid_geometry(CADPTS_DAT_PATH, grid_size, geometry_dir)
+    boundary = geometry['boundary']
+    # print("boundary : ", boundary)
+    # The raster index of the timestep elements is stored into the cell map, keep it local to this extraction.
+    CellGrid = dict(geometry['cell_map'])
+    # print("CellGrid : ", CellGrid)
+    output_cache = load_output_cache(run_path)
+    if output_cache and 'timdep_depth' in output_cache:
+        timeSteps = _get_cached_water_level_grids(output_cache, window)
+    else:
+        timeSteps = _get_water_level_grids(TIMEDEP_OUT_PATH, window)
+    return timeSteps, boundary, CellGrid
+
+
+def _get_grid_steps(timeSteps, base_date_time, run_date_time):
+    for ModelTime, elements, depths in timeSteps:
+        # Get Time stamp Ref:http://stackoverflow.com/a/13685221/1461060
+        fileModelTime = base_date_time
+        fileModelTime = fileModelTime + timedelta(hours=ModelTime)
+        dateAndTime = fileModelTime.strftime("%Y-%m-%d_%H-%M-%S")
+        if fileModelTime >= run_date_time:
+            fileName = "%s-%s.%s" % ('water_level_grid', dateAndTime, 'asc')
+            yield fileName, elements, depths
+        else:
+            print('Skip. Current model time:' + dateAndTime +
+                  ' is not greater than ' + run_date_time.strftime("%Y-%m-%d_%H-%M-%S"))
+
+
+def _imap_bounded(pool, func, chunks, max_pending):
+    """
+    Same as Pool.imap, but at most max_pending chunks are read and handed to the pool before their results are taken.
+    Pool.imap reads every chunk ahead and keeps every result until it is taken.
+    :param pool: multiprocessing.Pool
+    :param func: function, applied to each chunk in a worker process
+    :param chunks: iterable of the chunks
+    :param max_pending: int, number of chunks handed to the pool and not yet taken
+    :return: generator of the results, in the order of the chunks
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(func, (chunk,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _init_grid_worker(*grid_args):
+    global _grid_worker_args
+    _grid_worker_args = grid_args
+
+
+def _write_esri_grids(gridSteps):
+    fileNames = []
+    for fileName, elements, depths in gridSteps:
+        _write_esri_grid(fileName, elements, depths, *_grid_worker_args)
+        fileNames.append(fileName)
+    return fileNames
+
+
+def _render_esri_grids(gridSteps):
+    boundary, CellGrid, water_level_depth_min, grid_size, out_dir = _grid_worker_args
+    grids = []
+    for fileName, elements, depths in gridSteps:
+        EsriGrid = _get_esri_grid(elements, depths, boundary, CellGrid, water_level_depth_min, gap=grid_size)
+        grids.append((fileName, ''.join(EsriGrid)))
+    return grids
+
+
+def _write_esri_grid(fileName, elements, depths, boundary, CellGrid, water_level_depth_min, grid_size, out_dir):
+    EsriGrid = _get_esri_grid(elements, depths, boundary, CellGrid, water_level_depth_min, gap=grid_size)
+    # Create files
+    with stage('grid_write'):
+        with open(path.join(out_dir, fileName), 'w') as F:
+            F.writelines(EsriGrid)
+
+
+def _get_water_level_grids(timdep_file_path, window=None):
+    for step in read_timdep(timdep_file_path) if window is None else read_timdep_window(timdep_file_path, window):
+        if not len(step.values):
+            yield step.model_time, np.zeros(0, dtype=np.int64), np.zeros(0)
+            continue
+        # Get flood depth (Depth). Flood level (Elevation) is in column 5.
+        yield step.model_time, step.values[:, 0].astype(np.int64), step.values[:, 1].copy()
+
+
+def _get_cached_water_level_grids(output_cache, window=None):
+    elements = np.asarray(output_cache['timdep_elements'])
+    depths = output_cache['timdep_depth']
+    modelTimes = output_cache['timdep_times'].tolist()
+    for index in get_window_steps(modelTimes, window).tolist():
+        yield modelTimes[index], elements, np.asarray(depths[index])
+
+
+def _get_esri_grid(elements, depths, boudary, CellMap, water_level_depth_min,  gap=250.0, missingVal=-9):
     "Esri GRID format : https://en.wikipedia.org/wiki/Esri_grid"
     "ncols         4"
     "nrows         6"
@@ -76,87 +382,98 @@ def _get_esri_grid(waterLevels, boudary, CellMap, water_level_depth_min,  gap=25
 
     EsriGrid = []
 
-    cols = int(math.ceil((boudary['long_max'] - boudary['long_min']) / gap)) + 1
-    rows = int(math.ceil((boudary['lat_max'] - boudary['lat_min']) / gap)) + 1
+    cols, rows = get_grid_dimensions(boudary, gap)
     # print('>>>>>  cols: %d, rows: %d' % (cols, rows))
 
-    Grid = [[missingVal for x in range(cols)] for y in range(rows)]
-
-    for level in waterLevels:
-        v = level.split()
-        i, j = CellMap[int(v[0])]
-        if i >= cols or j >= rows:
-            pass
-            # TODO log these things
-            # print('i: %d, j: %d, cols: %d, rows: %d' % (i, j, cols, rows))
-            # print(boudary)
-        if float(v[1]) >= water_level_depth_min:
-            Grid[j][i] = float(v[1])
-
-    EsriGrid.append('%s\t%s\n' % ('ncols', cols))
-    EsriGrid.append('%s\t%s\n' % ('nrows', rows))
-    EsriGrid.append('%s\t%s\n' % ('xllcorner', boudary['long_min'] - 125))
-    EsriGrid.append('%s\t%s\n' % ('yllcorner', boudary['lat_min'] - 125))
-    EsriGrid.append('%s\t%s\n' % ('cellsize', gap))
-    EsriGrid.append('%s\t%s\n' % ('NODATA_value', missingVal))
-
-    for j in range(0, rows):
-        arr = []
-        for i in range(0, cols):
-            arr.append(Grid[j][i])
-
-        EsriGrid.append('%s\n' % (' '.join(str(x) for x in arr)))
+    with stage('grid_render'):
+        # Raster of indices into the value table, 0 is the missing value.
+        Grid = np.zeros((rows, cols), dtype=np.int64)
+        i, j, is_mapped = _get_raster_index(elements, CellMap)
+        # TODO log the cells which fall outside the grid.
+        mask = is_mapped & (depths >= water_level_depth_min) & (i < cols) & (j < rows)
+        values, value_indices = np.unique(depths[mask], return_inverse=True)
+        Grid[j[mask], i[mask]] = value_indices.ravel() + 1
+
+    EsriGrid.extend(_get_esri_header(cols, rows, boudary, gap, missingVal))
+
+    # Only the distinct depths are formatted, the rows are then put together as one buffer.
+    with stage('grid_format'):
+        table = [str(missingVal)] + [str(x) for x in values.tolist()]
+        EsriGrid.append(_format_raster(Grid, table))
+    count('cells_emitted', rows * cols)
     return EsriGrid
 
 
-def _get_grid_boudary(cad_pts_file_path):
-    "longitude  -> x : larger value"
-    "latitude   -> y : smaller value"
+def _get_esri_raster(Raster, boudary, gap=250.0, missingVal=-9):
+    """
+    Esri grid of a raster of values.
+    :param Raster: numpy.ndarray, (rows x cols) values, NaN where the value is missing
+    :return: list of str
+    """
+    rows, cols = Raster.shape
+    EsriGrid = _get_esri_header(cols, rows, boudary, gap, missingVal)
+    # Raster of indices into the value table, 0 is the missing value.
+    Grid = np.zeros((rows, cols), dtype=np.int64)
+    mask = ~np.isnan(Raster)
+    values, value_indices = np.unique(Raster[mask], return_inverse=True)
+    Grid[mask] = value_indices.ravel() + 1
+    with stage('grid_format'):
+        table = [str(missingVal)] + [str(x) for x in values.tolist()]
+        EsriGrid.append(_format_raster(Grid, table))
+    count('cells_emitted', rows * cols)
+    return EsriGrid
 
-    long_min = 1000000000.0
-    lat_min = 1000000000.0
-    long_max = 0.0
-    lat_max = 0.0
 
-    with open(cad_pts_file_path) as f:
-        lines = f.readlines()
-        for line in lines :
-            values = line.split()
-            long_min = min(long_min, float(values[1]))
-            lat_min = min(lat_min, float(values[2]))
+def _get_esri_header(cols, rows, boudary, gap, missingVal):
+    return [
+        '%s\t%s\n' % ('ncols', cols),
+        '%s\t%s\n' % ('nrows', rows),
+        '%s\t%s\n' % ('xllcorner', boudary['long_min'] - 125),
+        '%s\t%s\n' % ('yllcorner', boudary['lat_min'] - 125),
+        '%s\t%s\n' % ('cellsize', gap),
+        '%s\t%s\n' % ('NODATA_value', missingVal)
+    ]
 
-            long_max = max(long_max, float(values[1]))
-            lat_max = max(lat_max, float(values[2]))
 
-    return {
-        'long_min': long_min,
-        'lat_min': lat_min,
-        'long_max': long_max,
-        'lat_max': lat_max
-    }
+def _get_raster_index(elements, CellMap):
+    """
+    Raster positions of the given elements. The positions are worked out once and reused while the elements stay the
+    same, which is the case for every timestep of a run.
+    :return: tuple of numpy.ndarray, (column, row, whether the element is in the grid)
+    """
+    index = CellMap.get('index')
+    if index is not None and (index[0] is elements or np.array_equal(index[0], elements)):
+        return index[1:]
+    if len(CellMap['elements']):
+        positions = np.minimum(np.searchsorted(CellMap['elements'], elements), len(CellMap['elements']) - 1)
+        is_mapped = CellMap['elements'][positions] == elements
+        i = np.where(is_mapped, CellMap['cols'][positions], 0)
+        j = np.where(is_mapped, CellMap['rows'][positions], 0)
+    else:
+        is_mapped = np.zeros(len(elements), dtype=bool)
+        i = j = np.zeros(len(elements), dtype=np.int64)
+    CellMap['index'] = (elements, i, j, is_mapped)
+    return i, j, is_mapped
 
 
-def _get_cell_grid(cad_pts_file_path, boudary, gap=250.0):
-    CellMap = {}
-
-    cols = int(math.ceil((boudary['long_max'] - boudary['long_min']) / gap)) + 1
-    rows = int(math.ceil((boudary['lat_max'] - boudary['lat_min']) / gap)) + 1
-
-    with open(cad_pts_file_path) as f:
-        lines = f.readlines()
-        for line in lines :
-            v = line.split()
-            i = int((float(v[1]) - boudary['long_min']) / gap)
-            j = int((float(v[2]) - boudary['lat_min']) / gap)
-            if not isinstance(i, numbers.Integral) or not isinstance(j, numbers.Integral):
-                pass
-                # TODO log this
-                # print('### WARNING i: %d, j: %d, cols: %d, rows: %d' % (i, j, cols, rows))
-            if i >= cols or j >= rows:
-                pass
-                # TODO log this
-                # print('### WARNING i: %d, j: %d, cols: %d, rows: %d' % (i, j, cols, rows))
-            if i >= 0 or j >= 0 :
-                CellMap[int(v[0])] = (i, rows - j -1)
-
-    return CellMap
+def _format_raster(Grid, table):
+    """
+    Format a raster of value table indices as space separated rows.
+    :param Grid: numpy.ndarray, (rows x cols) indices into the table
+    :param table: list of str, formatted values
+    :return: str
+    """
+    rows, cols = Grid.shape
+    if not rows or not cols:
+        return '\n' * rows
+    tokens = np.array(table, dtype='S')
+    width = tokens.dtype.itemsize
+    lengths = np.char.str_len(tokens)
+    # Each cell is written to a fixed width slot followed by its separator, then the padding is dropped.
+    slots = np.zeros((rows, cols, width + 1), dtype=np.uint8)
+    slots[:, :, :width] = tokens.view(np.uint8).reshape(len(table), width)[Grid]
+    slots[:, :, width] = ord(' ')
+    slots[:, -1, width] = ord('\n')
+    is_used = np.arange(width + 1) < lengths[Grid][:, :, None]
+    is_used[:, :, width] = True
+    return slots[is_used].tobytes().decode('ascii')
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import shutil
+
+from glob import glob
+from os import path
+
+from .general import get_current_date_time, INDEX_DIR
+from .snapshot import link_file, LINK_MODE_HARDLINK
+
+# Kept in <run_path>/index with the indexes of the output files, so it is not archived with the output.
+OUTPUT_MANIFEST_FILE = 'output.manifest.json'
+
+
+def collect_flo2d_output(run_path):
+    """
+    Collect the results of a finished model run into <run_path>/output.
+    *.OUT files are moved and *.DAT files are hardlinked (copied if linking is not possible) into a staging directory.
+    The staging directory is then renamed to output, so the output directory only ever exists in a complete state. A
+    manifest of the sizes and checksums of the files is written once the output is in place.
+    :param run_path: str, absolute path to the run resources and configs
+    :return: dict, the output manifest
+    """
+    run_model_path = path.join(run_path, 'model')
+    run_output_path = path.join(run_path, 'output')
+    staging_path = run_output_path + '.tmp'
+    if path.exists(staging_path):
+        shutil.rmtree(staging_path)
+    os.makedirs(staging_path)
+
+    for out_file in glob(path.join(run_model_path, '*.OUT')):
+        shutil.move(out_file, path.join(staging_path, path.basename(out_file)))
+
+    for dat_file in glob(path.join(run_model_path, '*.DAT')):
+        link_file(dat_file, path.join(staging_path, path.basename(dat_file)), LINK_MODE_HARDLINK)
+
+    manifest = {'created_at': get_current_date_time(), 'files': {}}
+    for file_name in sorted(os.listdir(staging_path)):
+        file_path = path.join(staging_path, file_name)
+        manifest['files'][file_name] = {'size': path.getsize(file_path), 'sha1': _get_checksum(file_path)}
+
+    # The manifest of the previous output is removed first, it never describes an output it was not written for.
+    manifest_path = path.join(run_path, INDEX_DIR, OUTPUT_MANIFEST_FILE)
+    if path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    # commit the output. A previous output is renamed aside and removed only after the new one is in place, so the
+    # readers never see a half deleted output directory.
+    old_output_path = run_output_path + '.old'
+    if path.exists(old_output_path):
+        shutil.rmtree(old_output_path)
+    if path.exists(run_output_path):
+        os.rename(run_output_path, old_output_path)
+    os.rename(staging_path, run_output_path)
+    shutil.rmtree(old_output_path, ignore_errors=True)
+
+    if not path.exists(path.dirname(manifest_path)):
+        os.makedirs(path.dirname(manifest_path))
+    with open(manifest_path + '.tmp', 'w') as F:
+        json.dump(manifest, F)
+        F.flush()
+        os.fsync(F.fileno())
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def get_output_manifest(run_path):
+    """
+    :param run_path: str, absolute path to the run resources and configs
+    :return: dict, the output manifest, None if the output is not committed
+    """
+    try:
+        with open(path.join(run_path, INDEX_DIR, OUTPUT_MANIFEST_FILE), 'r') as F:
+            return json.load(F)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _get_checksum(file_path):
+    checksum = hashlib.sha1()
+    with open(file_path, 'rb') as F:
+        for block in iter(lambda: F.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
@@ -0,0 +1,84 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .metrics import stage
+
+DEFAULT_PERCENTILES = [10, 50, 90]
+# Value written by the flood plain extraction when a cell is not in a timestep.
+MISSING_VALUE = -999
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_batch_executor(workers):
+    """
+    Get the process wide pool of threads running the extractions of batch requests.
+    :param workers: int, number of threads
+    :return: concurrent.futures.ThreadPoolExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(int(workers), 1), thread_name_prefix='flo2d-batch')
+        return _executor
+
+
+def get_ensemble_statistics(run_series, percentiles=None):
+    """
+    Statistics of the series of the same name across the runs of an ensemble, per timestep.
+    :param run_series: list of dict, {name: [[timestamp, value], ...]} of each run
+    :param percentiles: list of float, percentiles to compute, DEFAULT_PERCENTILES if not given
+    :return: dict, {name: {'timestamps': [...], 'runs': [...], 'min': [...], 'max': [...], 'mean': [...],
+    'p<percentile>': [...]}}. Timesteps without a value in any run get None.
+    """
+    percentiles = DEFAULT_PERCENTILES if percentiles is None else percentiles
+    names = sorted(set(name for series in run_series for name in series.keys()))
+    statistics = {}
+    with stage('ensemble_statistics'):
+        for name in names:
+            timestamps = sorted(set(point[0] for series in run_series for point in series.get(name, [])))
+            positions = {timestamp: position for position, timestamp in enumerate(timestamps)}
+            # (runs x timesteps) values, NaN where a run has no value for the timestep.
+            values = np.full((len(run_series), len(timestamps)), np.nan)
+            for run_index, series in enumerate(run_series):
+                points = series.get(name, [])
+                if points:
+                    columns = np.array([positions[point[0]] for point in points], dtype=np.int64)
+                    values[run_index, columns] = [_to_float(point[1]) for point in points]
+            values[values == MISSING_VALUE] = np.nan
+            statistics[name] = _get_statistics(timestamps, values, percentiles)
+    return statistics
+
+
+def _get_statistics(timestamps, values, percentiles):
+    has_value = ~np.isnan(values)
+    runs = has_value.sum(axis=0)
+    statistics = {'timestamps': timestamps, 'runs': runs.tolist()}
+    if not values.size:
+        for key in ['min', 'max', 'mean'] + ['p%g' % percentile for percentile in percentiles]:
+            statistics[key] = [None] * len(timestamps)
+        return statistics
+    # Timesteps without a value in any run are filled so the reductions do not warn, then reported as None.
+    filled = np.where(has_value.any(axis=0), values, 0.0)
+    statistics['min'] = _to_list(np.nanmin(filled, axis=0), runs)
+    statistics['max'] = _to_list(np.nanmax(filled, axis=0), runs)
+    statistics['mean'] = _to_list(np.nanmean(filled, axis=0), runs)
+    if percentiles:
+        for percentile, result in zip(percentiles, np.nanpercentile(filled, percentiles, axis=0)):
+            statistics['p%g' % percentile] = _to_list(result, runs)
+    return statistics
+
+
+def _to_list(result, runs):
+    return [value if count else None for value, count in zip(np.round(result, 6).tolist(), runs.tolist())]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
@@ -1,158 +1,363 @@
+import numpy as np
+
 from os import path
 from datetime import timedelta
 
-from .general import get_run_date_times
+from .general import get_run_date_times, isfloat
+from .hychan import get_hychan_index, read_element_lines, read_element_rows
+from .metrics import stage, count
+from .output_cache import load_output_cache
+from .tail import get_timdep_tail
+from .timdep import read_timdep, read_timdep_window, get_timdep_tokens
+from .window import get_window_steps
+
+# Columns of the channel outputs in HYCHAN.OUT rows.
+HYCHAN_OUT_COLUMNS = {
+    'water-level': 1,
+    'water-depth': 2,
+    'discharge': 4
+}
+# Arrays of the channel outputs in the output cache.
+HYCHAN_CACHE_ARRAYS = {
+    'water-level': 'hychan_stage',
+    'discharge': 'hychan_discharge'
+}
+# Value of the flood plain cells which are not in a timestep.
+MISSING_VALUE = -999
 
 
-def extract_water_levels(run_path, channel_cell_map, flood_plain_map):
+def extract_water_levels(run_path, channel_cell_map, flood_plain_map, window=None):
     HYCHAN_OUT_PATH = path.join(run_path, 'output', 'HYCHAN.OUT')
     TIMDEP_OUT_PATH = path.join(run_path, 'output', 'TIMDEP.OUT')
     base_dt, run_dt = get_run_date_times(run_path)
+    output_cache = load_output_cache(run_path)
 
-    channel_tms_length = _get_timeseries_length(HYCHAN_OUT_PATH)
-    channel_tms = _get_channel_timeseries(HYCHAN_OUT_PATH, 'water-level', channel_tms_length, base_dt, channel_cell_map)
-    flood_plain_tms = _get_flood_plain_timeseries(TIMDEP_OUT_PATH, base_dt, flood_plain_map)
+    if output_cache and 'hychan_stage' in output_cache:
+        channel_tms = _get_cached_channel_timeseries(output_cache, 'water-level', base_dt, channel_cell_map, window)
+    else:
+        channel_tms = _get_channel_timeseries(HYCHAN_OUT_PATH, 'water-level', base_dt, channel_cell_map, window)
+    if output_cache and 'timdep_elevation' in output_cache:
+        flood_plain_tms = _get_cached_flood_plain_timeseries(output_cache, base_dt, flood_plain_map, window)
+    else:
+        flood_plain_tms = _get_flood_plain_timeseries(TIMDEP_OUT_PATH, base_dt, flood_plain_map, window)
 
     return _change_keys(channel_cell_map, channel_tms), _change_keys(flood_plain_map, flood_plain_tms)
 
 
-def extract_water_discharge(run_path, channel_cell_map):
+def extract_water_discharge(run_path, channel_cell_map, window=None):
     HYCHAN_OUT_PATH = path.join(run_path, 'output', 'HYCHAN.OUT')
-    channel_tms_length = _get_timeseries_length(HYCHAN_OUT_PATH)
     base_dt, run_dt = get_run_date_times(run_path)
+    output_cache = load_output_cache(run_path)
 
-    channel_tms = _get_channel_timeseries(HYCHAN_OUT_PATH, 'discharge', channel_tms_length, base_dt, channel_cell_map)
+    if output_cache and 'hychan_discharge' in output_cache:
+        channel_tms = _get_cached_channel_timeseries(output_cache, 'discharge', base_dt, channel_cell_map, window)
+    else:
+        channel_tms = _get_channel_timeseries(HYCHAN_OUT_PATH, 'discharge', base_dt, channel_cell_map, window)
 
     return _change_keys(channel_cell_map, channel_tms)
 
 
-def _get_timeseries_length(hychan_file_path):
-    # Calculate the size of time series
-    bufsize = 65536
-    series_length = 0
-    with open(hychan_file_path) as infile:
-        is_water_level_lines = False
-        is_counting = False
-        count_series_size = 0  # HACK: When it comes to the end of file, unable to detect end of time series
-        while True:
-            lines = infile.readlines(bufsize)
-            if not lines or series_length:
-                break
-            for line in lines:
-                if line.startswith('CHANNEL HYDROGRAPH FOR ELEMENT NO:', 5):
-                    is_water_level_lines = True
-                elif is_water_level_lines:
-                    cols = line.split()
-                    if len(cols) > 0 and cols[0].replace('.', '', 1).isdigit():
-                        count_series_size += 1
-                        is_counting = True
-                    elif is_water_level_lines and is_counting:
-                        series_length = count_series_size
-                        break
-    return series_length
-
-
-def _get_channel_timeseries(hychan_file_path, output_type, series_length, base_time, cell_map):
-
-    hychan_out_mapping = {
-        'water-level': 1,
-        'water-depth': 2,
-        'discharge': 4
+def iter_water_levels(run_path, channel_cell_map, flood_plain_map, window=None, numeric=False):
+    """
+    Extract the water levels of a finished run one cell at a time, for responses which are sent while they are being
+    extracted. Channel series are read from HYCHAN.OUT one element at a time. TIMDEP.OUT holds the timesteps one after
+    the other, so the flood plain levels of the requested cells are collected in one pass and then handed out one cell
+    at a time.
+    :param run_path: str, absolute path to the run resources and configs
+    :param channel_cell_map: dict, element number -> name of the channel cells
+    :param flood_plain_map: dict, element number -> name of the flood plain cells
+    :param window: TimeWindow, timesteps to extract, every timestep if not given
+    :param numeric: boolean, collect the flood plain levels as numbers instead of as written in the output file, for
+    formats which send numbers. The levels are collected in a float array, otherwise in a fixed width bytes array of
+    the tokens.
+    :return: generator of (group, timestamps, cells). group is 'CHANNELS' or 'FLOOD_PLAIN', timestamps is the list of
+    timestamps of the group and cells is a generator of (name, values). values has one value per timestamp, as
+    written in the output file or a float when numeric, None where the cell has no value.
+    """
+    TIMDEP_OUT_PATH = path.join(run_path, 'output', 'TIMDEP.OUT')
+    base_dt, run_dt = get_run_date_times(run_path)
+    output_cache = load_output_cache(run_path)
+
+    timestamps, cells = _get_channel_columns(run_path, output_cache, 'water-level', base_dt, channel_cell_map, window)
+    yield 'CHANNELS', timestamps, cells
+    if output_cache and 'timdep_elevation' in output_cache:
+        elementNumbers, timestamps, waterLevels = _get_cached_flood_plain_levels(output_cache, base_dt,
+                                                                                  flood_plain_map, window, numeric)
+    else:
+        elementNumbers, timestamps, waterLevels = _get_flood_plain_levels(TIMDEP_OUT_PATH, base_dt, flood_plain_map,
+                                                                           window, numeric)
+    yield 'FLOOD_PLAIN', timestamps, _get_flood_plain_columns(flood_plain_map, elementNumbers, waterLevels)
+
+
+def iter_water_discharge(run_path, channel_cell_map, window=None):
+    """
+    Extract the water discharge of a finished run one cell at a time, see iter_water_levels.
+    :return: generator of (group, timestamps, cells)
+    """
+    base_dt, run_dt = get_run_date_times(run_path)
+    yield ('CHANNELS',) + _get_channel_columns(run_path, load_output_cache(run_path), 'discharge', base_dt,
+                                               channel_cell_map, window)
+
+
+def extract_partial_water_levels(run_path, channel_cell_map, flood_plain_map, window=None):
+    """
+    Extract the water levels of a run which is still in progress from the files FLOPRO is writing in the model
+    directory. Channel series are only available once FLOPRO has written them to HYCHAN.OUT.
+    :return: tuple, (channel timeseries, flood plain timeseries, progress of the run)
+    """
+    HYCHAN_OUT_PATH = path.join(run_path, 'model', 'HYCHAN.OUT')
+    TIMDEP_OUT_PATH = path.join(run_path, 'model', 'TIMDEP.OUT')
+    base_dt, run_dt = get_run_date_times(run_path)
+
+    channel_tms = _get_partial_channel_timeseries(HYCHAN_OUT_PATH, 'water-level', base_dt, channel_cell_map, window)
+    steps = get_timdep_tail(TIMDEP_OUT_PATH, _get_element_ids(list(flood_plain_map.keys()))[0]) or []
+    flood_plain_tms = _get_partial_flood_plain_timeseries(steps, base_dt, flood_plain_map, window)
+
+    return _change_keys(channel_cell_map, channel_tms), _change_keys(flood_plain_map, flood_plain_tms), \
+        _get_progress(base_dt, steps)
+
+
+def extract_partial_water_discharge(run_path, channel_cell_map, window=None):
+    """
+    Extract the water discharge of a run which is still in progress.
+    :return: tuple, (channel timeseries, progress of the run)
+    """
+    HYCHAN_OUT_PATH = path.join(run_path, 'model', 'HYCHAN.OUT')
+    TIMDEP_OUT_PATH = path.join(run_path, 'model', 'TIMDEP.OUT')
+    base_dt, run_dt = get_run_date_times(run_path)
+
+    channel_tms = _get_partial_channel_timeseries(HYCHAN_OUT_PATH, 'discharge', base_dt, channel_cell_map, window)
+
+    # Only the timesteps are followed for the progress, no flood plain rows are kept.
+    steps = get_timdep_tail(TIMDEP_OUT_PATH, np.zeros(0, dtype=np.int64)) or []
+
+    return _change_keys(channel_cell_map, channel_tms), _get_progress(base_dt, steps)
+
+
+def _get_progress(base_time, steps):
+    if not steps:
+        return {'model_time': None, 'date_time': None, 'time_steps': 0}
+    model_time = steps[-1].model_time
+    return {
+        'model_time': model_time,
+        'date_time': (base_time + timedelta(hours=model_time)).strftime("%Y-%m-%d %H:%M:%S"),
+        'time_steps': len(steps)
     }
 
+
+def _get_channel_timeseries(hychan_file_path, output_type, base_time, cell_map, window=None):
     # Extract Channel Water Level elevations from HYCHAN.OUT file
     ELEMENT_NUMBERS = cell_map.keys()
-    MISSING_VALUE = -999
-    bufsize = 65536
     waterLevelSeriesDict = dict.fromkeys(ELEMENT_NUMBERS, [])
-    with open(hychan_file_path) as infile:
-        is_water_level_lines = False
-        is_series_complete = False
-        waterLevelLines = []
-        seriesSize = 0  # HACK: When it comes to the end of file, unable to detect end of time series
-        while True:
-            lines = infile.readlines(bufsize)
-            if not lines:
-                break
-            for line in lines:
-                if line.startswith('CHANNEL HYDROGRAPH FOR ELEMENT NO:', 5):
-                    seriesSize = 0
-                    elementNo = line.split()[5]
-
-                    if elementNo in ELEMENT_NUMBERS:
-                        is_water_level_lines = True
-                        waterLevelLines.append(line)
-                    else:
-                        is_water_level_lines = False
-
-                elif is_water_level_lines:
-                    cols = line.split()
-                    if len(cols) > 0 and isfloat(cols[0]):
-                        seriesSize += 1
-                        waterLevelLines.append(line)
-
-                        if seriesSize == series_length:
-                            is_series_complete = True
-
-                if is_series_complete:
-                    timeseries = []
-                    elementNo = waterLevelLines[0].split()[5]
-                    print('Extracted Cell No', elementNo, cell_map[elementNo])
-                    for ts in waterLevelLines[1:]:
-                        v = ts.split()
-                        if len(v) < 1:
-                            continue
-                        # Get flood level (Elevation)
-                        value = v[hychan_out_mapping[output_type]]
-                        # Get flood depth (Depth)
-                        # value = v[2]
-                        if not isfloat(value):
-                            value = MISSING_VALUE
-                            continue  # If value is not present, skip
-                        if value == 'NaN':
-                            continue  # If value is NaN, skip
-                        timeStep = float(v[0])
-                        currentStepTime = base_time + timedelta(hours=timeStep)
-                        dateAndTime = currentStepTime.strftime("%Y-%m-%d %H:%M:%S")
-                        timeseries.append([dateAndTime, value])
-                    waterLevelSeriesDict[elementNo] = timeseries
-                    is_water_level_lines = False
-                    is_series_complete = False
-                    waterLevelLines = []
-        return waterLevelSeriesDict
-
-
-def _get_flood_plain_timeseries(timdep_file_path, base_time, cell_map):
-    # Extract Flood Plain water elevations from BASE.OUT file
-    bufsize = 65536
-    MISSING_VALUE = -999
+    hychan_index = get_hychan_index(hychan_file_path)
+    for elementNo, waterLevelLines in _read_channel_lines(hychan_file_path, hychan_index, cell_map, window):
+        rows = [ts.split() for ts in waterLevelLines]
+        # Get flood level (Elevation)
+        values = [v[HYCHAN_OUT_COLUMNS[output_type]] for v in rows]
+        # Get flood depth (Depth)
+        # values = [v[2] for v in rows]
+        waterLevelSeriesDict[elementNo] = _get_channel_series(base_time, [float(v[0]) for v in rows], values)
+    return waterLevelSeriesDict
+
+
+def _read_channel_lines(hychan_file_path, hychan_index, cell_map, window=None):
+    offsets = {elementNo: offset for elementNo, offset in hychan_index['elements'].items() if elementNo in cell_map}
+    if window is None:
+        return read_element_lines(hychan_file_path, offsets, hychan_index['series_length'])
+    # Only the rows within the window are read, rows after the window are not read at all.
+    rows = get_window_steps(hychan_index['series_times'], window).tolist()
+    return read_element_rows(hychan_file_path, hychan_index, offsets, rows)
+
+
+def _get_channel_columns(run_path, output_cache, output_type, base_time, cell_map, window=None):
+    """
+    The timestamps are shared by the cells, a cell whose series has other timesteps raises ValueError.
+    :return: tuple, (timestamps of the series, generator of (name, values) of the channel cells). Values which are
+    not numbers are None. Cells which are not in the output have only None values.
+    """
+    if output_cache and HYCHAN_CACHE_ARRAYS.get(output_type) in output_cache:
+        series = output_cache[HYCHAN_CACHE_ARRAYS[output_type]]
+        positions = {elementNo: index for index, elementNo in enumerate(output_cache['hychan_elements'])
+                     if elementNo in cell_map}
+        modelTimes = output_cache['hychan_times'][0] if len(positions) else np.zeros(0)
+        steps = get_window_steps(modelTimes, window)
+
+        def get_values():
+            for elementNo, index in positions.items():
+                yield elementNo, output_cache['hychan_times'][index][steps], \
+                    np.char.decode(series[index][steps], 'ascii').tolist()
+    else:
+        hychan_file_path = path.join(run_path, 'output', 'HYCHAN.OUT')
+        hychan_index = get_hychan_index(hychan_file_path)
+        modelTimes = np.asarray(hychan_index['series_times'], dtype=float)
+        steps = get_window_steps(modelTimes, window)
+
+        def get_values():
+            for elementNo, lines in _read_channel_lines(hychan_file_path, hychan_index, cell_map, window):
+                rows = [line.split() for line in lines]
+                yield elementNo, [float(v[0]) for v in rows], [v[HYCHAN_OUT_COLUMNS[output_type]] for v in rows]
+
+    timestamps = [(base_time + timedelta(hours=ModelTime)).strftime("%Y-%m-%d %H:%M:%S")
+                  for ModelTime in modelTimes[steps].tolist()]
+
+    def get_columns():
+        missing = dict(cell_map)
+        for elementNo, times, values in get_values():
+            if not np.array_equal(times, modelTimes[steps]):
+                raise ValueError('Series of channel element %s does not have the timesteps of the other elements.'
+                                 % elementNo)
+            missing.pop(elementNo, None)
+            with stage('format_series'):
+                values = [value if isfloat(value) and value != 'NaN' else None for value in values]
+            yield cell_map[elementNo], values
+        for name in missing.values():
+            yield name, [None] * len(timestamps)
+
+    return timestamps, get_columns()
+
+
+def _get_flood_plain_columns(cell_map, element_numbers, waterLevels):
+    for index, elementNo in enumerate(element_numbers):
+        values = waterLevels[index].tolist()
+        if waterLevels.dtype.kind == 'S':
+            yield cell_map[elementNo], [value.decode('ascii') if value else None for value in values]
+        else:
+            yield cell_map[elementNo], [None if value != value else value for value in values]
+
+
+def _get_partial_channel_timeseries(hychan_file_path, output_type, base_time, cell_map, window=None):
+    # HYCHAN.OUT holds the whole series of an element at once, only the elements written so far are available.
+    if not path.exists(hychan_file_path) or not path.getsize(hychan_file_path):
+        return dict.fromkeys(cell_map.keys(), [])
+    try:
+        return _get_channel_timeseries(hychan_file_path, output_type, base_time, cell_map, window)
+    except (IndexError, ValueError) as e:
+        # The last line is still being written, the series are read again on the next request.
+        print('Warning: HYCHAN.OUT of the running model is incomplete. ' + hychan_file_path, e)
+        return dict.fromkeys(cell_map.keys(), [])
+
+
+def _get_cached_channel_timeseries(output_cache, output_type, base_time, cell_map, window=None):
     ELEMENT_NUMBERS = cell_map.keys()
-    with open(timdep_file_path) as infile:
-        waterLevelLines = []
-        waterLevelSeriesDict = dict.fromkeys(ELEMENT_NUMBERS, [])
-        while True:
-            lines = infile.readlines(bufsize)
-            if not lines:
-                break
-            for line in lines:
-                if len(line.split()) == 1:
-                    if len(waterLevelLines) > 0:
-                        waterLevels = _get_water_level_of_channels(waterLevelLines, ELEMENT_NUMBERS)
-                        # Get Time stamp Ref:http://stackoverflow.com/a/13685221/1461060
-                        ModelTime = float(waterLevelLines[0].split()[0])
-                        currentStepTime = base_time + timedelta(hours=ModelTime)
-                        dateAndTime = currentStepTime.strftime("%Y-%m-%d %H:%M:%S")
-
-                        for elementNo in ELEMENT_NUMBERS:
-                            tmpTS = waterLevelSeriesDict[elementNo][:]
-                            if elementNo in waterLevels:
-                                tmpTS.append([dateAndTime, waterLevels[elementNo]])
-                            else:
-                                tmpTS.append([dateAndTime, MISSING_VALUE])
-                            waterLevelSeriesDict[elementNo] = tmpTS
-                        waterLevelLines = []
-                waterLevelLines.append(line)
-        return waterLevelSeriesDict
+    waterLevelSeriesDict = dict.fromkeys(ELEMENT_NUMBERS, [])
+    series = output_cache[HYCHAN_CACHE_ARRAYS[output_type]]
+    for index, elementNo in enumerate(output_cache['hychan_elements']):
+        if elementNo in cell_map:
+            steps = get_window_steps(output_cache['hychan_times'][index], window)
+            values = np.char.decode(series[index][steps], 'ascii').tolist()
+            waterLevelSeriesDict[elementNo] = _get_channel_series(base_time,
+                                                                  output_cache['hychan_times'][index][steps].tolist(),
+                                                                  values)
+    return waterLevelSeriesDict
+
+
+def _get_channel_series(base_time, time_steps, values):
+    timeseries = []
+    with stage('format_series'):
+        for timeStep, value in zip(time_steps, values):
+            if not isfloat(value):
+                continue  # If value is not present, skip
+            if value == 'NaN':
+                continue  # If value is NaN, skip
+            currentStepTime = base_time + timedelta(hours=timeStep)
+            dateAndTime = currentStepTime.strftime("%Y-%m-%d %H:%M:%S")
+            timeseries.append([dateAndTime, value])
+    count('cells_emitted', len(timeseries))
+    return timeseries
+
+
+def _get_flood_plain_timeseries(timdep_file_path, base_time, cell_map, window=None):
+    return _get_flood_plain_series(*_get_flood_plain_levels(timdep_file_path, base_time, cell_map, window))
+
+
+def _get_flood_plain_levels(timdep_file_path, base_time, cell_map, window=None, numeric=False):
+    # Extract Flood Plain water elevations from TIMDEP.OUT file
+    ELEMENT_NUMBERS = list(cell_map.keys())
+    element_ids, element_indices = _get_element_ids(ELEMENT_NUMBERS)
+    row_finder = _RowFinder(element_ids)
+    # Columnar accumulator, one row per requested element and one column per timestep.
+    waterLevels = _get_flood_plain_accumulator(len(ELEMENT_NUMBERS), 64, numeric)
+    timestamps = []
+    # The blocks outside of the window are skipped with the timestep offset index, without being read.
+    for step in read_timdep(timdep_file_path) if window is None else read_timdep_window(timdep_file_path, window):
+        if len(timestamps) == waterLevels.shape[1]:
+            waterLevels = np.concatenate((waterLevels, _get_flood_plain_accumulator(*waterLevels.shape, numeric)),
+                                         axis=1)
+        found, levels = _get_water_level_of_channels(step, row_finder, numeric)
+        waterLevels = _fit_levels(waterLevels, levels)
+        waterLevels[element_indices[found], len(timestamps)] = levels
+        # Get Time stamp Ref:http://stackoverflow.com/a/13685221/1461060
+        currentStepTime = base_time + timedelta(hours=step.model_time)
+        timestamps.append(currentStepTime.strftime("%Y-%m-%d %H:%M:%S"))
+    return ELEMENT_NUMBERS, timestamps, waterLevels[:, :len(timestamps)]
+
+
+def _get_cached_flood_plain_timeseries(output_cache, base_time, cell_map, window=None):
+    return _get_flood_plain_series(*_get_cached_flood_plain_levels(output_cache, base_time, cell_map, window))
+
+
+def _get_cached_flood_plain_levels(output_cache, base_time, cell_map, window=None, numeric=False):
+    ELEMENT_NUMBERS = list(cell_map.keys())
+    element_ids, element_indices = _get_element_ids(ELEMENT_NUMBERS)
+    rows = _RowFinder(element_ids).find(output_cache['timdep_elements'])
+    found = rows >= 0
+    steps = get_window_steps(output_cache['timdep_times'], window)
+    timestamps = [(base_time + timedelta(hours=ModelTime)).strftime("%Y-%m-%d %H:%M:%S")
+                  for ModelTime in output_cache['timdep_times'][steps].tolist()]
+    waterLevels = _get_flood_plain_accumulator(len(ELEMENT_NUMBERS), len(timestamps), numeric)
+    if found.any() and timestamps:
+        # Get flood level (Elevation)
+        elevation = output_cache['timdep_elevation'] if window is None else output_cache['timdep_elevation'][steps]
+        levels = elevation[:, rows[found]].T
+        if numeric:
+            levels = levels.astype(float)
+        waterLevels = _fit_levels(waterLevels, levels)
+        waterLevels[element_indices[found]] = levels
+    return ELEMENT_NUMBERS, timestamps, waterLevels
+
+
+def _get_flood_plain_accumulator(cells, time_steps, numeric):
+    # Numeric levels are floats with NaN for the missing values, the others are the tokens as written in the file in
+    # a fixed width bytes array, empty for the missing values.
+    if numeric:
+        return np.full((cells, time_steps), np.nan)
+    return np.zeros((cells, time_steps), dtype='S1')
+
+
+def _fit_levels(waterLevels, levels):
+    # A bytes accumulator is widened to the longest token, numpy would truncate the longer ones.
+    if waterLevels.dtype.kind == 'S' and levels.dtype.itemsize > waterLevels.dtype.itemsize:
+        return waterLevels.astype(levels.dtype)
+    return waterLevels
+
+
+def _get_partial_flood_plain_timeseries(steps, base_time, cell_map, window=None):
+    steps = [steps[position] for position in get_window_steps([step.model_time for step in steps], window)]
+    ELEMENT_NUMBERS = list(cell_map.keys())
+    element_ids, element_indices = _get_element_ids(ELEMENT_NUMBERS)
+    row_finder = _RowFinder(element_ids)
+    waterLevels = _get_flood_plain_accumulator(len(ELEMENT_NUMBERS), len(steps), False)
+    timestamps = []
+    for step in steps:
+        if len(element_ids) and len(step.elements):
+            rows = row_finder.find(step.elements)
+            found = rows >= 0
+            waterLevels = _fit_levels(waterLevels, step.levels)
+            waterLevels[element_indices[found], len(timestamps)] = step.levels[rows[found]]
+        currentStepTime = base_time + timedelta(hours=step.model_time)
+        timestamps.append(currentStepTime.strftime("%Y-%m-%d %H:%M:%S"))
+    return _get_flood_plain_series(ELEMENT_NUMBERS, timestamps, waterLevels)
+
+
+def _get_flood_plain_series(element_numbers, timestamps, waterLevels):
+    waterLevelSeriesDict = {}
+    with stage('format_series'):
+        for index, elementNo in enumerate(element_numbers):
+            waterLevelSeriesDict[elementNo] = [[timestamp, value.decode('ascii') if value else MISSING_VALUE]
+                                               for timestamp, value in
+                                               zip(timestamps, waterLevels[index, :len(timestamps)].tolist())]
+    count('cells_emitted', len(element_numbers) * len(timestamps))
+    return waterLevelSeriesDict
 
 
 def _change_keys(key_map, dict_to_be_mapped):
@@ -162,31 +367,59 @@ def _change_keys(key_map, dict_to_be_mapped):
     return dict_
 
 
-def isfloat(value):
-    try:
-        float(value)
-        return True
-    except ValueError:
-        return False
+def _get_element_ids(element_numbers):
+    """
+    Map the requested element numbers to the integer ids used in the FLO2D output files.
+    Element numbers which are not written the way FLO2D writes them (e.g. with leading zeros) never match a row.
+    :param element_numbers: list of str
+    :return: tuple of numpy.ndarray, (element ids, index of each id in element_numbers)
+    """
+    element_ids = []
+    element_indices = []
+    for index, elementNo in enumerate(element_numbers):
+        if str(elementNo).isdigit() and str(int(elementNo)) == str(elementNo):
+            element_ids.append(int(elementNo))
+            element_indices.append(index)
+    return np.array(element_ids, dtype=np.int64), np.array(element_indices, dtype=np.int64)
 
 
-def _get_water_level_of_channels(lines, channels=None):
+def _get_water_level_of_channels(step, row_finder, numeric=False):
     """
      Get Water Levels of given set of channels
-    :param lines:
-    :param channels:
-    :return:
-    """
-    if channels is None:
-        channels = []
-    water_levels = {}
-    for line in lines[1:]:
-        if line == '\n':
-            break
-        v = line.split()
-        if v[0] in channels:
-            # Get flood level (Elevation)
-            water_levels[v[0]] = v[5]
-            # Get flood depth (Depth)
-            # water_levels[int(v[0])] = v[2]
-    return water_levels
+    :param step: TimdepStep
+    :param row_finder: _RowFinder of the requested element ids
+    :param numeric: boolean, get the water levels as parsed instead of the bytes tokens as written in the file
+    :return: tuple, (boolean mask of the element ids present in the step, water levels)
+    """
+    if not len(row_finder.ids) or not len(step.values):
+        return np.zeros(len(row_finder.ids), dtype=bool), np.zeros(0, dtype=float if numeric else 'S1')
+    rows = row_finder.find(step.values[:, 0].astype(np.int64))
+    found = rows >= 0
+    # Get flood level (Elevation). Flood depth (Depth) is in column 1.
+    if numeric:
+        return found, step.values[rows[found], 5]
+    return found, get_timdep_tokens(step, 5, rows[found])
+
+
+class _RowFinder:
+    """
+    Finds the rows of the given element ids in TIMDEP.OUT blocks. The lookup is reused while the element column of
+    consecutive blocks stays the same, which is the case for every block of a FLO2D run.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.elements = None
+        self.rows = None
+
+    def find(self, elements):
+        if not len(elements):
+            return np.full(len(self.ids), -1, dtype=np.int64)
+        if self.elements is None or not np.array_equal(self.elements, elements):
+            # When an element is repeated in a block the last row wins.
+            order = np.argsort(elements, kind='stable')
+            positions = np.searchsorted(elements, self.ids, side='right', sorter=order) - 1
+            rows = order[np.clip(positions, 0, None)]
+            matched = (positions >= 0) & (elements[rows] == self.ids)
+            self.elements, self.rows = elements, np.where(matched, rows, -1)
+        return self.rows
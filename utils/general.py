@@ -2,9 +2,12 @@ import json
 
 from datetime import datetime
 from distutils.dir_util import remove_tree
-from os import path, makedirs
+from os import path, makedirs, walk, listdir
 
-from constants import INIT_DATE_TIME_FORMAT
+from constants import INIT_DATE_TIME_FORMAT, DATE_TIME_FORMAT
+
+# Directory of a run the indexes of its collected output files are kept in.
+INDEX_DIR = 'index'
 
 
 def create_dir(dir_path):
@@ -17,10 +20,76 @@ def create_dir(dir_path):
         raise
 
 
+def get_index_path(file_path, suffix):
+    """
+    Path of the index file of a FLO2D output file. Indexes of the collected outputs are kept in <run_path>/index, so
+    the output directory only holds the files which are archived into output.zip. Indexes of the files FLOPRO is
+    still writing in the model directory are kept next to them.
+    :param file_path: str, path to the output file
+    :param suffix: str, suffix of the index file name
+    :return: str
+    """
+    file_dir = path.dirname(path.abspath(file_path))
+    if path.basename(file_dir) == 'output':
+        return path.join(path.dirname(file_dir), INDEX_DIR, path.basename(file_path) + suffix)
+    return file_path + suffix
+
+
 def get_run_date_times(run_path):
     run_config_path = path.join(run_path, 'input', 'run-config.json')
     with open(run_config_path, 'r') as F:
         run_config = json.load(F)
     base_dt = datetime.strptime(run_config['base-date-time'], INIT_DATE_TIME_FORMAT)
     run_dt = datetime.strptime(run_config['run-date-time'], INIT_DATE_TIME_FORMAT)
-    return base_dt, run_dt
\ No newline at end of file
+    return base_dt, run_dt
+
+
+def isfloat(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def get_current_date_time():
+    return datetime.now().strftime(DATE_TIME_FORMAT)
+
+
+def get_dir_size(dir_path):
+    """
+    Total size of the files under the given directory.
+    :param dir_path: str, path to the directory
+    :return: int, size in bytes, 0 if the directory does not exist
+    """
+    size = 0
+    for root, dirs, files in walk(dir_path):
+        for file_name in files:
+            try:
+                size += path.getsize(path.join(root, file_name))
+            except OSError:
+                pass
+    return size
+
+
+def get_run_sizes(run_path):
+    """
+    Sizes of the inputs, outputs and the derived artifacts (cache, archives, grids) of a run.
+    :param run_path: str, absolute path to the run resources and configs
+    :return: dict, {'input_size': int, 'output_size': int, 'artifacts_size': int}
+    """
+    sizes = {'input_size': 0, 'output_size': 0, 'artifacts_size': 0}
+    if not path.exists(run_path):
+        return sizes
+    for entry in listdir(run_path):
+        entry_path = path.join(run_path, entry)
+        if entry == 'model':
+            continue
+        size = get_dir_size(entry_path) if path.isdir(entry_path) else path.getsize(entry_path)
+        if entry == 'input':
+            sizes['input_size'] = size
+        elif entry == 'output':
+            sizes['output_size'] = size
+        else:
+            sizes['artifacts_size'] += size
+    return sizes
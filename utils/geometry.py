@@ -0,0 +1,179 @@
+import hashlib
+import math
+import os
+import threading
+
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+
+# Number of grid geometries kept in memory.
+GEOMETRY_LRU_SIZE = 8
+
+_geometries = OrderedDict()
+# CADPTS.DAT (path, size, mtime) -> content hash, so an unchanged file is not hashed again.
+_content_hashes = {}
+_geometry_lock = threading.Lock()
+
+
+def get_grid_geometry(cad_pts_file_path, grid_size, geometry_dir=None):
+    """
+    Get the grid geometry of a CADPTS.DAT file. Geometries are keyed by the content hash of the file, so every run of
+    the same model shares one. They are kept in an in-process LRU and persisted to geometry_dir if given.
+    :param cad_pts_file_path: str, path to the CADPTS.DAT file
+    :param grid_size: float, size of a grid cell
+    :param geometry_dir: str, directory to persist the geometries in, optional
+    :return: dict, {'key': str, 'boundary': dict, 'cols': int, 'rows': int, 'elements': numpy.ndarray,
+    'coordinates': numpy.ndarray, 'cell_map': dict of the raster position index arrays}
+    """
+    key = '%s-%s' % (_get_content_hash(cad_pts_file_path), float(grid_size))
+    with _geometry_lock:
+        geometry = _geometries.get(key)
+        if geometry is not None:
+            _geometries.move_to_end(key)
+            return geometry
+
+    geometry = _load_geometry(geometry_dir, key) if geometry_dir else None
+    if geometry is None:
+        elements, coordinates = read_cad_pts(cad_pts_file_path)
+        geometry = _build_geometry(key, elements, coordinates, grid_size)
+        if geometry_dir:
+            _save_geometry(geometry_dir, geometry)
+
+    with _geometry_lock:
+        _geometries[key] = geometry
+        while len(_geometries) > GEOMETRY_LRU_SIZE:
+            _geometries.popitem(last=False)
+    return geometry
+
+
+def read_cad_pts(cad_pts_file_path):
+    """
+    :param cad_pts_file_path: str, path to the CADPTS.DAT file
+    :return: tuple of numpy.ndarray, (element numbers, (cells x 2) x and y coordinates)
+    """
+    cadPts = np.loadtxt(cad_pts_file_path, ndmin=2, usecols=(0, 1, 2))
+    return cadPts[:, 0].astype(np.int64), cadPts[:, 1:3]
+
+
+def get_grid_boudary(coordinates):
+    "longitude  -> x : larger value"
+    "latitude   -> y : smaller value"
+
+    long_min = 1000000000.0
+    lat_min = 1000000000.0
+    long_max = 0.0
+    lat_max = 0.0
+
+    if len(coordinates):
+        long_min = min(long_min, float(coordinates[:, 0].min()))
+        lat_min = min(lat_min, float(coordinates[:, 1].min()))
+
+        long_max = max(long_max, float(coordinates[:, 0].max()))
+        lat_max = max(lat_max, float(coordinates[:, 1].max()))
+
+    return {
+        'long_min': long_min,
+        'lat_min': lat_min,
+        'long_max': long_max,
+        'lat_max': lat_max
+    }
+
+
+def get_grid_dimensions(boudary, gap=250.0):
+    """
+    :return: tuple of int, (cols, rows)
+    """
+    cols = int(math.ceil((boudary['long_max'] - boudary['long_min']) / gap)) + 1
+    rows = int(math.ceil((boudary['lat_max'] - boudary['lat_min']) / gap)) + 1
+    return cols, rows
+
+
+def get_cell_grid(elements, coordinates, boudary, gap=250.0):
+    """
+    Map the cells to their raster positions.
+    :return: dict of numpy.ndarray, {'elements': sorted element numbers, 'cols': column of each element,
+    'rows': row of each element}
+    """
+    cols, rows = get_grid_dimensions(boudary, gap)
+
+    i = ((coordinates[:, 0] - boudary['long_min']) / gap).astype(np.int64)
+    j = ((coordinates[:, 1] - boudary['lat_min']) / gap).astype(np.int64)
+    # TODO log the cells which fall outside the grid.
+    is_mapped = (i >= 0) | (j >= 0)
+    # When an element is repeated the last position wins.
+    reverse_elements = elements[is_mapped][::-1]
+    cell_elements, first = np.unique(reverse_elements, return_index=True)
+
+    return {
+        'elements': cell_elements,
+        'cols': i[is_mapped][::-1][first],
+        'rows': (rows - j - 1)[is_mapped][::-1][first]
+    }
+
+
+def _build_geometry(key, elements, coordinates, grid_size):
+    boundary = get_grid_boudary(coordinates)
+    cols, rows = get_grid_dimensions(boundary, grid_size)
+    return {
+        'key': key,
+        'boundary': boundary,
+        'cols': cols,
+        'rows': rows,
+        'elements': elements,
+        'coordinates': coordinates,
+        'cell_map': get_cell_grid(elements, coordinates, boundary, gap=grid_size)
+    }
+
+
+def _get_content_hash(cad_pts_file_path):
+    stat = os.stat(cad_pts_file_path)
+    signature = (path.abspath(cad_pts_file_path), stat.st_size, stat.st_mtime_ns)
+    content_hash = _content_hashes.get(signature)
+    if content_hash is None:
+        checksum = hashlib.sha1()
+        with open(cad_pts_file_path, 'rb') as F:
+            for block in iter(lambda: F.read(1024 * 1024), b''):
+                checksum.update(block)
+        content_hash = checksum.hexdigest()
+        _content_hashes[signature] = content_hash
+    return content_hash
+
+
+def _load_geometry(geometry_dir, key):
+    try:
+        with np.load(path.join(geometry_dir, key + '.npz')) as data:
+            boundary = dict(zip(['long_min', 'lat_min', 'long_max', 'lat_max'], data['boundary'].tolist()))
+            return {
+                'key': key,
+                'boundary': boundary,
+                'cols': int(data['dimensions'][0]),
+                'rows': int(data['dimensions'][1]),
+                'elements': data['elements'],
+                'coordinates': data['coordinates'],
+                'cell_map': {'elements': data['cell_elements'], 'cols': data['cell_cols'], 'rows': data['cell_rows']}
+            }
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def _save_geometry(geometry_dir, geometry):
+    if not path.exists(geometry_dir):
+        os.makedirs(geometry_dir)
+    boundary = geometry['boundary']
+    geometry_path = path.join(geometry_dir, geometry['key'] + '.npz')
+    tmp_geometry_path = '%s.%d.tmp.npz' % (geometry_path[:-len('.npz')], os.getpid())
+    try:
+        np.savez(tmp_geometry_path,
+                 boundary=np.array([boundary['long_min'], boundary['lat_min'], boundary['long_max'],
+                                    boundary['lat_max']]),
+                 dimensions=np.array([geometry['cols'], geometry['rows']]),
+                 elements=geometry['elements'],
+                 coordinates=geometry['coordinates'],
+                 cell_elements=geometry['cell_map']['elements'],
+                 cell_cols=geometry['cell_map']['cols'],
+                 cell_rows=geometry['cell_map']['rows'])
+        os.replace(tmp_geometry_path, geometry_path)
+    except (IOError, OSError) as e:
+        print('Error: Unable to save grid geometry. ' + geometry_path, e)
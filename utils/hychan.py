@@ -0,0 +1,196 @@
+import json
+import mmap
+import os
+
+from os import path
+
+from .general import isfloat, get_index_path
+from .metrics import stage, count
+
+ELEMENT_HEADER = b'CHANNEL HYDROGRAPH FOR ELEMENT NO:'
+# Column where the element header starts in HYCHAN.OUT lines.
+ELEMENT_HEADER_COLUMN = 5
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 2
+
+
+def get_hychan_index(hychan_file_path):
+    """
+    Get the element offset index of a HYCHAN.OUT file. The index is built on the first access and persisted with
+    the file, see get_index_path, and it is rebuilt whenever the size or the modified time of the file changes.
+    :param hychan_file_path: str, path to the HYCHAN.OUT file
+    :return: dict, see build_hychan_index
+    """
+    stat = os.stat(hychan_file_path)
+    index_path = get_index_path(hychan_file_path, INDEX_SUFFIX)
+    try:
+        with open(index_path, 'r') as F:
+            index = json.load(F)
+        if index.get('version') == INDEX_VERSION and index['size'] == stat.st_size and \
+                index['mtime'] == stat.st_mtime:
+            return index
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    with stage('hychan_index'):
+        index = build_hychan_index(hychan_file_path)
+    index.update({'version': INDEX_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime})
+    tmp_index_path = '%s.%d.tmp' % (index_path, os.getpid())
+    try:
+        if not path.exists(path.dirname(tmp_index_path)):
+            os.makedirs(path.dirname(tmp_index_path), exist_ok=True)
+        with open(tmp_index_path, 'w') as F:
+            json.dump(index, F)
+        os.replace(tmp_index_path, index_path)
+    except (IOError, OSError):
+        print('Error: Unable to save HYCHAN index. ' + index_path)
+    return index
+
+
+def build_hychan_index(hychan_file_path):
+    """
+    Scan a HYCHAN.OUT file once and record the byte offset of every element header and the layout of the series.
+    The layout is taken from the series of the first element, FLO2D writes the same timesteps for every element.
+    :param hychan_file_path: str, path to the HYCHAN.OUT file
+    :return: dict, {
+        'series_length': int,
+        'series_times': list of float, model time of each row of the series,
+        'row_offset': int, bytes from the start of the element header line to the first row of the series,
+        'row_length': int, bytes of each row when the rows are fixed width, None otherwise,
+        'elements': {element number (str): byte offset of its header line}
+    }
+    """
+    elements = {}
+    series = {'series_length': 0, 'series_times': [], 'row_offset': None, 'row_length': None}
+    with open(hychan_file_path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            series['elements'] = elements
+            return series
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            position = mm.find(ELEMENT_HEADER)
+            while position >= 0:
+                line_start = mm.rfind(b'\n', 0, position) + 1
+                if position - line_start == ELEMENT_HEADER_COLUMN:
+                    line_end = mm.find(b'\n', position)
+                    line = mm[line_start:line_end if line_end >= 0 else len(mm)]
+                    # When an element is repeated in the file the last series wins.
+                    elements[line.split()[5].decode()] = line_start
+                    if len(elements) == 1:
+                        series = _get_series(mm, line_start, line_end + 1 if line_end >= 0 else len(mm))
+                position = mm.find(ELEMENT_HEADER, position + len(ELEMENT_HEADER))
+    series['elements'] = elements
+    return series
+
+
+def read_element_lines(hychan_file_path, offsets, series_length):
+    """
+    Read the series lines of the elements starting at the given header offsets.
+    :param hychan_file_path: str, path to the HYCHAN.OUT file
+    :param offsets: dict, element number -> byte offset of its header line
+    :param series_length: int, number of timesteps in each series
+    :return: generator of (element number, list of series lines) for the elements with a complete series
+    """
+    with open(hychan_file_path, 'rb') as infile:
+        for elementNo, offset in sorted(offsets.items(), key=lambda item: item[1]):
+            with stage('hychan_read'):
+                infile.seek(offset)
+                infile.readline()
+                lines = []
+                for line in infile:
+                    if line.startswith(ELEMENT_HEADER, ELEMENT_HEADER_COLUMN) or len(lines) == series_length:
+                        break
+                    cols = line.split()
+                    if len(cols) > 0 and isfloat(cols[0]):
+                        lines.append(line.decode())
+                count('bytes_read', infile.tell() - offset)
+                count('rows_parsed', len(lines))
+            if series_length and len(lines) == series_length:
+                yield elementNo, lines
+
+
+def read_element_rows(hychan_file_path, hychan_index, offsets, rows):
+    """
+    Read the given rows of the series of the elements. When the rows are fixed width only the bytes from the first to
+    the last given row are read, otherwise an element is read up to its last given row.
+    :param hychan_file_path: str, path to the HYCHAN.OUT file
+    :param hychan_index: dict, index of the file, see get_hychan_index
+    :param offsets: dict, element number -> byte offset of its header line
+    :param rows: list of int, positions of the rows in the series, in order
+    :return: generator of (element number, list of series lines) for the elements which have all the given rows
+    """
+    if not len(rows):
+        return
+    with open(hychan_file_path, 'rb') as infile:
+        for elementNo, offset in sorted(offsets.items(), key=lambda item: item[1]):
+            with stage('hychan_read'):
+                lines = None
+                if hychan_index.get('row_length'):
+                    lines = _read_fixed_rows(infile, offset + hychan_index['row_offset'], hychan_index['row_length'],
+                                             rows, hychan_index['series_times'])
+                if lines is None:
+                    lines = _read_rows(infile, offset, rows)
+                count('rows_parsed', len(lines) if lines else 0)
+            if lines is not None:
+                yield elementNo, lines
+
+
+def _read_fixed_rows(infile, position, row_length, rows, series_times):
+    infile.seek(position + rows[0] * row_length)
+    data = infile.read((rows[-1] - rows[0] + 1) * row_length)
+    count('bytes_read', len(data))
+    lines = []
+    for row in rows:
+        start = (row - rows[0]) * row_length
+        line = data[start:start + row_length]
+        # The rows of this element are not laid out as the ones of the first element, it is read line by line.
+        if len(line) != row_length or not line.endswith(b'\n') or b'\n' in line[:-1]:
+            return None
+        cols = line.split()
+        if not len(cols) or not isfloat(cols[0]) or float(cols[0]) != series_times[row]:
+            return None
+        lines.append(line.decode())
+    return lines
+
+
+def _read_rows(infile, offset, rows):
+    infile.seek(offset)
+    infile.readline()
+    wanted = set(rows)
+    lines = []
+    position = 0
+    for line in infile:
+        if line.startswith(ELEMENT_HEADER, ELEMENT_HEADER_COLUMN) or position > rows[-1]:
+            break
+        cols = line.split()
+        if len(cols) > 0 and isfloat(cols[0]):
+            if position in wanted:
+                lines.append(line.decode())
+            position += 1
+    count('bytes_read', infile.tell() - offset)
+    return lines if position > rows[-1] else None
+
+
+def _get_series(mm, header_start, position):
+    # Read the consecutive time rows which follow the first element header.
+    series_times = []
+    row_starts = []
+    while position < len(mm):
+        line_end = mm.find(b'\n', position)
+        if line_end < 0:
+            line_end = len(mm)
+        cols = mm[position:line_end].split()
+        if len(cols) > 0 and cols[0].replace(b'.', b'', 1).isdigit():
+            series_times.append(float(cols[0]))
+            row_starts.append(position)
+        elif series_times:
+            row_starts.append(position)
+            row_lengths = set(next_start - start for start, next_start in zip(row_starts[:-1], row_starts[1:]))
+            return {
+                'series_length': len(series_times),
+                'series_times': series_times,
+                'row_offset': row_starts[0] - header_start,
+                'row_length': row_lengths.pop() if len(row_lengths) == 1 else None
+            }
+        position = line_end + 1
+    # The series of the first element is not terminated, same as the file not having a complete series.
+    return {'series_length': 0, 'series_times': [], 'row_offset': None, 'row_length': None}
@@ -0,0 +1,226 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+
+from os import path
+
+from .metrics import stage, count
+from .snapshot import link_file, LINK_MODE_HARDLINK
+
+# Bytes copied at once when an upload is not already in the store.
+COPY_CHUNK_SIZE = 1024 * 1024
+# Uploads left behind by an earlier process are removed after this many seconds.
+STALE_UPLOAD_AGE = 24 * 60 * 60
+# Seconds between the sweeps of the stored files no run links to anymore.
+SWEEP_INTERVAL = 60 * 60
+_DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+_input_store = None
+_input_store_lock = threading.Lock()
+
+
+def get_input_store(store_dir, unused_age):
+    """
+    Get the process wide store of the run input files.
+    :param store_dir: str, directory of the store, should be on the same file system as the runs
+    :param unused_age: int, seconds a stored file is kept after the last run linking to it is removed
+    :return: InputStore
+    """
+    global _input_store
+    with _input_store_lock:
+        if _input_store is None:
+            _input_store = InputStore(store_dir, unused_age)
+        return _input_store
+
+
+def is_valid_digest(digest):
+    """
+    :param digest: str
+    :return: boolean, True if the given value is a SHA-256 hex digest
+    """
+    return bool(digest) and _DIGEST_PATTERN.match(digest) is not None
+
+
+class InputStore:
+    """
+    Content addressed store of the run input files. Each distinct file is kept once, as <store_dir>/<first two digest
+    characters>/<SHA-256 digest>, and is hard linked into the input directories of the runs. Uploads are hashed while
+    they are written into the store, so a file is read once whether or not the store already had it.
+    The stored files are shared by the runs, they must not be modified in place. A stored file which is not linked to
+    any run anymore, and was not stored or linked within unused_age, is removed.
+    """
+
+    def __init__(self, store_dir, unused_age):
+        self.store_dir = store_dir
+        self.unused_age = unused_age
+        self.upload_dir = path.join(store_dir, 'uploads')
+        self.lock = threading.Lock()
+        self.swept_at = 0
+        if not path.exists(self.upload_dir):
+            os.makedirs(self.upload_dir)
+        self._remove_stale_uploads()
+        self.remove_unused_blobs()
+
+    def has_blob(self, digest):
+        return is_valid_digest(digest) and path.exists(self.get_blob_path(digest))
+
+    def get_blob_path(self, digest):
+        if not is_valid_digest(digest):
+            raise ValueError('Invalid SHA-256 digest: %s' % digest)
+        return path.join(self.store_dir, digest[:2], digest)
+
+    def new_upload(self):
+        """
+        :return: HashingUpload, a file in the store to write an upload into
+        """
+        return HashingUpload(self.upload_dir)
+
+    def save(self, stream, expected_digest=None):
+        """
+        Add a file to the store.
+        :param stream: HashingUpload of this store, or a readable file object which is copied into the store
+        :param expected_digest: str, SHA-256 the client gave for the file, optional
+        :return: str, SHA-256 hex digest of the file
+        :raise ValueError: if the file does not match the expected digest
+        """
+        upload = stream if isinstance(stream, HashingUpload) and stream.upload_dir == self.upload_dir else None
+        if upload is None:
+            upload = self.new_upload()
+            with stage('input_hash'):
+                stream.seek(0)
+                for block in iter(lambda: stream.read(COPY_CHUNK_SIZE), b''):
+                    upload.write(block)
+        digest = upload.get_digest()
+        if expected_digest and expected_digest.lower() != digest:
+            upload.close()
+            raise ValueError('SHA-256 of the uploaded file is %s, not %s.' % (digest, expected_digest))
+        blob_path = self.get_blob_path(digest)
+        if path.exists(blob_path):
+            # Same content as an earlier upload, only the link is added to the run.
+            upload.close()
+            _touch(blob_path)
+        else:
+            if not path.exists(path.dirname(blob_path)):
+                os.makedirs(path.dirname(blob_path), exist_ok=True)
+            upload.commit(blob_path)
+            count('bytes_uploaded', upload.size)
+        return digest
+
+    def link_blob(self, digest, dst):
+        """
+        Link a stored file into a run directory. The file is copied when it can not be linked.
+        :param digest: str, SHA-256 hex digest of the file
+        :param dst: str, path to link the file to
+        """
+        blob_path = self.get_blob_path(digest)
+        link_file(blob_path, dst, LINK_MODE_HARDLINK)
+        _touch(blob_path)
+        if time.time() - self.swept_at > SWEEP_INTERVAL:
+            self.remove_unused_blobs()
+
+    def remove_unused_blobs(self):
+        """
+        Remove the stored files which have no other link than the one in the store, i.e. the runs which used them were
+        removed, and which were not stored or linked within unused_age.
+        Files copied into a run because they could not be linked also have a single link, they are removed the same
+        way as the run has its own copy.
+        """
+        if not self.lock.acquire(False):
+            # Another thread is sweeping.
+            return
+        try:
+            now = time.time()
+            self.swept_at = now
+            for dir_name in os.listdir(self.store_dir):
+                blob_dir = path.join(self.store_dir, dir_name)
+                if len(dir_name) != 2 or not path.isdir(blob_dir):
+                    continue
+                for digest in os.listdir(blob_dir):
+                    blob_path = path.join(blob_dir, digest)
+                    try:
+                        stat = os.stat(blob_path)
+                        if stat.st_nlink == 1 and now - stat.st_mtime > self.unused_age:
+                            os.remove(blob_path)
+                    except OSError as e:
+                        print('Error: Unable to remove unused input file. ' + blob_path, e)
+        finally:
+            self.lock.release()
+
+    def _remove_stale_uploads(self):
+        now = time.time()
+        for file_name in os.listdir(self.upload_dir):
+            file_path = path.join(self.upload_dir, file_name)
+            try:
+                if now - path.getmtime(file_path) > STALE_UPLOAD_AGE:
+                    os.remove(file_path)
+            except OSError:
+                pass
+
+
+def _touch(file_path):
+    # The modified time of a stored file is the last time it was stored or linked, it is kept that long when unused.
+    try:
+        os.utime(file_path, None)
+    except OSError:
+        pass
+
+
+class HashingUpload:
+    """
+    Writable and readable upload file in the store, which hashes the data as it is written. The file is removed on
+    close unless it was committed into the store.
+    """
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self.file_path = path.join(upload_dir, '%d.%d.%d.upload' % (os.getpid(), threading.get_ident(),
+                                                                    int(time.time() * 1000000)))
+        self.file = open(self.file_path, 'w+b')
+        self.checksum = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def readline(self, *args):
+        return self.file.readline(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def get_digest(self):
+        return self.checksum.hexdigest()
+
+    def commit(self, blob_path):
+        self.file.close()
+        try:
+            os.rename(self.file_path, blob_path)
+        except OSError:
+            # Another request stored the same content at the same time.
+            if not path.exists(blob_path):
+                shutil.move(self.file_path, blob_path)
+            elif path.exists(self.file_path):
+                os.remove(self.file_path)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+        if path.exists(self.file_path):
+            try:
+                os.remove(self.file_path)
+            except OSError as e:
+                print('Error: Unable to remove upload. ' + self.file_path, e)
@@ -0,0 +1,288 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import path
+
+from .extractor import extract_water_levels, extract_water_discharge
+from .preparator import stream_flo2d_waterlevel_grid_asci, stream_flo2d_waterlevel_grid_store, \
+    stream_flo2d_waterlevel_envelope_asci
+from .result_cache import get_output_version
+from .window import TimeWindow
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# Type of each job, and the file name its result is downloaded as.
+JOB_TYPES = {
+    'water-level': 'water_level.json',
+    'water-discharge': 'water_discharge.json',
+    'water-level-grid': 'asci_grid.zip',
+    'water-level-grid-store': 'water_level_grid.zarr.zip',
+    'water-level-envelope': 'water_level_envelope.zip'
+}
+
+# Seconds between the sweeps of the job directory for expired results.
+SWEEP_INTERVAL = 10 * 60
+_JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+
+def get_job_manager(job_dir, processes, max_age):
+    """
+    Get the process wide manager of the extraction jobs.
+    :param job_dir: str, directory of the job results
+    :param processes: int, number of processes running the jobs
+    :param max_age: int, seconds a finished job and its result are kept
+    :return: JobManager
+    """
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(job_dir, processes, max_age)
+        return _job_manager
+
+
+class JobManager:
+    """
+    Runs the long extractions in a bounded pool of local processes, so they do not hold a request thread while they
+    run. A job is identified by its type, its parameters and the version of the run output, so identical requests
+    made while a job is queued, running or done get the same job and share its result.
+    """
+
+    def __init__(self, job_dir, processes, max_age):
+        self.job_dir = job_dir
+        self.processes = max(int(processes), 1)
+        self.max_age = max_age
+        # Reentrant, a job which is already finished calls _finish from submit.
+        self.lock = threading.RLock()
+        self.jobs = {}
+        self.executor = None
+        self.swept_at = 0
+        if not path.exists(self.job_dir):
+            os.makedirs(self.job_dir)
+        self._remove_stale_results(True)
+
+    def submit(self, job_type, run_id, run_path, params):
+        """
+        Submit an extraction job, or get the job of an identical earlier request.
+        :param job_type: str, one of JOB_TYPES
+        :param run_id: str, id of the run
+        :param run_path: str, absolute path to the run resources and configs
+        :param params: dict, json serializable parameters of the job type, see run_job
+        :return: dict, see get_job
+        """
+        job_id = _get_job_id(job_type, run_id, get_output_version(run_path), params)
+        with self.lock:
+            self._remove_expired()
+            job = self.jobs.get(job_id)
+            if job is not None and _get_state(job) != JOB_FAILED:
+                job['requests'] += 1
+                return _to_status(job)
+            job = self._load_finished(job_id)
+            if job is not None:
+                job['requests'] += 1
+                return _to_status(job)
+            result_path = path.join(self.job_dir, job_id)
+            job = {
+                'job_id': job_id,
+                'type': job_type,
+                'run_id': run_id,
+                'requests': 1,
+                'submitted_at': time.time(),
+                'finished_at': None,
+                'result_path': result_path
+            }
+            # The type and run of the job are kept with the result, to serve it after a server restart.
+            with open(result_path + '.json', 'w') as F:
+                json.dump({'type': job_type, 'run_id': run_id, 'submitted_at': job['submitted_at']}, F)
+            job['future'] = self._get_executor().submit(run_job, job_type, run_path, params, result_path)
+            job['future'].add_done_callback(partial(self._finish, job))
+            self.jobs[job_id] = job
+            return _to_status(job)
+
+    def get_job(self, job_id):
+        """
+        :param job_id: str
+        :return: dict, {'job_id', 'type', 'run_id', 'state', 'requests', 'submitted_at', 'finished_at', 'size',
+        'error', 'file_name'}, None if the job is not known
+        """
+        with self.lock:
+            self._remove_expired()
+            job = self.jobs.get(job_id) or self._load_finished(job_id)
+            return _to_status(job) if job is not None else None
+
+    def get_result_path(self, job_id):
+        """
+        :param job_id: str
+        :return: str, path to the result of the job, None unless the job is done
+        """
+        with self.lock:
+            self._remove_expired()
+            job = self.jobs.get(job_id) or self._load_finished(job_id)
+            if job is None or _get_state(job) != JOB_DONE:
+                return None
+            return job['result_path']
+
+    def get_counts(self):
+        """
+        :return: dict, number of the jobs in each state
+        """
+        with self.lock:
+            counts = {JOB_QUEUED: 0, JOB_RUNNING: 0, JOB_DONE: 0, JOB_FAILED: 0}
+            for job in self.jobs.values():
+                counts[_get_state(job)] += 1
+            return counts
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+        return self.executor
+
+    def _finish(self, job, future):
+        with self.lock:
+            job['finished_at'] = time.time()
+            if future.exception() is not None:
+                print('Error: Extraction job failed. ' + job['job_id'], future.exception())
+
+    def _load_finished(self, job_id):
+        # A job finished by an earlier server process, known only by its result in the job directory.
+        if not _JOB_ID_PATTERN.match(job_id):
+            return None
+        result_path = path.join(self.job_dir, job_id)
+        try:
+            with open(result_path + '.json', 'r') as F:
+                meta = json.load(F)
+            finished_at = path.getmtime(result_path)
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - finished_at > self.max_age or meta.get('type') not in JOB_TYPES:
+            return None
+        job = {
+            'job_id': job_id,
+            'type': meta['type'],
+            'run_id': meta['run_id'],
+            'requests': 0,
+            'submitted_at': meta['submitted_at'],
+            'finished_at': finished_at,
+            'result_path': result_path
+        }
+        self.jobs[job_id] = job
+        return job
+
+    def _remove_expired(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job['finished_at'] is None or now - job['finished_at'] <= self.max_age:
+                continue
+            del self.jobs[job_id]
+            for file_path in [job['result_path'], job['result_path'] + '.json']:
+                if path.exists(file_path):
+                    try:
+                        os.remove(file_path)
+                    except OSError as e:
+                        print('Error: Unable to remove job result. ' + file_path, e)
+        if now - self.swept_at > SWEEP_INTERVAL:
+            self._remove_stale_results(False)
+
+    def _remove_stale_results(self, at_start):
+        # Results which are not in the job table, e.g. of an earlier server process, are removed once they expire.
+        # Incomplete results are only removed at start, the jobs of this process may still be writing them.
+        now = time.time()
+        self.swept_at = now
+        for file_name in os.listdir(self.job_dir):
+            file_path = path.join(self.job_dir, file_name)
+            try:
+                if file_name.endswith('.part'):
+                    if at_start:
+                        os.remove(file_path)
+                elif file_name.split('.')[0] not in self.jobs and now - path.getmtime(file_path) > self.max_age:
+                    os.remove(file_path)
+            except OSError:
+                pass
+
+
+def run_job(job_type, run_path, params, result_path):
+    """
+    Run an extraction job, in a process of the job pool.
+    :param job_type: str, one of JOB_TYPES
+    :param run_path: str, absolute path to the run resources and configs
+    :param params: dict, 'window' (TimeWindow as a dict) and the parameters of the job type,
+        water-level: 'channel_cell_map', 'flood_plain_cell_map'
+        water-discharge: 'channel_cell_map'
+        water-level-grid: 'grid_size', 'geometry_dir'
+        water-level-grid-store: 'grid_size', 'geometry_dir', 'chunks', 'crs'
+        water-level-envelope: 'grid_size', 'depth_threshold', 'geometry_dir'
+    :param result_path: str, path to write the result to
+    """
+    window = TimeWindow(**params['window']) if params.get('window') else None
+    if job_type == 'water-level':
+        channel_tms, flood_plain_tms = extract_water_levels(run_path, params['channel_cell_map'],
+                                                            params['flood_plain_cell_map'], window)
+        chunks = [json.dumps({'CHANNELS': channel_tms, 'FLOOD_PLAIN': flood_plain_tms}).encode('utf-8')]
+    elif job_type == 'water-discharge':
+        channel_tms = extract_water_discharge(run_path, params['channel_cell_map'], window)
+        chunks = [json.dumps({'CHANNELS': channel_tms}).encode('utf-8')]
+    elif job_type == 'water-level-grid':
+        # Rendered in the job process, a nested pool of grid processes per job would not be bounded by the job pool.
+        chunks = stream_flo2d_waterlevel_grid_asci(run_path, params['grid_size'], 1, params['geometry_dir'], False,
+                                                   window)
+    elif job_type == 'water-level-grid-store':
+        chunks = stream_flo2d_waterlevel_grid_store(run_path, params['grid_size'], params['geometry_dir'],
+                                                    params['chunks'], params['crs'], False, window)
+    elif job_type == 'water-level-envelope':
+        chunks = stream_flo2d_waterlevel_envelope_asci(run_path, params['grid_size'], params['depth_threshold'],
+                                                       params['geometry_dir'], window)
+    else:
+        raise ValueError('Unknown job type: %s' % job_type)
+
+    # Written aside and moved in place, so a result is never read before it is complete.
+    part_path = '%s.%d.part' % (result_path, os.getpid())
+    try:
+        with open(part_path, 'wb') as part_file:
+            for chunk in chunks:
+                part_file.write(chunk)
+        os.replace(part_path, result_path)
+    finally:
+        if path.exists(part_path):
+            os.remove(part_path)
+
+
+def _get_job_id(job_type, run_id, output_version, params):
+    canonical = json.dumps([job_type, run_id, output_version, params], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def _get_state(job):
+    future = job.get('future')
+    if future is None:
+        return JOB_DONE
+    if future.done():
+        return JOB_FAILED if future.exception() is not None else JOB_DONE
+    return JOB_RUNNING if future.running() else JOB_QUEUED
+
+
+def _to_status(job):
+    state = _get_state(job)
+    error = job['future'].exception() if state == JOB_FAILED else None
+    return {
+        'job_id': job['job_id'],
+        'type': job['type'],
+        'run_id': job['run_id'],
+        'state': state,
+        'requests': job['requests'],
+        'submitted_at': job['submitted_at'],
+        'finished_at': job['finished_at'],
+        'size': path.getsize(job['result_path']) if state == JOB_DONE else None,
+        'error': str(error) if error is not None else None,
+        'file_name': JOB_TYPES[job['type']]
+    }
@@ -0,0 +1,214 @@
+import os
+import sys
+import threading
+import time
+
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from os import path
+
+# Operation label of the work done outside of a request or a model run.
+BACKGROUND_OPERATION = 'background'
+# Counters recorded with count(), with their help text.
+COUNTERS = OrderedDict([
+    ('bytes_read', 'Bytes read from the FLO2D output files.'),
+    ('rows_parsed', 'Rows parsed from the FLO2D output files.'),
+    ('cells_emitted', 'Values written to extraction results and grids.'),
+    ('bytes_archived', 'Bytes of archives sent or written.'),
+    ('bytes_uploaded', 'Bytes of run input files added to the input store.')
+])
+
+_metrics_lock = threading.Lock()
+_stage_seconds = defaultdict(float)
+_stage_calls = defaultdict(int)
+_operation_seconds = defaultdict(float)
+_operation_calls = defaultdict(int)
+_counters = defaultdict(float)
+_gauges = []
+_local = threading.local()
+
+
+def start_trace(operation):
+    """
+    Start recording the stages of a request or a model run in the current thread.
+    :param operation: str, e.g. the endpoint of the request or 'model_run'
+    :return: dict, the trace
+    """
+    trace = {'operation': operation, 'start': time.time(), 'stages': OrderedDict(), 'counters': defaultdict(float)}
+    _local.trace = trace
+    return trace
+
+
+def get_trace():
+    """
+    :return: dict, the trace recorded in the current thread, None if no trace was started
+    """
+    return getattr(_local, 'trace', None)
+
+
+def end_trace(status='ok'):
+    """
+    Stop recording the current trace and add its duration to the metrics.
+    :param status: str, outcome of the operation e.g. the HTTP status code
+    :return: dict, the trace, None if no trace was started
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return None
+    _local.trace = None
+    trace['seconds'] = time.time() - trace['start']
+    with _metrics_lock:
+        _operation_seconds[(trace['operation'], str(status))] += trace['seconds']
+        _operation_calls[(trace['operation'], str(status))] += 1
+    return trace
+
+
+@contextmanager
+def trace(operation):
+    start_trace(operation)
+    status = 'ok'
+    try:
+        yield
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        end_trace(status)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the current request or model run.
+    :param name: str, e.g. 'timdep_parse'
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        trace = getattr(_local, 'trace', None)
+        operation = trace['operation'] if trace is not None else BACKGROUND_OPERATION
+        if trace is not None:
+            trace['stages'][name] = trace['stages'].get(name, 0.0) + seconds
+        with _metrics_lock:
+            _stage_seconds[(operation, name)] += seconds
+            _stage_calls[(operation, name)] += 1
+
+
+def count(name, value=1):
+    """
+    Add to a counter of the current request or model run.
+    :param name: str, one of COUNTERS
+    :param value: int, amount to add
+    """
+    trace = getattr(_local, 'trace', None)
+    operation = trace['operation'] if trace is not None else BACKGROUND_OPERATION
+    if trace is not None:
+        trace['counters'][name] += value
+    with _metrics_lock:
+        _counters[(name, operation)] += value
+
+
+def register_gauge(name, help_text, get_value):
+    """
+    Add a value which is read when the metrics are rendered, e.g. the size of a cache.
+    :param name: str, metric name
+    :param help_text: str
+    :param get_value: function, returns the current value
+    """
+    with _metrics_lock:
+        _gauges.append((name, help_text, get_value))
+
+
+def format_stages(trace):
+    """
+    :param trace: dict
+    :return: str, stage timings of the trace in the Server-Timing header format
+    """
+    if not trace:
+        return ''
+    return ', '.join('%s;dur=%.1f' % (name, seconds * 1000.0) for name, seconds in trace['stages'].items())
+
+
+def render_metrics():
+    """
+    :return: str, the metrics in the Prometheus text exposition format
+    """
+    lines = []
+    with _metrics_lock:
+        _render(lines, 'flo2d_operation_seconds_total', 'Time spent on requests and model runs.', 'counter',
+                _operation_seconds, ('operation', 'status'))
+        _render(lines, 'flo2d_operations_total', 'Number of requests and model runs.', 'counter',
+                _operation_calls, ('operation', 'status'))
+        _render(lines, 'flo2d_stage_seconds_total', 'Time spent in each stage of the requests and model runs.',
+                'counter', _stage_seconds, ('operation', 'stage'))
+        _render(lines, 'flo2d_stage_calls_total', 'Number of times each stage ran.', 'counter',
+                _stage_calls, ('operation', 'stage'))
+        for name, help_text in COUNTERS.items():
+            values = {(operation,): value for (counter, operation), value in _counters.items() if counter == name}
+            _render(lines, 'flo2d_%s_total' % name, help_text, 'counter', values, ('operation',))
+        gauges = list(_gauges)
+    for name, help_text, get_value in gauges:
+        try:
+            value = get_value()
+        except Exception as e:
+            print('Error: Reading metric. ' + name, e)
+            continue
+        _render(lines, name, help_text, 'gauge', {(): value}, ())
+    return '\n'.join(lines) + '\n'
+
+
+def _render(lines, name, help_text, metric_type, values, label_names):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s %s' % (name, metric_type))
+    for labels, value in sorted(values.items()):
+        if label_names:
+            label_text = ','.join('%s="%s"' % (label, _escape(value_)) for label, value_ in zip(label_names, labels))
+            lines.append('%s{%s} %s' % (name, label_text, repr(float(value))))
+        else:
+            lines.append('%s %s' % (name, repr(float(value))))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class SampledProfiler:
+    """
+    Samples the stack of a thread at a fixed interval. The samples are written in the folded stack format, which
+    flame graph tools read.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._sample, name='flo2d-profiler')
+        self.thread.daemon = True  # Daemonize thread
+        self.thread.start()
+
+    def stop(self, folded_file_path):
+        self.stopped.set()
+        self.thread.join()
+        profile_dir = path.dirname(folded_file_path)
+        if profile_dir and not path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        with open(folded_file_path, 'w') as F:
+            for stack, samples in sorted(self.samples.items(), key=lambda item: -item[1]):
+                F.write('%s %d\n' % (stack, samples))
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
@@ -0,0 +1,162 @@
+import json
+import os
+import shutil
+
+from os import path
+
+import numpy as np
+
+from .hychan import get_hychan_index, read_element_lines
+from .timdep import read_timdep, get_timdep_tokens
+
+CACHE_DIR = 'cache'
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+SOURCE_FILES = ['TIMDEP.OUT', 'HYCHAN.OUT', 'CADPTS.DAT']
+
+
+def build_output_cache(run_path):
+    """
+    Convert the text outputs of a finished run into memory-mappable arrays under <run_path>/cache.
+    Values which the extract endpoints return verbatim (water levels and discharges) are kept as their text tokens so
+    the responses stay the same as the ones from the text parsers.
+    Arrays written,
+        timdep_times: (timesteps) model time in hours
+        timdep_elements: (cells) element numbers, same for every timestep
+        timdep_depth: (timesteps x cells) flood depth
+        timdep_elevation: (timesteps x cells) flood level text tokens
+        hychan_times: (channels x timesteps) model time in hours
+        hychan_stage: (channels x timesteps) channel water level text tokens
+        hychan_discharge: (channels x timesteps) channel discharge text tokens
+        cadpts_elements: (cells) element numbers
+        cadpts_coordinates: (cells x 2) x and y coordinates
+    :param run_path: str, absolute path to the run resources and configs
+    :return: dict, the cache manifest
+    """
+    output_dir = path.join(run_path, 'output')
+    cache_dir = path.join(run_path, CACHE_DIR)
+    tmp_cache_dir = '%s.%d.tmp' % (cache_dir, os.getpid())
+    if path.exists(tmp_cache_dir):
+        shutil.rmtree(tmp_cache_dir)
+    os.makedirs(tmp_cache_dir)
+
+    manifest = {'version': MANIFEST_VERSION, 'sources': {}, 'arrays': {}, 'hychan_elements': []}
+    for source in SOURCE_FILES:
+        source_path = path.join(output_dir, source)
+        if path.exists(source_path):
+            stat = os.stat(source_path)
+            manifest['sources'][source] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    if 'TIMDEP.OUT' in manifest['sources']:
+        _cache_timdep(path.join(output_dir, 'TIMDEP.OUT'), tmp_cache_dir, manifest)
+    if 'HYCHAN.OUT' in manifest['sources']:
+        _cache_hychan(path.join(output_dir, 'HYCHAN.OUT'), tmp_cache_dir, manifest)
+    if 'CADPTS.DAT' in manifest['sources']:
+        _cache_cadpts(path.join(output_dir, 'CADPTS.DAT'), tmp_cache_dir, manifest)
+
+    with open(path.join(tmp_cache_dir, MANIFEST_FILE), 'w') as F:
+        json.dump(manifest, F)
+    if path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_cache_dir, cache_dir)
+    return manifest
+
+
+def load_output_cache(run_path):
+    """
+    Open the cached arrays of a run as read only memory maps.
+    :param run_path: str, absolute path to the run resources and configs
+    :return: dict, array name -> numpy.memmap, plus 'hychan_elements'. None if there is no cache or if the outputs
+    changed after the cache was built.
+    """
+    cache_dir = path.join(run_path, CACHE_DIR)
+    try:
+        with open(path.join(cache_dir, MANIFEST_FILE), 'r') as F:
+            manifest = json.load(F)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    for source, source_stat in manifest['sources'].items():
+        try:
+            stat = os.stat(path.join(run_path, 'output', source))
+        except OSError:
+            return None
+        if stat.st_size != source_stat['size'] or stat.st_mtime != source_stat['mtime']:
+            return None
+
+    cache = {'hychan_elements': manifest['hychan_elements']}
+    for name, array in manifest['arrays'].items():
+        shape = tuple(array['shape'])
+        if 0 in shape:
+            cache[name] = np.zeros(shape, dtype=array['dtype'])
+        else:
+            cache[name] = np.memmap(path.join(cache_dir, array['file']), dtype=array['dtype'], mode='r', shape=shape)
+    return cache
+
+
+def _cache_timdep(timdep_file_path, cache_dir, manifest):
+    times = []
+    elements = None
+    with open(path.join(cache_dir, 'timdep_depth.bin'), 'wb') as depth_file, \
+            open(path.join(cache_dir, 'timdep_elevation.bin'), 'wb') as elevation_file:
+        width = None
+        for step in read_timdep(timdep_file_path):
+            step_elements = step.values[:, 0].astype(np.int64) if len(step.values) else np.zeros(0, dtype=np.int64)
+            if elements is None:
+                elements = step_elements
+            elif not np.array_equal(elements, step_elements):
+                print('Warning: TIMDEP.OUT timesteps have different cells, skip caching it.')
+                return
+            if not len(elements):
+                times.append(step.model_time)
+                continue
+            elevation = get_timdep_tokens(step, 5)
+            if width is None:
+                width = elevation.dtype.itemsize
+            elif elevation.dtype.itemsize > width:
+                print('Warning: TIMDEP.OUT water levels are not fixed width, skip caching it.')
+                return
+            times.append(step.model_time)
+            np.ascontiguousarray(step.values[:, 1], dtype='<f8').tofile(depth_file)
+            elevation.astype('S%d' % width).tofile(elevation_file)
+    if elements is None:
+        elements = np.zeros(0, dtype=np.int64)
+    _save_array(cache_dir, manifest, 'timdep_times', np.array(times, dtype='<f8'))
+    _save_array(cache_dir, manifest, 'timdep_elements', elements.astype('<i8'))
+    _add_array(manifest, 'timdep_depth', '<f8', (len(times), len(elements)))
+    _add_array(manifest, 'timdep_elevation', 'S%d' % (width or 1), (len(times), len(elements)))
+
+
+def _cache_hychan(hychan_file_path, cache_dir, manifest):
+    hychan_index = get_hychan_index(hychan_file_path)
+    series_length = hychan_index['series_length']
+    elements, times, stages, discharges = [], [], [], []
+    for elementNo, lines in read_element_lines(hychan_file_path, hychan_index['elements'], series_length):
+        rows = [line.split() for line in lines]
+        elements.append(elementNo)
+        times.append([float(v[0]) for v in rows])
+        stages.append([v[1] if len(v) > 1 else '' for v in rows])
+        discharges.append([v[4] if len(v) > 4 else '' for v in rows])
+    shape = (len(elements), series_length)
+    manifest['hychan_elements'] = elements
+    _save_array(cache_dir, manifest, 'hychan_times', np.array(times, dtype='<f8').reshape(shape))
+    _save_array(cache_dir, manifest, 'hychan_stage', np.array(stages, dtype='S').reshape(shape))
+    _save_array(cache_dir, manifest, 'hychan_discharge', np.array(discharges, dtype='S').reshape(shape))
+
+
+def _cache_cadpts(cad_pts_file_path, cache_dir, manifest):
+    points = np.loadtxt(cad_pts_file_path, ndmin=2)
+    if not len(points):
+        points = np.zeros((0, 3))
+    _save_array(cache_dir, manifest, 'cadpts_elements', points[:, 0].astype('<i8'))
+    _save_array(cache_dir, manifest, 'cadpts_coordinates', np.ascontiguousarray(points[:, 1:3], dtype='<f8'))
+
+
+def _save_array(cache_dir, manifest, name, array):
+    array.tofile(path.join(cache_dir, name + '.bin'))
+    _add_array(manifest, name, array.dtype.str, array.shape)
+
+
+def _add_array(manifest, name, dtype, shape):
+    manifest['arrays'][name] = {'file': name + '.bin', 'dtype': dtype, 'shape': list(shape)}
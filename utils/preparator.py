@@ -1,26 +1,61 @@
 import json
+import zipfile
 
 from shutil import make_archive
 from distutils.dir_util import copy_tree
 from os import path
 
 from .general import create_dir, get_run_date_times
-from .asci_extractor import extract_water_level_grid
-
-
-def prepare_flo2d_run(run_path, model_template_path, flo2d_lib_path):
-    # create a directory for the model run.
+from .metrics import stage, count
+from .asci_extractor import extract_water_level_grid, iter_water_level_grids, iter_water_level_grid_store, \
+    extract_water_level_envelopes
+from .archiver import stream_zip, get_dir_entries
+from .snapshot import get_template_snapshot, link_tree, LINK_MODE_COPY
+
+
+def prepare_flo2d_run(run_path, model_template_path, flo2d_lib_path, snapshot_root=None, link_mode=LINK_MODE_COPY,
+                      run_dir_pool=None):
+    """
+    Prepare the model directory of a run with the FLO2D libraries, the model template and the run inputs.
+    :param run_path: str, absolute path to the run resources and configs
+    :param model_template_path: str, path to the model template directory
+    :param flo2d_lib_path: str, path to the FLO2D libraries directory
+    :param snapshot_root: str, directory to keep the verified template snapshots in. Required unless link_mode is copy.
+    :param link_mode: str, 'copy' to copy the template and libraries, 'hardlink' or 'reflink' to link them from the
+    template snapshot. Run inputs are always copied.
+    :param run_dir_pool: RunDirPool, pool of model directories already prepared with the same template and libraries,
+    optional. The model directory is only prepared here when the pool has none ready.
+    """
     model_path = path.join(run_path, 'model')
-    create_dir(model_path)
-
-    # copy flo2d library files to model run directory.
-    copy_tree(flo2d_lib_path, model_path)
-
-    # copy model template to model run directory.
-    copy_tree(model_template_path, model_path)
+    if run_dir_pool is None or not run_dir_pool.claim(model_path):
+        # create a directory for the model run.
+        create_dir(model_path)
+        prepare_flo2d_model_dir(model_path, model_template_path, flo2d_lib_path, snapshot_root, link_mode)
 
     # copy the model input files to model run directory
-    copy_tree(path.join(run_path, 'input'), model_path)
+    link_tree(path.join(run_path, 'input'), model_path, LINK_MODE_COPY)
+
+
+def prepare_flo2d_model_dir(model_path, model_template_path, flo2d_lib_path, snapshot_root=None,
+                            link_mode=LINK_MODE_COPY):
+    """
+    Place the FLO2D libraries and the model template in an empty model directory.
+    :param model_path: str, path to the model directory
+    :param model_template_path: str, path to the model template directory
+    :param flo2d_lib_path: str, path to the FLO2D libraries directory
+    :param snapshot_root: str, directory to keep the verified template snapshots in. Required unless link_mode is copy.
+    :param link_mode: str, see prepare_flo2d_run
+    """
+    if link_mode == LINK_MODE_COPY:
+        # copy flo2d library files to model run directory.
+        copy_tree(flo2d_lib_path, model_path)
+
+        # copy model template to model run directory.
+        copy_tree(model_template_path, model_path)
+    else:
+        # link the read only library and template files from the snapshot to model run directory.
+        snapshot_path = get_template_snapshot(snapshot_root, [flo2d_lib_path, model_template_path])
+        link_tree(snapshot_path, model_path, link_mode)
 
 
 def prepare_flo2d_output(run_path):
@@ -35,13 +70,15 @@ def prepare_flo2d_output(run_path):
     # Check whether the output is ready. If ready, archive and return the .zip, otherwise return None.
     output_dir = path.join(run_path, 'output')
     if path.exists(output_dir):
-        make_archive(path.join(run_path, output_base), 'zip', output_dir)
+        with stage('archive'):
+            make_archive(path.join(run_path, output_base), 'zip', output_dir)
+        count('bytes_archived', path.getsize(output_zip_abs_path))
         return output_zip
 
     return None
 
 
-def prepare_flo2d_waterlevel_grid_asci(run_path, grid_size):
+def prepare_flo2d_waterlevel_grid_asci(run_path, grid_size, processes=1, geometry_dir=None):
     asci_grid_zip = 'asci_grid.zip'
     # Check whether asci_grid.zip is already created, if so just return the asci_grid_zip
     if path.exists(path.join(run_path, asci_grid_zip)):
@@ -51,12 +88,87 @@ def prepare_flo2d_waterlevel_grid_asci(run_path, grid_size):
     create_dir(asci_grid_dir)
 
     base_dt, run_dt = get_run_date_times(run_path)
-    extract_water_level_grid(run_path, grid_size, base_dt, run_dt, asci_grid_dir)
+    extract_water_level_grid(run_path, grid_size, base_dt, run_dt, asci_grid_dir, processes, geometry_dir)
 
-    make_archive(asci_grid_dir, 'zip', asci_grid_dir)
+    with stage('archive'):
+        make_archive(asci_grid_dir, 'zip', asci_grid_dir)
+    count('bytes_archived', path.getsize(path.join(run_path, asci_grid_zip)))
     return asci_grid_zip
 
 
+def stream_flo2d_output(run_path, cache=True):
+    """
+    Stream output.zip of a finished run while it is being compressed.
+    :param run_path: str, absolute path to the run resources and configs
+    :param cache: bool, keep the streamed archive as <run_path>/output.zip for repeat downloads
+    :return: generator of bytes
+    """
+    output_zip_abs_path = path.join(run_path, 'output.zip') if cache else None
+    return stream_zip(get_dir_entries(path.join(run_path, 'output')), output_zip_abs_path)
+
+
+def stream_flo2d_waterlevel_grid_asci(run_path, grid_size, processes=1, geometry_dir=None, cache=True, window=None):
+    """
+    Stream asci_grid.zip of a finished run. Each grid is rendered and compressed as it is sent, without writing the
+    grids to disk.
+    :param run_path: str, absolute path to the run resources and configs
+    :param grid_size: float, size of a grid cell
+    :param processes: int, number of processes rendering the grids
+    :param geometry_dir: str, directory of the shared grid geometries, optional
+    :param cache: bool, keep the streamed archive as <run_path>/asci_grid.zip for repeat downloads
+    :param window: TimeWindow, timesteps to export, optional. Archives of a time window are not kept.
+    :return: generator of bytes
+    """
+    asci_grid_zip_abs_path = path.join(run_path, 'asci_grid.zip') if cache and window is None else None
+    base_dt, run_dt = get_run_date_times(run_path)
+    grids = iter_water_level_grids(run_path, grid_size, base_dt, run_dt, processes, geometry_dir, window)
+    entries = ((fileName, EsriGrid.encode('ascii')) for fileName, EsriGrid in grids)
+    return stream_zip(entries, asci_grid_zip_abs_path)
+
+
+def stream_flo2d_waterlevel_grid_store(run_path, grid_size, geometry_dir=None, chunks=None, crs=None, cache=True,
+                                       window=None):
+    """
+    Stream water_level_grid.zarr.zip of a finished run, all the water level grids of the run as one chunked time x
+    rows x cols array, see iter_water_level_grid_store. The chunks are already compressed, so they are stored in the
+    zip as is.
+    :param run_path: str, absolute path to the run resources and configs
+    :param grid_size: float, size of a grid cell
+    :param geometry_dir: str, directory of the shared grid geometries, optional
+    :param chunks: tuple of int, (time, rows, cols) shape of a chunk, optional
+    :param crs: str, coordinate reference system of the grids, optional
+    :param cache: bool, keep the streamed archive as <run_path>/water_level_grid.zarr.zip for repeat downloads
+    :param window: TimeWindow, timesteps to export, optional. Archives of a time window are not kept.
+    :return: generator of bytes
+    """
+    grid_store_zip_abs_path = path.join(run_path, 'water_level_grid.zarr.zip') if cache and window is None else None
+    base_dt, run_dt = get_run_date_times(run_path)
+    kwargs = {'chunks': tuple(chunks)} if chunks else {}
+    entries = iter_water_level_grid_store(run_path, grid_size, base_dt, run_dt, geometry_dir, crs=crs, window=window,
+                                          **kwargs)
+    return stream_zip(entries, grid_store_zip_abs_path, compression=zipfile.ZIP_STORED)
+
+
+def stream_flo2d_waterlevel_envelope_asci(run_path, grid_size, depth_threshold=0.3, geometry_dir=None, window=None):
+    """
+    Stream a zip of the flood hazard rasters of a finished run, see extract_water_level_envelopes.
+    :param run_path: str, absolute path to the run resources and configs
+    :param grid_size: float, size of a grid cell
+    :param depth_threshold: float, depth a cell is counted as flooded at
+    :param geometry_dir: str, directory of the shared grid geometries, optional
+    :param window: TimeWindow, timesteps to reduce, optional
+    :return: generator of bytes
+    """
+    base_dt, run_dt = get_run_date_times(run_path)
+
+    def get_entries():
+        for fileName, EsriGrid in extract_water_level_envelopes(run_path, grid_size, base_dt, run_dt,
+                                                                 depth_threshold, geometry_dir, window):
+            yield fileName, EsriGrid.encode('ascii')
+
+    return stream_zip(get_entries())
+
+
 def prepare_flo2d_run_config(input_path, run_name, base_dt, run_dt):
     run_config = {
         'run-name': run_name,
@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import threading
+
+from os import path
+
+from constants import RUN_STATE_INITIALIZED, RUN_STATE_QUEUED, RUN_STATE_RUNNING, RUN_STATE_FINISHED, RUN_STATE_FAILED
+from .general import get_current_date_time
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        run_id TEXT PRIMARY KEY,
+        run_path TEXT NOT NULL,
+        state TEXT NOT NULL,
+        output_ready INTEGER NOT NULL DEFAULT 0,
+        input_size INTEGER,
+        output_size INTEGER,
+        artifacts_size INTEGER,
+        created_at TEXT NOT NULL,
+        queued_at TEXT,
+        started_at TEXT,
+        finished_at TEXT,
+        updated_at TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS run_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_id TEXT NOT NULL,
+        state TEXT NOT NULL,
+        at TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS run_events_run_id ON run_events (run_id)'
+]
+
+# Timestamp column updated when a run moves to the state.
+_STATE_TIMESTAMPS = {
+    RUN_STATE_QUEUED: 'queued_at',
+    RUN_STATE_RUNNING: 'started_at',
+    RUN_STATE_FINISHED: 'finished_at',
+    RUN_STATE_FAILED: 'finished_at'
+}
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_run_registry(db_path):
+    """
+    Get the process wide run registry.
+    :param db_path: str, path to the SQLite database file
+    :return: RunRegistry
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = RunRegistry(db_path)
+        return _registry
+
+
+class RunRegistry:
+    """
+    Local SQLite (WAL) store of the model runs, their state transitions, timings and the sizes of their inputs,
+    outputs and derived artifacts.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        db_dir = path.dirname(db_path)
+        if db_dir and not path.exists(db_dir):
+            os.makedirs(db_dir)
+        connection = self._connect()
+        with connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+
+    def register_run(self, run_id, run_path, input_size=None):
+        """
+        Add a run in the Initialized state, or reset it if the run_id is already registered.
+        """
+        now = get_current_date_time()
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO runs (run_id, run_path, state, output_ready, input_size, created_at, '
+                'updated_at) VALUES (?, ?, ?, 0, ?, ?, ?)',
+                (run_id, run_path, RUN_STATE_INITIALIZED, input_size, now, now))
+            connection.execute('INSERT INTO run_events (run_id, state, at) VALUES (?, ?, ?)',
+                               (run_id, RUN_STATE_INITIALIZED, now))
+
+    def set_state(self, run_id, state, run_path=None):
+        """
+        Move a run to the given state. An unregistered run is registered with the given run_path.
+        Output readiness is reset when the run starts again.
+        """
+        now = get_current_date_time()
+        columns = ['state = ?', 'updated_at = ?']
+        values = [state, now]
+        if state in _STATE_TIMESTAMPS:
+            columns.append('%s = ?' % _STATE_TIMESTAMPS[state])
+            values.append(now)
+        if state == RUN_STATE_RUNNING:
+            columns.extend(['output_ready = 0', 'finished_at = NULL'])
+        with self._connect() as connection:
+            if run_path is not None:
+                connection.execute(
+                    'INSERT OR IGNORE INTO runs (run_id, run_path, state, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?)', (run_id, run_path, state, now, now))
+            connection.execute('UPDATE runs SET %s WHERE run_id = ?' % ', '.join(columns), values + [run_id])
+            connection.execute('INSERT INTO run_events (run_id, state, at) VALUES (?, ?, ?)', (run_id, state, now))
+
+    def set_output_ready(self, run_id, output_size=None, artifacts_size=None):
+        """
+        Mark the outputs of a run as completely collected and safe to read.
+        """
+        with self._connect() as connection:
+            connection.execute('UPDATE runs SET output_ready = 1, output_size = ?, artifacts_size = ?, '
+                               'updated_at = ? WHERE run_id = ?',
+                               (output_size, artifacts_size, get_current_date_time(), run_id))
+
+    def set_artifacts_size(self, run_id, artifacts_size):
+        with self._connect() as connection:
+            connection.execute('UPDATE runs SET artifacts_size = ?, updated_at = ? WHERE run_id = ?',
+                               (artifacts_size, get_current_date_time(), run_id))
+
+    def get_run(self, run_id):
+        """
+        :param run_id: str, id of the run
+        :return: dict of the run columns, None if the run is not registered
+        """
+        row = self._connect().execute('SELECT * FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_run_events(self, run_id):
+        rows = self._connect().execute('SELECT state, at FROM run_events WHERE run_id = ? ORDER BY id',
+                                       (run_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def _connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
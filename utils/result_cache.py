@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from glob import glob
+from os import path
+
+from .collector import get_output_manifest
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache(cache_dir, max_memory_size, max_disk_size):
+    """
+    Get the process wide extraction result cache.
+    :param cache_dir: str, directory of the disk tier
+    :param max_memory_size: int, bytes of serialized results kept in memory
+    :param max_disk_size: int, bytes of serialized results kept in cache_dir, 0 to not use the disk tier
+    :return: ResultCache
+    """
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(cache_dir, max_memory_size, max_disk_size)
+        return _result_cache
+
+
+class ResultCache:
+    """
+    Two tier LRU cache of extraction results. Results are keyed by the run, the type of the extraction and a canonical
+    hash of the requested cell map, and are tagged with the version of the run output they were extracted from. A
+    result of an older output version is never returned.
+    """
+
+    def __init__(self, cache_dir, max_memory_size, max_disk_size):
+        self.cache_dir = cache_dir
+        self.max_memory_size = max_memory_size
+        self.max_disk_size = max_disk_size
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.disk_size = 0
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        if self.max_disk_size:
+            if not path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.disk_size = sum(path.getsize(file_path) for file_path in glob(path.join(self.cache_dir, '*.json')))
+
+    def get_or_extract(self, run_id, run_path, extract_type, cell_map, extract, options=None):
+        """
+        Get the cached result of an extraction, running the extraction on a miss.
+        :param run_id: str, id of the run
+        :param run_path: str, absolute path to the run resources and configs
+        :param extract_type: str, e.g. 'water-level'
+        :param cell_map: dict, the requested cell map
+        :param extract: function, called without arguments to extract the result on a miss
+        :param options: dict, other parameters of the extraction which change the result e.g. the time window, optional
+        :return: result of the extraction
+        """
+        key = _get_key(run_id, extract_type, cell_map, options)
+        version = get_output_version(run_path)
+        result = self._get(key, version)
+        if result is not None:
+            return result
+        result = extract()
+        self._put(key, version, result)
+        return result
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({'memory_entries': len(self.memory), 'memory_size': self.memory_size,
+                          'disk_size': self.disk_size})
+            return stats
+
+    def _get(self, key, version):
+        # Both tiers keep the serialized result, so the memory limit is the size actually held.
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] == version:
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                content = entry[1]
+            else:
+                content = None
+        if content is not None:
+            return json.loads(content.decode('utf-8'))
+
+        content = self._read_disk(key, version)
+        if content is not None:
+            self._put_memory(key, version, content)
+            with self.lock:
+                self.counters['disk_hits'] += 1
+            return json.loads(content.decode('utf-8'))
+
+        with self.lock:
+            self.counters['misses'] += 1
+        return None
+
+    def _put(self, key, version, result):
+        content = json.dumps(result, separators=(',', ':')).encode('utf-8')
+        self._put_memory(key, version, content)
+        if self.max_disk_size:
+            self._write_disk(key, version, content)
+
+    def _put_memory(self, key, version, content):
+        with self.lock:
+            previous = self.memory.pop(key, None)
+            if previous is not None:
+                self.memory_size -= len(previous[1])
+            if len(content) > self.max_memory_size:
+                return
+            self.memory[key] = (version, content)
+            self.memory_size += len(content)
+            while self.memory_size > self.max_memory_size:
+                evicted_key, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted[1])
+                self.counters['evictions'] += 1
+
+    def _read_disk(self, key, version):
+        # An entry is the output version on the first line followed by the serialized result.
+        if not self.max_disk_size:
+            return None
+        file_path = path.join(self.cache_dir, key + '.json')
+        try:
+            with open(file_path, 'rb') as F:
+                if F.readline().rstrip(b'\n') != version.encode('utf-8'):
+                    return None
+                content = F.read()
+            # The modified time of an entry is its last use, the least recently used entries are evicted first.
+            os.utime(file_path)
+            return content
+        except (IOError, OSError):
+            return None
+
+    def _write_disk(self, key, version, content):
+        file_path = path.join(self.cache_dir, key + '.json')
+        tmp_file_path = '%s.%d.%d.tmp' % (file_path, os.getpid(), threading.get_ident())
+        header = version.encode('utf-8') + b'\n'
+        try:
+            previous_size = path.getsize(file_path) if path.exists(file_path) else 0
+            with open(tmp_file_path, 'wb') as F:
+                F.write(header)
+                F.write(content)
+            os.replace(tmp_file_path, file_path)
+        except (IOError, OSError) as e:
+            print('Error: Unable to cache extraction result. ' + file_path, e)
+            return
+        with self.lock:
+            self.disk_size += len(header) + len(content) - previous_size
+            if self.disk_size > self.max_disk_size:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for file_path in glob(path.join(self.cache_dir, '*.json')):
+            try:
+                stat = os.stat(file_path)
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+            except OSError:
+                pass
+        self.disk_size = sum(entry[1] for entry in entries)
+        for mtime, size, file_path in sorted(entries):
+            if self.disk_size <= self.max_disk_size:
+                break
+            try:
+                os.remove(file_path)
+                self.disk_size -= size
+                self.counters['evictions'] += 1
+            except OSError:
+                pass
+
+
+def _get_key(run_id, extract_type, cell_map, options=None):
+    # Canonical form of the cell map, the same map always gives the same key whatever the order of its entries.
+    canonical = json.dumps([run_id, extract_type, cell_map] + ([options] if options else []), sort_keys=True,
+                           separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def get_output_version(run_path):
+    """
+    Version of the output of a run. Changes whenever the output is collected again.
+    :param run_path: str, absolute path to the run resources and configs
+    :return: str
+    """
+    manifest = get_output_manifest(run_path)
+    if manifest is None:
+        # Output collected before the manifest was written, fall back to the sizes and modified times.
+        files = []
+        for file_path in sorted(glob(path.join(run_path, 'output', '*.OUT')) +
+                                glob(path.join(run_path, 'output', '*.DAT'))):
+            stat = os.stat(file_path)
+            files.append([path.basename(file_path), stat.st_size, stat.st_mtime_ns])
+        manifest = {'files': files}
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
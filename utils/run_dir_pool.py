@@ -0,0 +1,177 @@
+import os
+import shutil
+import threading
+
+from os import path
+
+from .metrics import stage
+from .snapshot import get_template_version, add_rebuild_listener
+
+# Seconds between the checks of the template for changes while the pool is full.
+TEMPLATE_CHECK_INTERVAL = 60
+TRASH_DIR = 'trash'
+
+_run_dir_pool = None
+_run_dir_pool_lock = threading.Lock()
+
+
+def get_run_dir_pool(pool_dir, size, source_dirs, prepare_model_dir):
+    """
+    Get the process wide pool of prepared model directories, the pool is created and starts filling on the first call.
+    :param pool_dir: str, directory to keep the prepared model directories in, must be on the same file system as the
+    runs
+    :param size: int, number of model directories kept ready
+    :param source_dirs: list of str, directories the model directories are prepared from, e.g. [FLO2D_LIBS_DIR,
+    MODEL_250M_TEMPLATE_DIR]. The pool is rebuilt when any of their files changes.
+    :param prepare_model_dir: function, called with the path of an empty model directory to prepare it
+    :return: RunDirPool
+    """
+    global _run_dir_pool
+    with _run_dir_pool_lock:
+        if _run_dir_pool is None:
+            _run_dir_pool = RunDirPool(pool_dir, size, source_dirs, prepare_model_dir)
+            _run_dir_pool.start()
+        return _run_dir_pool
+
+
+class RunDirPool:
+    """
+    Keeps a number of model directories prepared with the FLO2D libraries and the model template, so a run only moves
+    one into place and adds its inputs before FLOPRO starts. A background thread refills the pool after each claim,
+    removes the old model directories the claims replaced, and rebuilds the pool when the template changes or its
+    snapshot is found modified. The prepared directories are named <template version>.<number>, directories of an
+    earlier server process are reused while the template is the same.
+    """
+
+    def __init__(self, pool_dir, size, source_dirs, prepare_model_dir):
+        self.pool_dir = pool_dir
+        self.size = max(int(size), 0)
+        self.source_dirs = source_dirs
+        self.prepare_model_dir = prepare_model_dir
+        self.trash_dir = path.join(pool_dir, TRASH_DIR)
+        self.condition = threading.Condition()
+        self.ready = []
+        # Ready directories moved out by claims which are still renaming them.
+        self.claiming = set()
+        # Incremented when the ready directories are dropped, a directory built before is not added.
+        self.generation = 0
+        self.seq = 0
+        if not path.exists(self.trash_dir):
+            os.makedirs(self.trash_dir)
+
+    def start(self):
+        add_rebuild_listener(self._discard_version)
+        thread = threading.Thread(target=self._refill, name='flo2d-run-dir-pool')
+        thread.daemon = True  # Daemonize thread
+        thread.start()
+
+    def claim(self, model_path):
+        """
+        Move a prepared model directory of the current template to model_path. An existing model directory is moved
+        aside and removed in the background.
+        :param model_path: str, path to the model directory of a run
+        :return: boolean, False if no directory of the current template was ready
+        """
+        version = get_template_version(self.source_dirs)
+        with self.condition:
+            candidates = [dir_name for dir_name in self.ready if dir_name.split('.')[0] == version]
+            if not candidates:
+                # Wake the refill thread, the template may have changed since it last checked.
+                self.condition.notify()
+                return False
+            dir_name = candidates[0]
+            self.ready.remove(dir_name)
+            self.claiming.add(dir_name)
+        claimed = True
+        with stage('claim_run_dir'):
+            try:
+                if path.exists(model_path):
+                    self._discard(model_path)
+                os.rename(path.join(self.pool_dir, dir_name), model_path)
+            except OSError as e:
+                print('Error: Unable to claim a prepared model directory. ' + model_path, e)
+                self._discard(path.join(self.pool_dir, dir_name))
+                claimed = False
+        with self.condition:
+            self.claiming.discard(dir_name)
+            self.condition.notify()
+        return claimed
+
+    def get_ready_count(self):
+        with self.condition:
+            return len(self.ready)
+
+    def _refill(self):
+        version = None
+        while True:
+            try:
+                new_version = get_template_version(self.source_dirs)
+                if new_version != version:
+                    version = new_version
+                    self._load(version)
+                self._empty_trash()
+                with self.condition:
+                    missing = self.size - len(self.ready)
+                    if missing <= 0:
+                        self.condition.wait(TEMPLATE_CHECK_INTERVAL)
+                        continue
+                    self.seq += 1
+                    dir_name = '%s.%d' % (version, self.seq)
+                    generation = self.generation
+                self._build(dir_name)
+                with self.condition:
+                    is_current = generation == self.generation
+                    if is_current:
+                        self.ready.append(dir_name)
+                if not is_current:
+                    self._discard(path.join(self.pool_dir, dir_name))
+            except Exception as e:
+                print('Error: Refilling the model directory pool.', e)
+                with self.condition:
+                    self.condition.wait(TEMPLATE_CHECK_INTERVAL)
+
+    def _load(self, version):
+        # Keep the directories of the current template, discard the others and any left half built.
+        with self.condition:
+            self.ready = []
+            for dir_name in sorted(os.listdir(self.pool_dir)):
+                if dir_name == TRASH_DIR or dir_name in self.claiming:
+                    continue
+                parts = dir_name.split('.')
+                if len(parts) == 2 and parts[0] == version and parts[1].isdigit():
+                    self.ready.append(dir_name)
+                    self.seq = max(self.seq, int(parts[1]))
+                else:
+                    self._discard(path.join(self.pool_dir, dir_name))
+
+    def _discard_version(self, version):
+        # The snapshot of the template was modified and rebuilt, the directories linked from it are dropped.
+        with self.condition:
+            stale = [dir_name for dir_name in self.ready if dir_name.split('.')[0] == version]
+            self.ready = [dir_name for dir_name in self.ready if dir_name not in stale]
+            self.generation += 1
+            self.condition.notify()
+        for dir_name in stale:
+            self._discard(path.join(self.pool_dir, dir_name))
+
+    def _build(self, dir_name):
+        tmp_dir_path = path.join(self.pool_dir, dir_name + '.tmp')
+        if path.exists(tmp_dir_path):
+            shutil.rmtree(tmp_dir_path)
+        os.makedirs(tmp_dir_path)
+        self.prepare_model_dir(tmp_dir_path)
+        os.rename(tmp_dir_path, path.join(self.pool_dir, dir_name))
+
+    def _discard(self, dir_path):
+        # Moved into the trash right away, removing a model directory takes a while.
+        with self.condition:
+            self.seq += 1
+            trash_path = path.join(self.trash_dir, '%d.%d' % (os.getpid(), self.seq))
+        try:
+            os.rename(dir_path, trash_path)
+        except OSError:
+            shutil.rmtree(dir_path, ignore_errors=True)
+
+    def _empty_trash(self):
+        for dir_name in os.listdir(self.trash_dir):
+            shutil.rmtree(path.join(self.trash_dir, dir_name), ignore_errors=True)
@@ -1,41 +1,71 @@
-import threading
+import os
 
-from glob import glob
 from os import path
-from shutil import copy
-from subprocess import Popen
+from subprocess import Popen, CalledProcessError
 
-from .general import create_dir
+from .collector import collect_flo2d_output
+from .metrics import stage
+from .output_cache import build_output_cache
 
+# Access rights OpenProcess needs to change the CPU affinity of a process on Windows.
+_PROCESS_SET_INFORMATION = 0x0200
+_PROCESS_QUERY_INFORMATION = 0x0400
 
-def run_flo2d_model(run_path):
-    thread = threading.Thread(target=_run_flo2d_model, args=(run_path,))
-    thread.daemon = True  # Daemonize thread
-    thread.start()
 
-
-def _run_flo2d_model(run_path):
+def _run_flo2d_model(run_path, cpus=None, on_output_ready=None):
     # run flo2d model
     run_model_path = path.join(run_path, 'model')
-    popen_flo2d = Popen(path.join(run_model_path, 'FLOPRO.exe'), cwd=run_model_path)
+    with stage('flopro'):
+        popen_flo2d = Popen(path.join(run_model_path, 'FLOPRO.exe'), cwd=run_model_path)
+        if cpus:
+            _set_cpu_affinity(popen_flo2d.pid, cpus)
 
-    # TODO update run_id in the DB with the status
+        # wait for flo2d run completes
+        popen_flo2d.communicate()
+    # the output of a failed run is left in the model directory, it is neither collected nor cached.
+    if popen_flo2d.returncode != 0:
+        raise CalledProcessError(popen_flo2d.returncode, path.join(run_model_path, 'FLOPRO.exe'))
 
-    # wait for flo2d run completes
-    popen_flo2d.communicate()
+    # move the results to output directory
+    with stage('collect_output'):
+        collect_flo2d_output(run_path)
+    # the output can be served as soon as it is committed, the cache below only speeds up the extractions.
+    if on_output_ready is not None:
+        on_output_ready()
 
-    # create output directory
-    run_output_path = path.join(run_path, 'output')
-    create_dir(run_output_path)
+    # convert the results to memory-mappable arrays for the extract endpoints
+    try:
+        with stage('output_cache'):
+            build_output_cache(run_path)
+    except Exception as e:
+        print('Error: Building output cache. ' + run_path, e)
 
-    # copy the results to output directory
-    out_file_list = glob(path.join(run_model_path, '*.OUT'))
-    dat_file_list = glob(path.join(run_model_path, '*.DAT'))
 
-    for out_file in out_file_list:
-        copy(out_file, run_output_path)
+def _set_cpu_affinity(pid, cpus):
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(pid, cpus)
+        elif os.name == 'nt':
+            _set_windows_cpu_affinity(pid, cpus)
+        else:
+            print('Warning: CPU affinity is not supported on this platform.')
+    except OSError as e:
+        print('Warning: Unable to set CPU affinity of the model run.', e)
 
-    for dat_file in dat_file_list:
-        copy(dat_file, run_output_path)
 
-    # TODO update run_id in the DB with the status
+def _set_windows_cpu_affinity(pid, cpus):
+    # The affinity mask covers the CPUs of the processor group of the process, the first 64 CPUs on most hosts.
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    kernel32.OpenProcess.restype = ctypes.c_void_p
+    kernel32.SetProcessAffinityMask.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+    handle = kernel32.OpenProcess(_PROCESS_SET_INFORMATION | _PROCESS_QUERY_INFORMATION, False, pid)
+    if not handle:
+        raise ctypes.WinError()
+    try:
+        mask = sum(1 << cpu for cpu in set(cpus))
+        if not kernel32.SetProcessAffinityMask(handle, mask):
+            raise ctypes.WinError()
+    finally:
+        kernel32.CloseHandle(handle)
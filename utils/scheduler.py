@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+
+from os import path
+
+from constants import RUN_STATE_QUEUED, RUN_STATE_RUNNING, RUN_STATE_FINISHED, RUN_STATE_FAILED
+from .general import get_current_date_time, get_run_sizes, get_dir_size
+from .metrics import trace, stage
+from .runner import _run_flo2d_model
+
+# Lower value runs first. Runs of the same priority run in the order they were queued.
+RUN_PRIORITIES = {
+    'operational': 0,
+    'rerun': 10
+}
+DEFAULT_RUN_PRIORITY = 'operational'
+
+# Number of finished runs kept in the persisted queue.
+MAX_FINISHED_RUNS = 1000
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_run_scheduler(state_file_path, slots, slot_cpus, prepare_run, run_registry=None):
+    """
+    Get the process wide run scheduler, the scheduler is created and started on the first call.
+    :param state_file_path: str, path to the file where the run queue is persisted
+    :param slots: int, number of FLOPRO runs allowed at once
+    :param slot_cpus: list of list of int, CPUs each slot is pinned to. Empty to leave the affinity as it is.
+    :param prepare_run: function, called with the run_path to prepare the model directory of a run
+    :param run_registry: RunRegistry, registry to record the run states in, optional
+    :return: RunScheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RunScheduler(state_file_path, slots, slot_cpus, prepare_run, run_registry)
+            _scheduler.start()
+        return _scheduler
+
+
+class RunScheduler:
+    """
+    Runs queued FLO2D model runs on a fixed number of slots. The queue is persisted after every state change, so
+    queued and finished runs survive a server restart. Runs which were running when the server stopped are queued
+    again on the next start.
+    """
+
+    def __init__(self, state_file_path, slots, slot_cpus, prepare_run, run_registry=None):
+        self.state_file_path = state_file_path
+        self.slots = max(int(slots), 1)
+        self.slot_cpus = slot_cpus or []
+        self.prepare_run = prepare_run
+        self.run_registry = run_registry
+        self.condition = threading.Condition()
+        self.runs = {}
+        self.seq = 0
+        self._load()
+
+    def start(self):
+        for slot in range(self.slots):
+            thread = threading.Thread(target=self._run_slot, args=(slot,), name='flo2d-run-slot-%d' % slot)
+            thread.daemon = True  # Daemonize thread
+            thread.start()
+
+    def enqueue(self, run_id, run_path, priority=DEFAULT_RUN_PRIORITY):
+        """
+        Queue a model run. A run which is already queued or running is not queued again.
+        :param run_id: str, id of the run
+        :param run_path: str, absolute path to the run resources and configs
+        :param priority: str, one of RUN_PRIORITIES
+        :return: dict, the run entry
+        """
+        if priority not in RUN_PRIORITIES:
+            raise ValueError('Unknown priority: %s' % priority)
+        with self.condition:
+            run = self.runs.get(run_id)
+            if run is not None and run['state'] in (RUN_STATE_QUEUED, RUN_STATE_RUNNING):
+                return dict(run)
+            self.seq += 1
+            run = {
+                'run_id': run_id,
+                'run_path': run_path,
+                'priority': priority,
+                'seq': self.seq,
+                'state': RUN_STATE_QUEUED,
+                'queued_at': get_current_date_time(),
+                'started_at': None,
+                'finished_at': None,
+                'slot': None
+            }
+            self.runs[run_id] = run
+            self._save()
+            self._set_registry_state(run_id, RUN_STATE_QUEUED, run_path)
+            self.condition.notify()
+            return dict(run)
+
+    def get_run(self, run_id):
+        with self.condition:
+            run = self.runs.get(run_id)
+            return dict(run) if run is not None else None
+
+    def get_queue_position(self, run_id):
+        with self.condition:
+            queued = self._queued_runs()
+            for position, run in enumerate(queued):
+                if run['run_id'] == run_id:
+                    return position
+            return None
+
+    def _run_slot(self, slot):
+        cpus = self.slot_cpus[slot] if slot < len(self.slot_cpus) else None
+        while True:
+            with self.condition:
+                queued = self._queued_runs()
+                while not queued:
+                    self.condition.wait()
+                    queued = self._queued_runs()
+                run = queued[0]
+                run.update({'state': RUN_STATE_RUNNING, 'started_at': get_current_date_time(), 'slot': slot})
+                self._save()
+            self._set_registry_state(run['run_id'], RUN_STATE_RUNNING, run['run_path'])
+
+            state = RUN_STATE_FINISHED
+            try:
+                with trace('model_run'):
+                    with stage('prepare'):
+                        self.prepare_run(run['run_path'])
+                    _run_flo2d_model(run['run_path'], cpus, lambda: self._set_output_ready(run))
+                if self.run_registry is not None:
+                    self.run_registry.set_artifacts_size(run['run_id'],
+                                                         get_run_sizes(run['run_path'])['artifacts_size'])
+            except Exception as e:
+                print('Error: Model run failed. ' + run['run_id'], e)
+                state = RUN_STATE_FAILED
+
+            with self.condition:
+                run.update({'state': state, 'finished_at': get_current_date_time()})
+                self._save()
+            self._set_registry_state(run['run_id'], state, run['run_path'])
+
+    def _set_output_ready(self, run):
+        if self.run_registry is None:
+            return
+        # Only the output directory is measured here, the artifacts are measured once the output cache is built.
+        output_size = get_dir_size(path.join(run['run_path'], 'output'))
+        self.run_registry.set_output_ready(run['run_id'], output_size, 0)
+
+    def _set_registry_state(self, run_id, state, run_path):
+        if self.run_registry is None:
+            return
+        try:
+            self.run_registry.set_state(run_id, state, run_path)
+        except Exception as e:
+            print('Error: Updating run registry. ' + run_id, e)
+
+    def _queued_runs(self):
+        queued = [run for run in self.runs.values() if run['state'] == RUN_STATE_QUEUED]
+        return sorted(queued, key=lambda run: (RUN_PRIORITIES.get(run['priority'], 0), run['seq']))
+
+    def _load(self):
+        if not path.exists(self.state_file_path):
+            return
+        with open(self.state_file_path, 'r') as F:
+            state = json.load(F)
+        for run in state['runs']:
+            if run['state'] == RUN_STATE_RUNNING:
+                # The server stopped while the run was in progress, run it again.
+                run.update({'state': RUN_STATE_QUEUED, 'started_at': None, 'slot': None})
+            self.runs[run['run_id']] = run
+        self.seq = state['seq']
+
+    def _save(self):
+        finished = [run for run in self.runs.values() if run['state'] in (RUN_STATE_FINISHED, RUN_STATE_FAILED)]
+        for run in sorted(finished, key=lambda run: run['seq'])[:-MAX_FINISHED_RUNS]:
+            del self.runs[run['run_id']]
+        state = {'seq': self.seq, 'runs': sorted(self.runs.values(), key=lambda run: run['seq'])}
+        state_dir = path.dirname(self.state_file_path)
+        if state_dir and not path.exists(state_dir):
+            os.makedirs(state_dir)
+        tmp_state_file_path = self.state_file_path + '.tmp'
+        with open(tmp_state_file_path, 'w') as F:
+            json.dump(state, F)
+        os.replace(tmp_state_file_path, self.state_file_path)
@@ -0,0 +1,68 @@
+import json
+
+from .metrics import stage, count
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+COLUMNAR_MIMETYPE = 'application/vnd.flo2d.columnar+json'
+# Cells serialized into one chunk of the response.
+CELLS_PER_CHUNK = 64
+
+
+def stream_ndjson_series(groups):
+    """
+    Serialize extracted series as newline delimited JSON, one line per cell,
+        {"group": "FLOOD_PLAIN", "cell": "<name>", "series": [["<timestamp>", "<value>"], ...]}
+    The values are as written in the output files. Timesteps without a value are left out of the series.
+    :param groups: generator of (group, timestamps, cells), see iter_water_levels
+    :return: generator of bytes
+    """
+    for group, timestamps, cells in groups:
+        lines = []
+        for name, values in cells:
+            with stage('serialize'):
+                series = [[timestamp, value] for timestamp, value in zip(timestamps, values) if value is not None]
+                lines.append(json.dumps({'group': group, 'cell': name, 'series': series}, separators=(',', ':')))
+            count('cells_emitted', len(series))
+            if len(lines) == CELLS_PER_CHUNK:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+                lines = []
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def stream_columnar_series(groups):
+    """
+    Serialize extracted series as one JSON document with a shared timestamp array per group and numeric values,
+        {"<group>": {"timestamps": ["<timestamp>", ...], "cells": {"<name>": [<value or null>, ...], ...}}, ...}
+    The document is sent while the cells are being extracted.
+    :param groups: generator of (group, timestamps, cells), see iter_water_levels
+    :return: generator of bytes
+    """
+    yield b'{'
+    for group_index, (group, timestamps, cells) in enumerate(groups):
+        with stage('serialize'):
+            head = '%s%s:{"timestamps":%s,"cells":{' % (',' if group_index else '', json.dumps(group),
+                                                         json.dumps(timestamps, separators=(',', ':')))
+        parts = [head]
+        for cell_index, (name, values) in enumerate(cells):
+            with stage('serialize'):
+                parts.append('%s%s:%s' % (',' if cell_index else '', json.dumps(name),
+                                          json.dumps([_to_number(value) for value in values], separators=(',', ':'))))
+            count('cells_emitted', len(values))
+            if len(parts) >= CELLS_PER_CHUNK:
+                yield ''.join(parts).encode('utf-8')
+                parts = []
+        parts.append('}}')
+        yield ''.join(parts).encode('utf-8')
+    yield b'}'
+
+
+def _to_number(value):
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    # NaN and infinity are not valid JSON.
+    return number if number - number == 0 else None
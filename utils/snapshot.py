@@ -0,0 +1,202 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from os import path
+
+LINK_MODE_COPY = 'copy'
+LINK_MODE_HARDLINK = 'hardlink'
+LINK_MODE_REFLINK = 'reflink'
+LINK_MODES = [LINK_MODE_COPY, LINK_MODE_HARDLINK, LINK_MODE_REFLINK]
+
+SNAPSHOT_META_FILE = '.snapshot.json'
+# Linux FICLONE ioctl request, clones the extents of a file on copy-on-write file systems (btrfs, xfs).
+_FICLONE = 0x40049409
+
+# Source stat signature -> content hash, so the sources are only hashed again when they change.
+_content_hashes = {}
+_snapshot_lock = threading.Lock()
+# Functions called with the content hash of a snapshot which was modified and rebuilt.
+_rebuild_listeners = []
+
+
+def get_template_snapshot(snapshot_root, source_dirs):
+    """
+    Get a verified read-only snapshot of the given source directories merged in order, later directories overriding
+    files of the earlier ones. Snapshots are keyed by the content hash of the sources, so a snapshot is built once per
+    template change and reused by every run.
+    :param snapshot_root: str, directory to keep the snapshots in, should be on the same file system as the runs
+    :param source_dirs: list of str, source directories e.g. [FLO2D_LIBS_DIR, MODEL_250M_TEMPLATE_DIR]
+    :return: str, path to the snapshot directory
+    """
+    rebuilt = False
+    with _snapshot_lock:
+        content_hash = _get_template_version(source_dirs)
+        snapshot_path = path.join(snapshot_root, content_hash)
+        if path.exists(snapshot_path) and not _is_snapshot_intact(snapshot_path):
+            # A run modified a linked file in place, the snapshot can not be trusted anymore.
+            print('Warning: Template snapshot was modified, rebuilding. ' + snapshot_path)
+            shutil.rmtree(snapshot_path)
+            rebuilt = True
+        if not path.exists(snapshot_path):
+            _build_snapshot(snapshot_path, source_dirs, content_hash)
+            _remove_old_snapshots(snapshot_root, content_hash)
+        listeners = list(_rebuild_listeners) if rebuilt else []
+    # Directories linked from the modified snapshot share its modified files.
+    for listener in listeners:
+        listener(content_hash)
+    return snapshot_path
+
+
+def add_rebuild_listener(listener):
+    """
+    Call a function whenever a snapshot is found modified and rebuilt, e.g. to drop model directories linked from it.
+    :param listener: function, called with the content hash of the rebuilt snapshot, see get_template_version
+    """
+    with _snapshot_lock:
+        _rebuild_listeners.append(listener)
+
+
+def get_template_version(source_dirs):
+    """
+    Content hash of the given source directories merged in order, the name of their snapshot. The sources are only
+    hashed again when the size or the modified time of a file changes.
+    :param source_dirs: list of str, source directories e.g. [FLO2D_LIBS_DIR, MODEL_250M_TEMPLATE_DIR]
+    :return: str
+    """
+    with _snapshot_lock:
+        return _get_template_version(source_dirs)
+
+
+def link_tree(src_dir, dst_dir, link_mode=LINK_MODE_HARDLINK):
+    """
+    Mirror the files of src_dir into dst_dir using the given link mode. Falls back to copying a file when it can not
+    be linked (e.g. different file systems).
+    :param src_dir: str, source directory
+    :param dst_dir: str, destination directory
+    :param link_mode: str, one of LINK_MODES
+    """
+    for root, dirs, files in os.walk(src_dir):
+        rel_root = path.relpath(root, src_dir)
+        target_root = path.normpath(path.join(dst_dir, rel_root))
+        if not path.exists(target_root):
+            os.makedirs(target_root)
+        for file_name in files:
+            if rel_root == '.' and file_name == SNAPSHOT_META_FILE:
+                continue
+            link_file(path.join(root, file_name), path.join(target_root, file_name), link_mode)
+
+
+def link_file(src, dst, link_mode=LINK_MODE_HARDLINK):
+    # Never write through an existing link, it would modify the file it shares the data with.
+    if path.lexists(dst):
+        os.remove(dst)
+    if link_mode == LINK_MODE_HARDLINK:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif link_mode == LINK_MODE_REFLINK and _reflink(src, dst):
+        return
+    shutil.copy2(src, dst)
+
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+        return True
+    except (IOError, OSError) as e:
+        if path.exists(dst):
+            os.remove(dst)
+        if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EBADF):
+            print('Warning: Unable to reflink, copying instead. ' + src, e)
+        return False
+
+
+def _get_template_version(source_dirs):
+    signature = _get_stat_signature(source_dirs)
+    content_hash = _content_hashes.get(signature)
+    if content_hash is None:
+        content_hash = _get_content_hash(source_dirs)
+        _content_hashes[signature] = content_hash
+    return content_hash
+
+
+def _iter_files(source_dirs):
+    for source_dir in source_dirs:
+        for root, dirs, files in os.walk(source_dir):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = path.join(root, file_name)
+                yield path.relpath(file_path, source_dir).replace(os.sep, '/'), file_path
+
+
+def _get_stat_signature(source_dirs):
+    signature = [tuple(source_dirs)]
+    for rel_path, file_path in _iter_files(source_dirs):
+        stat = os.stat(file_path)
+        signature.append((rel_path, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def _get_content_hash(source_dirs):
+    # Files are hashed in the same order they are merged into the snapshot.
+    files = {}
+    for rel_path, file_path in _iter_files(source_dirs):
+        files[rel_path] = file_path
+    content_hash = hashlib.sha1()
+    for rel_path in sorted(files.keys()):
+        content_hash.update(rel_path.encode('utf-8') + b'\0')
+        with open(files[rel_path], 'rb') as F:
+            for block in iter(lambda: F.read(1024 * 1024), b''):
+                content_hash.update(block)
+        content_hash.update(b'\0')
+    return content_hash.hexdigest()
+
+
+def _get_snapshot_files(snapshot_path):
+    files = {}
+    for rel_path, file_path in _iter_files([snapshot_path]):
+        if rel_path != SNAPSHOT_META_FILE:
+            stat = os.stat(file_path)
+            files[rel_path] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def _build_snapshot(snapshot_path, source_dirs, content_hash):
+    tmp_snapshot_path = '%s.%d.tmp' % (snapshot_path, os.getpid())
+    if path.exists(tmp_snapshot_path):
+        shutil.rmtree(tmp_snapshot_path)
+    os.makedirs(tmp_snapshot_path)
+    for source_dir in source_dirs:
+        link_tree(source_dir, tmp_snapshot_path, LINK_MODE_COPY)
+    meta = {'content_hash': content_hash, 'sources': source_dirs, 'files': _get_snapshot_files(tmp_snapshot_path)}
+    with open(path.join(tmp_snapshot_path, SNAPSHOT_META_FILE), 'w') as F:
+        json.dump(meta, F)
+    os.rename(tmp_snapshot_path, snapshot_path)
+
+
+def _is_snapshot_intact(snapshot_path):
+    try:
+        with open(path.join(snapshot_path, SNAPSHOT_META_FILE), 'r') as F:
+            meta = json.load(F)
+    except (IOError, OSError, ValueError):
+        return False
+    return meta['files'] == _get_snapshot_files(snapshot_path)
+
+
+def _remove_old_snapshots(snapshot_root, content_hash):
+    # Runs keep their own links to the files, removing a snapshot does not affect them.
+    for entry in os.listdir(snapshot_root):
+        if entry != content_hash and path.isdir(path.join(snapshot_root, entry)):
+            shutil.rmtree(path.join(snapshot_root, entry), ignore_errors=True)
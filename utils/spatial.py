@@ -0,0 +1,154 @@
+import threading
+
+import numpy as np
+
+from .geometry import get_grid_geometry
+from .metrics import stage
+
+# Side of a bucket of the spatial index, in grid cells.
+BUCKET_CELLS = 16
+
+_index_lock = threading.Lock()
+
+
+def get_region_cells(cad_pts_file_path, grid_size, geometry_dir=None, bbox=None, polygon=None):
+    """
+    Element numbers of the cells within a bounding box or a polygon, in the CADPTS.DAT coordinates.
+    :param cad_pts_file_path: str, path to the CADPTS.DAT file
+    :param grid_size: float, size of a grid cell
+    :param geometry_dir: str, directory of the shared grid geometries, optional
+    :param bbox: list of float, [x min, y min, x max, y max]
+    :param polygon: list of [x, y], vertices of the polygon. The ring may or may not be closed.
+    :return: list of str, element numbers in increasing order
+    :raise ValueError: if the bounding box or the polygon is not valid
+    """
+    geometry = get_grid_geometry(cad_pts_file_path, grid_size, geometry_dir)
+    index = get_spatial_index(geometry, grid_size)
+    with stage('spatial_query'):
+        if polygon is not None:
+            elements = find_cells_in_polygon(index, polygon)
+        elif bbox is not None:
+            elements = find_cells_in_bbox(index, bbox)
+        else:
+            raise ValueError('Either bbox or polygon is required.')
+    return [str(element) for element in elements.tolist()]
+
+
+def get_spatial_index(geometry, grid_size):
+    """
+    Get the spatial index of a grid geometry. The index is built on the first access and kept with the geometry.
+    The cells are bucketed into squares of BUCKET_CELLS x BUCKET_CELLS grid cells and sorted by bucket, row by row, so
+    the cells of the buckets of a bounding box row are one contiguous range found with a binary search.
+    :param geometry: dict, see get_grid_geometry
+    :param grid_size: float, size of a grid cell of the geometry
+    :return: dict, {'origin': (x, y), 'bucket_size': float, 'bucket_cols': int, 'buckets': sorted bucket number of
+    each cell, 'elements': element numbers, 'coordinates': (cells x 2) x and y coordinates, both in bucket order}
+    """
+    index = geometry.get('spatial_index')
+    if index is not None:
+        return index
+    with _index_lock:
+        index = geometry.get('spatial_index')
+        if index is None:
+            with stage('spatial_index'):
+                index = build_spatial_index(geometry['elements'], geometry['coordinates'], grid_size)
+            geometry['spatial_index'] = index
+    return index
+
+
+def build_spatial_index(elements, coordinates, grid_size):
+    """
+    :param elements: numpy.ndarray, element numbers
+    :param coordinates: numpy.ndarray, (cells x 2) x and y coordinates
+    :param grid_size: float, size of a grid cell
+    :return: dict, see get_spatial_index
+    """
+    bucket_size = float(grid_size) * BUCKET_CELLS
+    origin = (float(coordinates[:, 0].min()), float(coordinates[:, 1].min())) if len(coordinates) else (0.0, 0.0)
+    bucket_cols = int((coordinates[:, 0].max() - origin[0]) // bucket_size) + 1 if len(coordinates) else 1
+    buckets = _get_bucket(coordinates[:, 0], origin[0], bucket_size) + \
+        _get_bucket(coordinates[:, 1], origin[1], bucket_size) * bucket_cols
+    order = np.argsort(buckets, kind='stable')
+    return {
+        'origin': origin,
+        'bucket_size': bucket_size,
+        'bucket_cols': bucket_cols,
+        'buckets': buckets[order],
+        'elements': elements[order],
+        'coordinates': coordinates[order]
+    }
+
+
+def find_cells_in_bbox(index, bbox):
+    """
+    :param index: dict, see get_spatial_index
+    :param bbox: list of float, [x min, y min, x max, y max]
+    :return: numpy.ndarray, element numbers of the cells within the bounding box, edges included
+    """
+    x_min, y_min, x_max, y_max = _get_bbox(bbox)
+    candidates = _get_candidates(index, x_min, y_min, x_max, y_max)
+    points = index['coordinates'][candidates]
+    inside = (points[:, 0] >= x_min) & (points[:, 0] <= x_max) & (points[:, 1] >= y_min) & (points[:, 1] <= y_max)
+    return np.unique(index['elements'][candidates[inside]])
+
+
+def find_cells_in_polygon(index, polygon):
+    """
+    :param index: dict, see get_spatial_index
+    :param polygon: list of [x, y], vertices of the polygon
+    :return: numpy.ndarray, element numbers of the cells within the polygon (even-odd rule)
+    """
+    try:
+        vertices = np.array(polygon, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError('polygon should be a list of [x, y] points.')
+    if vertices.ndim != 2 or vertices.shape[1] != 2 or len(vertices) < 3 or not np.isfinite(vertices).all():
+        raise ValueError('polygon should be a list of at least 3 [x, y] points.')
+    x_min, y_min = vertices.min(axis=0)
+    x_max, y_max = vertices.max(axis=0)
+    candidates = _get_candidates(index, x_min, y_min, x_max, y_max)
+    points = index['coordinates'][candidates]
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    # Count the edges which a ray from each point towards +x crosses.
+    for (x1, y1), (x2, y2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+    return np.unique(index['elements'][candidates[inside]])
+
+
+def _get_candidates(index, x_min, y_min, x_max, y_max):
+    # Positions of the cells in the buckets which overlap the bounding box.
+    bucket_size = index['bucket_size']
+    bucket_cols = index['bucket_cols']
+    col_min = max(int((x_min - index['origin'][0]) // bucket_size), 0)
+    col_max = min(int((x_max - index['origin'][0]) // bucket_size), bucket_cols - 1)
+    row_min = max(int((y_min - index['origin'][1]) // bucket_size), 0)
+    row_max = int((y_max - index['origin'][1]) // bucket_size)
+    if col_min > col_max or row_min > row_max or not len(index['buckets']):
+        return np.zeros(0, dtype=np.int64)
+    row_max = min(row_max, int(index['buckets'][-1]) // bucket_cols)
+    rows = np.arange(row_min, row_max + 1)
+    starts = np.searchsorted(index['buckets'], rows * bucket_cols + col_min, side='left')
+    ends = np.searchsorted(index['buckets'], rows * bucket_cols + col_max, side='right')
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, end) for start, end in zip(starts.tolist(), ends.tolist())])
+
+
+def _get_bbox(bbox):
+    try:
+        x_min, y_min, x_max, y_max = [float(value) for value in bbox]
+    except (TypeError, ValueError):
+        raise ValueError('bbox should be [x min, y min, x max, y max].')
+    if not np.isfinite([x_min, y_min, x_max, y_max]).all():
+        raise ValueError('bbox should be finite numbers.')
+    if not x_min <= x_max or not y_min <= y_max:
+        raise ValueError('bbox minimum is larger than its maximum.')
+    return x_min, y_min, x_max, y_max
+
+
+def _get_bucket(values, origin, bucket_size):
+    return ((values - origin) // bucket_size).astype(np.int64)
@@ -0,0 +1,113 @@
+import os
+import threading
+
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from .timdep import CHUNK_SIZE, get_timdep_tokens, _BlockBuilder
+
+# Number of followed TIMDEP.OUT files kept in memory, a file is followed while its run is in progress. A file
+# followed for other elements is followed once per set of elements.
+MAX_TAILS = 8
+
+TimdepLevels = namedtuple('TimdepLevels', ['model_time', 'elements', 'levels'])
+TimdepLevels.__doc__ = """
+Flood levels of one timestep block of TIMDEP.OUT.
+model_time: float, model time in hours.
+elements: numpy.ndarray, element numbers of the kept block rows.
+levels: numpy.ndarray of bytes, flood level (Elevation) of each kept row as written in the file.
+"""
+
+_tails = OrderedDict()
+_tails_lock = threading.Lock()
+
+
+def get_timdep_tail(timdep_file_path, element_ids):
+    """
+    Get the flood levels of the complete timestep blocks of a TIMDEP.OUT file which is still being written by FLOPRO.
+    Each call reads only the bytes appended since the previous call. The block being written is left out until the
+    header of the next block shows up. Only the rows of the given elements are kept, every timestep of a run is
+    kept while it is in progress.
+    :param timdep_file_path: str, path to the TIMDEP.OUT file in the model directory of a run
+    :param element_ids: numpy.ndarray of int, element numbers to keep the rows of, empty to only follow the timesteps
+    :return: list of TimdepLevels, None if the file does not exist
+    """
+    element_ids = np.unique(np.asarray(element_ids, dtype=np.int64))
+    key = (timdep_file_path, element_ids.tobytes())
+    with _tails_lock:
+        if not os.path.exists(timdep_file_path):
+            # The run finished and the file was collected to the output directory.
+            for tail_key in [tail_key for tail_key in _tails if tail_key[0] == timdep_file_path]:
+                del _tails[tail_key]
+            return None
+        tail = _tails.get(key)
+        if tail is None:
+            tail = _TimdepTail(timdep_file_path, element_ids)
+            _tails[key] = tail
+            while len(_tails) > MAX_TAILS:
+                _tails.popitem(last=False)
+        _tails.move_to_end(key)
+    return tail.poll()
+
+
+class _TimdepTail:
+    """
+    Follows a growing TIMDEP.OUT. Remembers the offset of the last complete line read and the rows of the block being
+    built, so only new bytes are parsed on each poll.
+    """
+
+    def __init__(self, timdep_file_path, element_ids):
+        self.timdep_file_path = timdep_file_path
+        self.element_ids = element_ids
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def poll(self):
+        with self.lock:
+            try:
+                with open(self.timdep_file_path, 'rb') as infile:
+                    stat = os.fstat(infile.fileno())
+                    if stat.st_ino != self.inode or stat.st_size < self.offset:
+                        # The file was replaced, e.g. the run was started again.
+                        self._reset(stat.st_ino)
+                    infile.seek(self.offset)
+                    while True:
+                        chunk = infile.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        self._feed(chunk)
+            except (IOError, OSError) as e:
+                print('Error: Reading TIMDEP.OUT of the running model. ' + self.timdep_file_path, e)
+            return list(self.steps)
+
+    def _feed(self, chunk):
+        last_line_end = chunk.rfind(b'\n') + 1
+        if not last_line_end:
+            # No complete line yet, it is read again on the next poll.
+            self.pending += chunk
+            self.offset += len(chunk)
+            return
+        buf = self.pending + chunk[:last_line_end]
+        self.pending = chunk[last_line_end:]
+        self.offset += len(chunk)
+        for step in self.block.feed(buf):
+            if not len(step.values):
+                elements, levels = np.zeros(0, dtype=np.int64), np.zeros(0, dtype='S1')
+            else:
+                elements = step.values[:, 0].astype(np.int64)
+                rows = np.flatnonzero(np.isin(elements, self.element_ids))
+                elements = elements[rows]
+                # Get flood level (Elevation). Flood depth (Depth) is in column 1.
+                levels = get_timdep_tokens(step, 5, rows) if len(rows) else np.zeros(0, dtype='S1')
+            if self.steps and np.array_equal(self.steps[-1].elements, elements):
+                # Share the element column between the blocks, it is the same for every block of a run.
+                elements = self.steps[-1].elements
+            self.steps.append(TimdepLevels(step.model_time, elements, levels))
+
+    def _reset(self, inode):
+        self.inode = inode
+        self.offset = 0
+        self.pending = b''
+        self.block = _BlockBuilder()
+        self.steps = []
@@ -0,0 +1,266 @@
+import json
+import os
+import warnings
+
+from collections import namedtuple
+from os import path
+
+import numpy as np
+
+from .general import get_index_path
+from .metrics import stage, count
+from .window import get_window_steps
+
+# Raw bytes read from TIMDEP.OUT per iteration. Block boundaries are found within each chunk using numpy.
+CHUNK_SIZE = 8 * 1024 * 1024
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 1
+
+TimdepStep = namedtuple('TimdepStep', ['model_time', 'values', 'data'])
+TimdepStep.__doc__ = """
+One timestep block of TIMDEP.OUT.
+model_time: float, model time in hours as given in the block header line.
+values: numpy.ndarray, (cells x columns) float array of the block rows.
+data: bytes, raw text of the block rows, used to recover the original value tokens.
+"""
+
+
+def read_timdep(timdep_file_path, chunk_size=CHUNK_SIZE):
+    """
+    Iterate over the timestep blocks of a TIMDEP.OUT file.
+    A block starts with a line holding a single token (the model time) and is followed by one row per cell. Rows after
+    a blank line are ignored. Same as the line based readers this replaces, the last block of the file is not yielded
+    as it cannot be told apart from a block which is still being written.
+    :param timdep_file_path: str, path to the TIMDEP.OUT file
+    :param chunk_size: int, number of bytes to read from the file at once
+    :return: generator of TimdepStep
+    """
+    with open(timdep_file_path, 'rb') as infile:
+        block = _BlockBuilder()
+        tail = b''
+        while True:
+            with stage('timdep_read'):
+                chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+            count('bytes_read', len(chunk))
+            buf = tail + chunk
+            last_line_end = buf.rfind(b'\n') + 1
+            tail = buf[last_line_end:]
+            if last_line_end:
+                for step in block.feed(buf[:last_line_end]):
+                    yield step
+        if tail:
+            for step in block.feed(tail + b'\n'):
+                yield step
+
+
+def read_timdep_window(timdep_file_path, window):
+    """
+    Iterate over the timestep blocks of a TIMDEP.OUT file which are within a time window. The blocks are found with the
+    timestep offset index of the file, the blocks outside the window are not read.
+    :param timdep_file_path: str, path to the TIMDEP.OUT file
+    :param window: TimeWindow, None for every block
+    :return: generator of TimdepStep, same as read_timdep
+    """
+    index = get_timdep_index(timdep_file_path)
+    offsets = index['offsets']
+    # The last block is not yielded, same as read_timdep.
+    with open(timdep_file_path, 'rb') as infile:
+        for position in get_window_steps(index['model_times'][:-1], window):
+            with stage('timdep_read'):
+                infile.seek(offsets[position])
+                data = infile.read(offsets[position + 1] - offsets[position])
+            count('bytes_read', len(data))
+            block = _BlockBuilder()
+            for step in block.feed(data):
+                yield step
+            yield block.finish()
+
+
+def get_timdep_index(timdep_file_path):
+    """
+    Get the timestep offset index of a TIMDEP.OUT file. The index is built on the first access and persisted with
+    the file, see get_index_path, and it is rebuilt whenever the size or the modified time of the file changes.
+    :param timdep_file_path: str, path to the TIMDEP.OUT file
+    :return: dict, {'model_times': [model time of each block], 'offsets': [byte offset of each block header line]}
+    """
+    stat = os.stat(timdep_file_path)
+    index_path = get_index_path(timdep_file_path, INDEX_SUFFIX)
+    try:
+        with open(index_path, 'r') as F:
+            index = json.load(F)
+        if index.get('version') == INDEX_VERSION and index['size'] == stat.st_size and \
+                index['mtime'] == stat.st_mtime:
+            return index
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    with stage('timdep_index'):
+        index = build_timdep_index(timdep_file_path)
+    index.update({'version': INDEX_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime})
+    tmp_index_path = '%s.%d.tmp' % (index_path, os.getpid())
+    try:
+        if not path.exists(path.dirname(tmp_index_path)):
+            os.makedirs(path.dirname(tmp_index_path), exist_ok=True)
+        with open(tmp_index_path, 'w') as F:
+            json.dump(index, F)
+        os.replace(tmp_index_path, index_path)
+    except (IOError, OSError):
+        print('Error: Unable to save TIMDEP index. ' + index_path)
+    return index
+
+
+def build_timdep_index(timdep_file_path, chunk_size=CHUNK_SIZE):
+    """
+    Scan a TIMDEP.OUT file once and record the model time and the byte offset of every block header line. Only the
+    line boundaries are looked at, the rows are not parsed.
+    :param timdep_file_path: str, path to the TIMDEP.OUT file
+    :param chunk_size: int, number of bytes to read from the file at once
+    :return: dict, {'model_times': [model time of each block], 'offsets': [byte offset of each block header line]}
+    """
+    model_times = []
+    offsets = []
+    with open(timdep_file_path, 'rb') as infile:
+        tail = b''
+        tail_offset = 0
+        while True:
+            chunk = infile.read(chunk_size)
+            count('bytes_read', len(chunk))
+            buf = tail + chunk if chunk else tail + (b'\n' if tail else b'')
+            last_line_end = buf.rfind(b'\n') + 1
+            if last_line_end:
+                line_starts, line_ends, token_counts = _scan_lines(buf[:last_line_end])
+                for header in np.flatnonzero(token_counts == 1):
+                    model_times.append(float(buf[line_starts[header]:line_ends[header]]))
+                    offsets.append(tail_offset + int(line_starts[header]))
+            if not chunk:
+                break
+            tail = buf[last_line_end:]
+            tail_offset += last_line_end
+    return {'model_times': model_times, 'offsets': offsets}
+
+
+def get_timdep_tokens(step, column, rows=None):
+    """
+    Get the original text tokens of a column of a timestep block.
+    :param step: TimdepStep
+    :param column: int, column index
+    :param rows: numpy.ndarray, row indices of the block, all the rows if not given
+    :return: numpy.ndarray of bytes, one token per row
+    """
+    chars = np.frombuffer(step.data, dtype=np.uint8)
+    if not len(chars):
+        return np.zeros(0, dtype='S1')
+    is_space = chars <= 32
+    token_starts = np.flatnonzero(~is_space[1:] & is_space[:-1]) + 1
+    if not is_space[0]:
+        token_starts = np.concatenate(([0], token_starts))
+    token_ends = np.flatnonzero(~is_space[:-1] & is_space[1:]) + 1
+    columns = step.values.shape[1]
+    starts = token_starts[column::columns]
+    ends = token_ends[column::columns]
+    if rows is not None:
+        starts, ends = starts[rows], ends[rows]
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    offsets = np.arange(width)
+    tokens = chars[np.minimum(starts[:, None] + offsets, len(chars) - 1)]
+    tokens[offsets >= lengths[:, None]] = 0
+    return np.ascontiguousarray(tokens).view('S%d' % width).ravel()
+
+
+def _scan_lines(buf):
+    """
+    Find line boundaries and count the whitespace separated tokens in each line of the given buffer.
+    :param buf: bytes, ends with a new line
+    :return: tuple of numpy.ndarray, (line start offsets, line end offsets, token counts)
+    """
+    chars = np.frombuffer(buf, dtype=np.uint8)
+    line_ends = np.flatnonzero(chars == 10)
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    # TIMDEP.OUT is plain ASCII, anything up to the space character separates tokens.
+    is_space = chars <= 32
+    token_starts = np.flatnonzero(~is_space[1:] & is_space[:-1]) + 1
+    if not is_space[0]:
+        token_starts = np.concatenate(([0], token_starts))
+    token_counts = np.searchsorted(token_starts, line_ends) - np.searchsorted(token_starts, line_starts)
+    return line_starts, line_ends, token_counts
+
+
+def _parse_block(data, column_counts):
+    columns = column_counts[0] if len(column_counts) else 0
+    if len(column_counts) and (column_counts != columns).any():
+        raise ValueError('TIMDEP.OUT block rows have different number of columns.')
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            values = np.fromstring(data, sep=' ')
+    except (ValueError, DeprecationWarning):
+        values = np.array([_to_float(token) for token in data.split()], dtype=float)
+    return values.reshape(len(column_counts), columns)
+
+
+def _to_float(token):
+    try:
+        return float(token)
+    except ValueError:
+        return np.nan
+
+
+class _BlockBuilder:
+    """
+    Collects the rows of the current timestep block over consecutive buffers.
+    """
+
+    def __init__(self):
+        self.model_time = None
+        self._reset()
+
+    def feed(self, buf):
+        with stage('timdep_parse'):
+            line_starts, line_ends, token_counts = _scan_lines(buf)
+        first = 0
+        for header in np.flatnonzero(token_counts == 1):
+            self._add_rows(buf, line_starts, line_ends, token_counts, first, header)
+            if self.model_time is not None:
+                yield self._build()
+            else:
+                self._reset()
+            self.model_time = float(buf[line_starts[header]:line_ends[header]])
+            first = header + 1
+        self._add_rows(buf, line_starts, line_ends, token_counts, first, len(token_counts))
+
+    def finish(self):
+        """
+        Build the block being collected, for a block which is read on its own.
+        :return: TimdepStep, None if no block header was fed
+        """
+        if self.model_time is None:
+            return None
+        return self._build()
+
+    def _add_rows(self, buf, line_starts, line_ends, token_counts, first, last):
+        if self.is_closed or first >= last:
+            return
+        blank_lines = np.flatnonzero(token_counts[first:last] == 0)
+        if len(blank_lines):
+            last = first + blank_lines[0]
+            self.is_closed = True
+        if first < last:
+            self.parts.append(buf[line_starts[first]:line_ends[last - 1] + 1])
+            self.column_counts.append(token_counts[first:last])
+
+    def _build(self):
+        data = b''.join(self.parts)
+        column_counts = np.concatenate(self.column_counts) if self.column_counts else np.zeros(0, dtype=int)
+        with stage('timdep_parse'):
+            step = TimdepStep(self.model_time, _parse_block(data, column_counts), data)
+        count('rows_parsed', len(column_counts))
+        self._reset()
+        return step
+
+    def _reset(self):
+        self.parts = []
+        self.column_counts = []
+        self.is_closed = False
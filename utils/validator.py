@@ -25,12 +25,16 @@ def is_valid_init_dt(date_time):
         return False
 
 
-def is_output_ready(run_path):
+def is_output_ready(run_path, run=None):
     """
     Checks whether the output is ready for a given run.
     :param run_path: str, absolute path to the run resources and configs
+    :param run: dict, entry of the run in the run registry, None if the run is not registered
     :return: boolean, True if output is ready to be consumed, False otherwise
     """
+    if run is not None:
+        return bool(run['output_ready'])
+    # Runs which are not in the run registry. The output directory is renamed into place only after the results are
+    # collected.
     output_dir = path.join(run_path, 'output')
-    # TODO check in the database for the status for further assurance.
     return path.exists(output_dir)
@@ -0,0 +1,63 @@
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from constants import INIT_DATE_TIME_FORMAT, DATE_TIME_FORMAT
+
+TimeWindow = namedtuple('TimeWindow', ['start', 'end', 'every'])
+TimeWindow.__doc__ = """
+Timesteps to extract from a run.
+start: float, first model time in hours, None to start from the first timestep.
+end: float, last model time in hours, None to go up to the last timestep.
+every: int, stride over the timesteps within start and end, 1 for every timestep.
+"""
+
+
+def get_time_window(base_dt, start=None, end=None, every=None):
+    """
+    Time window of the start, end and every parameters of an extract request.
+    :param base_dt: datetime, model start time
+    :param start: str, first timestamp to extract, "yyyy-mm-dd HH:MM:SS" or "yyyy-mm-dd_HH:MM:SS", optional
+    :param end: str, last timestamp to extract, same format as start, optional
+    :param every: str or int, extract every nth timestep of the window, optional
+    :return: TimeWindow, None if none of the parameters is given
+    :raise ValueError: if a parameter is not valid
+    """
+    if not start and not end and every in [None, '']:
+        return None
+    start_time = _get_model_time(base_dt, start) if start else None
+    end_time = _get_model_time(base_dt, end) if end else None
+    if start_time is not None and end_time is not None and end_time < start_time:
+        raise ValueError('end is before start.')
+    every = int(every) if every not in [None, ''] else 1
+    if every < 1:
+        raise ValueError('every should be a positive integer.')
+    return TimeWindow(start_time, end_time, every)
+
+
+def get_window_steps(model_times, window):
+    """
+    Positions of the timesteps within the time window.
+    :param model_times: list or numpy.ndarray of float, model times of the timesteps in hours, in order
+    :param window: TimeWindow, None for every timestep
+    :return: numpy.ndarray of int
+    """
+    model_times = np.asarray(model_times, dtype=float)
+    if window is None:
+        return np.arange(len(model_times))
+    in_window = np.ones(len(model_times), dtype=bool)
+    if window.start is not None:
+        in_window &= model_times >= window.start
+    if window.end is not None:
+        in_window &= model_times <= window.end
+    return np.flatnonzero(in_window)[::window.every]
+
+
+def _get_model_time(base_dt, date_time):
+    for date_time_format in [DATE_TIME_FORMAT, INIT_DATE_TIME_FORMAT]:
+        try:
+            return (datetime.strptime(date_time, date_time_format) - base_dt).total_seconds() / 3600.0
+        except ValueError:
+            pass
+    raise ValueError('Invalid date time: %s' % date_time)